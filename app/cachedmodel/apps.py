@@ -9,3 +9,13 @@ class CachedModelAppConfig(AppConfig):
     """
     name = "cachedmodel"
     verbose_name = "Row Cached Models"
+
+    def ready(self):
+        from django.core.signals import request_started
+        from .models import connect_extra_cache_signals, connect_m2m_cache_signals
+        from .utils.modelutils import build_model_registry, preload_content_types
+        connect_extra_cache_signals()
+        connect_m2m_cache_signals()
+        build_model_registry()
+        # not from here, as the database may not be ready
+        request_started.connect(preload_content_types, dispatch_uid='cachedmodel.preload_content_types')
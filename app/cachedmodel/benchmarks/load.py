@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+Drive concurrent row cache reads mixed with writes, from threads in one or more processes
+"""
+import contextlib
+import multiprocessing
+import platform
+import random
+import threading
+import time
+
+import django
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import DatabaseError, connections, models
+
+from .suite import BenchmarkRows, _summary, benchmark_caches, row_cache_alias
+from ..utils.lazymodel import get_model_cache
+
+__all__ = (
+    'LoadWorker',
+    'run_load',
+)
+
+
+# locks for writes to rows, shared by all workers; each guards every STRIPES'th row
+STRIPES = 64
+
+
+def _version_field(model, exclude):
+    """A text field to write a version number to on each save."""
+    # noinspection PyProtectedMember
+    for field in model._meta.concrete_fields:
+        if (field is not exclude and not field.unique and not field.is_relation
+                and isinstance(field, (models.CharField, models.TextField))):
+            return field
+    raise ValueError(f'{model._meta.label} has no text field to write versions to')
+
+
+class LoadWorker:
+    """
+    Reads and writes random rows for a while, keeping the time taken and
+    queries made by each operation.
+
+    Each write saves a new version number to the row, and once saved records
+    it in shared memory. A read which returns an older version than the one
+    recorded when it began is counted as stale: it missed a write which had
+    already finished.
+
+    """
+
+    def __init__(self, rows, version_field, shared, write_ratio=0.1, lookup_ratio=0.5, seed=None):
+        self.model = rows.model
+        self.pks = rows.pks
+        self.lookups = [rows.lookup(pk) for pk in self.pks]
+        self.field = version_field
+        self.versions, self.counter, self.locks = shared
+        self.write_ratio = write_ratio
+        self.lookup_ratio = lookup_ratio
+        self.random = random.Random(seed)
+        self.times = {'read_pk': [], 'read_lookup': [], 'write': []}
+        self.queries = dict.fromkeys(self.times, 0)
+        self.stale = 0
+        self.errors = 0
+        self.error = None
+        self._queries = 0
+
+    def _count_query(self, execute, sql, params, many, context):
+        self._queries += 1
+        return execute(sql, params, many, context)
+
+    def read(self, i, lookup) -> bool:
+        expected = self.versions[i]
+        if lookup:
+            instance = self.model.objects.get(**self.lookups[i])
+        else:
+            instance = self.model.objects.get(pk=self.pks[i])
+        try:
+            version = int(getattr(instance, self.field.attname) or 0)
+        except ValueError:
+            version = 0
+        return version < expected
+
+    def write(self, i):
+        with self.locks[i % STRIPES]:
+            with self.counter.get_lock():
+                self.counter.value += 1
+                version = self.counter.value
+            instance = self.model.objects.get(pk=self.pks[i])
+            setattr(instance, self.field.attname, str(version))
+            # invalidates or writes through the cached row, as remove_object_from_cache() is connected
+            instance.save()
+            self.versions[i] = version
+
+    def run(self, duration):
+        deadline = time.monotonic() + duration
+        connection = connections['default']
+        try:
+            with connection.execute_wrapper(self._count_query):
+                while time.monotonic() < deadline:
+                    i = self.random.randrange(len(self.pks))
+                    if self.random.random() < self.write_ratio:
+                        kind = 'write'
+                    else:
+                        kind = 'read_lookup' if self.random.random() < self.lookup_ratio else 'read_pk'
+                    self._queries = 0
+                    start = time.perf_counter()
+                    try:
+                        if kind == 'write':
+                            self.write(i)
+                        elif self.read(i, kind == 'read_lookup'):
+                            self.stale += 1
+                    except (DatabaseError, self.model.DoesNotExist) as e:
+                        self.errors += 1
+                        self.error = self.error or f'{type(e).__name__}: {e}'
+                        continue
+                    self.times[kind].append(time.perf_counter() - start)
+                    self.queries[kind] += self._queries
+        finally:
+            connections.close_all()
+
+    def result(self) -> dict:
+        return {'times': self.times, 'queries': self.queries, 'stale': self.stale,
+                'errors': self.errors, 'error': self.error}
+
+
+def _run_threads(rows, version_field, shared, threads, duration, options, seed, results=None) -> list:
+    workers = [LoadWorker(rows, version_field, shared, seed=seed + n, **options) for n in range(threads)]
+    running = [threading.Thread(target=worker.run, args=(duration,), daemon=True) for worker in workers]
+    for thread in running:
+        thread.start()
+    for thread in running:
+        thread.join()
+    found = [worker.result() for worker in workers]
+    if results is not None:
+        # in a child process
+        results.put(found)
+    return found
+
+
+def _combine(found, elapsed) -> dict:
+    times = {}
+    queries = {}
+    for result in found:
+        for kind, kind_times in result['times'].items():
+            times.setdefault(kind, []).extend(kind_times)
+            queries[kind] = queries.get(kind, 0) + result['queries'][kind]
+    reads = len(times['read_pk']) + len(times['read_lookup'])
+    stale = sum(result['stale'] for result in found)
+    total = sum(len(kind_times) for kind_times in times.values())
+    operations = {}
+    for kind, kind_times in times.items():
+        operations[kind] = dict(_summary(kind_times), queries=queries[kind] / max(len(kind_times), 1),
+                                ops_per_second=len(kind_times) / elapsed)
+    return {
+        'ops': total,
+        'ops_per_second': total / elapsed,
+        'queries': sum(queries.values()) / max(total, 1),
+        'stale_reads': stale,
+        'stale_rate': stale / max(reads, 1),
+        'errors': sum(result['errors'] for result in found),
+        'error': next((result['error'] for result in found if result['error']), None),
+        'operations': operations,
+    }
+
+
+def run_load(model, rows=1000, threads=4, processes=1, duration=10.0, write_ratio=0.1, lookup_ratio=0.5,
+             redis_url=None, seed=None, label=None) -> dict:
+    """
+    Run workers in threads, in each of one or more processes, against rows
+    added to the model's table and removed afterwards. Uses the row cache
+    backend from the settings, or a Redis server if a url is given.
+
+    Processes are forked, so that they share the locks and versions of the rows.
+    They must share the row cache too, so more than one needs a Redis server
+    or a shared row cache backend.
+    """
+    ctx = multiprocessing.get_context('fork')
+    get_model_cache()
+    if processes > 1 and not redis_url and isinstance(caches[get_model_cache.cache], LocMemCache):
+        raise ValueError('The row cache is local memory, which forked processes do not share; '
+                         'give a Redis url to run more than one process')
+    seed = random.randrange(1 << 30) if seed is None else seed
+    benchmark_rows = BenchmarkRows(model, prefix='load-')
+    version_field = _version_field(model, benchmark_rows.field)
+    options = {'write_ratio': write_ratio, 'lookup_ratio': lookup_ratio}
+    try:
+        benchmark_rows.grow(rows)
+        shared = (ctx.Array('q', len(benchmark_rows.pks), lock=False), ctx.Value('q', 0),
+                  [ctx.Lock() for _ in range(STRIPES)])
+        with contextlib.ExitStack() as stack:
+            if redis_url:
+                aliases = stack.enter_context(benchmark_caches(redis_url))
+                stack.enter_context(row_cache_alias(aliases['redis']))
+            cache_backend = type(caches[get_model_cache.cache]).__name__
+            # connections can't be shared with the forked processes
+            connections.close_all()
+
+            start = time.monotonic()
+            if processes > 1:
+                results = ctx.Queue()
+                children = [ctx.Process(target=_run_threads, daemon=True,
+                                        args=(benchmark_rows, version_field, shared, threads, duration, options,
+                                              seed + n * threads, results))
+                            for n in range(processes)]
+                for child in children:
+                    child.start()
+                found = [result for _ in children for result in results.get()]
+                for child in children:
+                    child.join()
+            else:
+                found = _run_threads(benchmark_rows, version_field, shared, threads, duration, options, seed)
+            elapsed = time.monotonic() - start
+    finally:
+        benchmark_rows.delete()
+
+    return {
+        'meta': {
+            'label': label,
+            'model': model._meta.label,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'platform': platform.platform(),
+            'database': connections['default'].vendor,
+            'cache': 'redis' if redis_url else get_model_cache.cache,
+            'cache_backend': cache_backend,
+            'rows': rows,
+            'threads': threads,
+            'processes': processes,
+            'duration': elapsed,
+            'write_ratio': write_ratio,
+            'lookup_ratio': lookup_ratio,
+            'seed': seed,
+        },
+        'results': _combine(found, elapsed),
+    }
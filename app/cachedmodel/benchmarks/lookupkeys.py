@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the cost of building lookup cache keys with HashableTuple and the key compiler
+"""
+import timeit
+
+from ..utils.hashtuple import HashableTuple
+from ..utils.keycompiler import lookup_keys
+from ..utils.modelutils import get_identifier
+
+__all__ = (
+    'LOOKUPS',
+    'benchmark_lookup',
+)
+
+
+LOOKUPS = {
+    'name': {'name': 'address-book'},
+    'name, id__gt': {'name': 'address-book', 'id__gt': 10},
+    'name__in': {'name__in': ['address-book', 'address-card', 'adjust']},
+}
+
+
+def hashtuple_key(model, kwargs):
+    """The lookup cache key identifier, as built before the key compiler."""
+    return get_identifier(model, HashableTuple((), kwargs).hash)
+
+
+def benchmark_lookup(model, kwargs, number=100000) -> dict:
+    """Time in microseconds to build the identifier of a lookup cache key, each way."""
+    def hashtuple():
+        hashtuple_key(model, kwargs)
+
+    def compiled():
+        lookup_keys(model, kwargs)
+
+    return {
+        'hashtuple_us': min(timeit.repeat(hashtuple, number=number, repeat=3)) / number * 1e6,
+        'compiled_us': min(timeit.repeat(compiled, number=number, repeat=3)) / number * 1e6,
+    }
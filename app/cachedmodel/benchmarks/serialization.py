@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the size and decode time of pickled instances with compact rows
+"""
+import pickle
+import timeit
+
+from django.db import DatabaseError, models
+from django.utils import timezone
+
+from ..utils.serialization import decode_row, encode_row
+
+__all__ = (
+    'DEFAULT_MODELS',
+    'benchmark_model',
+    'sample_instance',
+)
+
+
+DEFAULT_MODELS = ('media.Icon', 'core.Message', 'cachedmodel.CachedModelTypes')
+
+
+def _sample_value(field):
+    if isinstance(field, (models.AutoField, models.ForeignKey, models.IntegerField)):
+        return 1
+    if isinstance(field, models.DateTimeField):
+        return timezone.now()
+    if isinstance(field, models.BooleanField):
+        return True
+    if isinstance(field, (models.CharField, models.TextField)):
+        return 'x' * min(field.max_length or 256, 256)
+    return None
+
+
+def sample_instance(model):
+    """The first row of a model's table, or an instance made up if there are none."""
+    try:
+        instance = model._base_manager.order_by('pk').first()
+    except DatabaseError:
+        instance = None
+    if instance is None:
+        # noinspection PyProtectedMember
+        fields = model._meta.concrete_fields
+        instance = model.from_db('default', [field.attname for field in fields],
+                                 [_sample_value(field) for field in fields])
+    return instance
+
+
+def benchmark_model(model, number=10000) -> dict:
+    """Encoded size in bytes, and time in microseconds to decode, of a row in each format."""
+    instance = sample_instance(model)
+    pickled = pickle.dumps(instance, pickle.HIGHEST_PROTOCOL)
+    compact = pickle.dumps(encode_row(instance), pickle.HIGHEST_PROTOCOL)
+
+    def decode_pickled():
+        pickle.loads(pickled)
+
+    def decode_compact():
+        decode_row(pickle.loads(compact))
+
+    return {
+        'model': model._meta.label,
+        'pickle_bytes': len(pickled),
+        'compact_bytes': len(compact),
+        'pickle_us': min(timeit.repeat(decode_pickled, number=number, repeat=3)) / number * 1e6,
+        'compact_us': min(timeit.repeat(decode_compact, number=number, repeat=3)) / number * 1e6,
+    }
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+Time the row cache operations against cache backends at several table sizes
+"""
+import contextlib
+import platform
+import random
+import time
+
+import django
+from django.core.cache import caches
+from django.db import connections, models
+from django.db.models.signals import post_save
+from django.test.utils import CaptureQueriesContext
+
+from .lookupkeys import LOOKUPS, benchmark_lookup
+from .serialization import _sample_value
+from ..models import remove_object_from_cache
+from ..testing import CountingCache
+from ..utils.bloom import reset_bloom_filter
+from ..utils.lazymodel import LazyModelObject, LazyModelObjectDict, get_model_cache
+from ..utils.modelutils import _model_generations, bump_model_generation, get_identifier
+
+__all__ = (
+    'BENCHMARKS',
+    'BenchmarkRows',
+    'benchmark_backend',
+    'benchmark_caches',
+    'benchmark_lookup_keys',
+    'compare_results',
+    'run_suite',
+)
+
+
+BENCHMARKS = ('get_pk', 'get_lookup', 'save', 'lazy_object', 'lazy_dict', 'lookup_key')
+
+# prefix of the cache aliases added for the benchmarks, and of their keys
+ALIAS_PREFIX = 'cachedmodel-benchmark-'
+
+# objects resolved together by each LazyModelObjectDict
+DICT_BATCH = 50
+
+
+@contextlib.contextmanager
+def benchmark_caches(redis_url=None, max_entries=1000000):
+    """
+    Add cache aliases for the benchmarks to run against, {name: alias}: an
+    empty local memory cache, and a Redis (or Redis compatible) server if a url
+    is given, whose keys are prefixed so a shared server can be used.
+    """
+    backends = {
+        'locmem': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': f'{ALIAS_PREFIX}locmem',
+            'OPTIONS': {'MAX_ENTRIES': max_entries},
+        },
+    }
+    if redis_url:
+        backends['redis'] = {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': redis_url,
+            'KEY_PREFIX': ALIAS_PREFIX,
+        }
+    aliases = {name: f'{ALIAS_PREFIX}{name}' for name in backends}
+    for name, alias in aliases.items():
+        caches.settings[alias] = backends[name]
+    try:
+        if redis_url:
+            try:
+                caches[aliases['redis']].get(f'{ALIAS_PREFIX}probe')
+            except Exception as e:
+                raise ValueError(f"Can't use the Redis server at {redis_url}: {e}") from e
+        yield aliases
+    finally:
+        for alias in aliases.values():
+            caches.settings.pop(alias, None)
+            with contextlib.suppress(AttributeError):
+                del caches[alias]
+
+
+@contextlib.contextmanager
+def row_cache_alias(alias):
+    """Use another cache alias for the row cache."""
+    get_model_cache()
+    previous = get_model_cache.cache
+    get_model_cache.cache = alias
+    # generations are held locally, and differ between backends
+    _model_generations.clear()
+    if get_model_cache.local is not None:
+        get_model_cache.local.clear()
+    try:
+        yield caches[alias]
+    finally:
+        get_model_cache.cache = previous
+        _model_generations.clear()
+        if get_model_cache.local is not None:
+            get_model_cache.local.clear()
+
+
+class BenchmarkRows:
+    """
+    Rows added to a model's table for the benchmarks, named with a prefix in
+    the first unique text field, and removed by delete().
+    """
+
+    def __init__(self, model, prefix='benchmark-'):
+        self.model = model
+        self.prefix = prefix
+        # noinspection PyProtectedMember
+        fields = [field for field in model._meta.concrete_fields if not field.primary_key]
+        unique = [field for field in fields if field.unique and isinstance(field, models.CharField)]
+        if not unique:
+            raise ValueError(f'{model._meta.label} has no unique text field to look rows up with')
+        self.field = unique[0]
+        self.fields = fields
+        self.names = {}
+
+    def _value(self, field, i):
+        if field is self.field:
+            return f'{self.prefix}{i}'
+        if field.has_default() or field.null:
+            return field.get_default()
+        value = None if field.is_relation else _sample_value(field)
+        if value is None:
+            raise ValueError(f"Can't make up a value for {field.model._meta.label}.{field.name}")
+        return value
+
+    def grow(self, size, batch_size=1000):
+        """Add rows until there are size of them."""
+        start = len(self.names)
+        objects = [self.model(**{field.attname: self._value(field, i) for field in self.fields})
+                   for i in range(start, size)]
+        # noinspection PyProtectedMember
+        self.model._base_manager.bulk_create(objects, batch_size=batch_size)
+        self.names = dict(self.model._base_manager.filter(**{f'{self.field.name}__startswith': self.prefix})
+                          .values_list('pk', self.field.name))
+        # bulk_create() doesn't add the rows to the Bloom filter
+        reset_bloom_filter(self.model)
+
+    @property
+    def pks(self) -> list:
+        return list(self.names)
+
+    def lookup(self, pk) -> dict:
+        return {self.field.name: self.names[pk]}
+
+    def delete(self):
+        # noinspection PyProtectedMember
+        self.model._base_manager.filter(**{f'{self.field.name}__startswith': self.prefix}).delete()
+        self.names = {}
+
+
+def _summary(times) -> dict:
+    times = sorted(times)
+    n = len(times)
+    return {
+        'ops': n,
+        'mean_us': sum(times) / n * 1e6 if n else None,
+        'p50_us': times[n // 2] * 1e6 if n else None,
+        'p99_us': times[min(n - 1, int(n * 0.99))] * 1e6 if n else None,
+    }
+
+
+def _measure(alias, calls) -> dict:
+    """Time each call, and count the cache round trips and queries it makes."""
+    times = []
+    with CountingCache(alias) as counter, CaptureQueriesContext(connections['default']) as queries:
+        for call in calls:
+            start = time.perf_counter()
+            call()
+            times.append(time.perf_counter() - start)
+    result = _summary(times)
+    result['round_trips'] = counter.round_trips / max(len(times), 1)
+    result['queries'] = len(queries) / max(len(times), 1)
+    return result
+
+
+def benchmark_backend(rows, alias, number=1000, benchmarks=BENCHMARKS) -> list:
+    """
+    Run the benchmarks against one cache backend, each cold (just after the
+    model moved to a new cache generation) then warm, for a sample of rows.
+    """
+    model = rows.model
+    pks = random.sample(rows.pks, min(number, len(rows.pks)))
+    identifiers = [get_identifier(model, pk) for pk in pks]
+    results = []
+
+    def run(benchmark, make_calls, phases=('cold', 'warm')):
+        if benchmark not in benchmarks:
+            return
+        for phase in phases:
+            if phase == 'cold':
+                bump_model_generation(model)
+            results.append(dict(benchmark=benchmark, phase=phase, **_measure(alias, make_calls())))
+
+    with row_cache_alias(alias):
+        run('get_pk', lambda: [lambda pk=pk: model.objects.get(pk=pk) for pk in pks])
+        lookups = [rows.lookup(pk) for pk in pks]
+        run('get_lookup', lambda: [lambda lookup=lookup: model.objects.get(**lookup) for lookup in lookups])
+        run('lazy_object', lambda: [lambda identifier=identifier: bool(LazyModelObject(identifier))
+                                    for identifier in identifiers])
+
+        def resolve(batch):
+            objects = LazyModelObjectDict()
+            for identifier in batch:
+                objects.add(identifier)
+            objects.resolve()
+
+        batches = [identifiers[i:i + DICT_BATCH] for i in range(0, len(identifiers), DICT_BATCH)]
+        run('lazy_dict', lambda: [lambda batch=batch: resolve(batch) for batch in batches])
+
+        # saved rows are written through to the cache by remove_object_from_cache()
+        # noinspection PyProtectedMember
+        instances = list(model._base_manager.filter(pk__in=pks))
+        run('save', lambda: [instance.save for instance in instances], phases=('save',))
+        run('save', lambda: [lambda instance=instance: remove_object_from_cache(
+            model, instance, signal=post_save, created=False) for instance in instances], phases=('signal',))
+    return results
+
+
+def benchmark_lookup_keys(model, number=100000) -> list:
+    """Time building lookup cache keys, with HashableTuple and the key compiler."""
+    results = []
+    for name, kwargs in LOOKUPS.items():
+        timings = benchmark_lookup(model, kwargs, number=number)
+        for phase in ('hashtuple', 'compiled'):
+            results.append({'benchmark': 'lookup_key', 'phase': phase, 'lookup': name, 'ops': number,
+                            'mean_us': timings[f'{phase}_us'], 'p50_us': None, 'p99_us': None,
+                            'round_trips': 0, 'queries': 0})
+    return results
+
+
+def run_suite(model, sizes=(100, 1000, 10000), number=1000, redis_url=None, benchmarks=BENCHMARKS,
+              label=None, progress=None) -> dict:
+    """
+    Run the benchmarks for each table size and backend, adding rows to the
+    model's table as it grows and removing them afterwards. Returns the
+    results, with details of where they were run, to be saved as JSON.
+    """
+    results = []
+    rows = BenchmarkRows(model)
+    try:
+        with benchmark_caches(redis_url) as aliases:
+            for size in sorted(sizes):
+                rows.grow(size)
+                for backend, alias in aliases.items():
+                    if progress:
+                        progress(f'{backend}, {size} rows')
+                    for result in benchmark_backend(rows, alias, number=number, benchmarks=benchmarks):
+                        results.append(dict(result, backend=backend, size=size))
+    finally:
+        rows.delete()
+    if 'lookup_key' in benchmarks:
+        # building a key takes microseconds, so many more are timed
+        results.extend(benchmark_lookup_keys(model, number=number * 100))
+
+    return {
+        'meta': {
+            'label': label,
+            'model': model._meta.label,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'platform': platform.platform(),
+            'database': connections['default'].vendor,
+            'sizes': sorted(sizes),
+            'number': number,
+        },
+        'results': results,
+    }
+
+
+def _result_key(result) -> tuple:
+    return result['benchmark'], result['phase'], result.get('backend'), result.get('size'), result.get('lookup')
+
+
+def compare_results(previous, current) -> list:
+    """Pair the results of two runs, adding the ratio of each one's time to the previous one's."""
+    before = {_result_key(result): result for result in previous['results']}
+    compared = []
+    for result in current['results']:
+        old = before.get(_result_key(result))
+        stat = 'mean_us' if result['p50_us'] is None else 'p50_us'
+        ratio = result[stat] / old[stat] if old and old.get(stat) else None
+        compared.append(dict(result, previous_us=old[stat] if old else None, ratio=ratio))
+    return compared
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from cachedmodel.benchmarks.lookupkeys import LOOKUPS, benchmark_lookup
+
+
+class Command(BaseCommand):
+    help = 'Compare the cost of building lookup cache keys with HashableTuple and the key compiler'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', default='media.Icon', metavar='app_label.ModelName',
+                            help='Model to build keys for, default media.Icon')
+        parser.add_argument('--number', type=int, default=100000,
+                            help='Number of keys to time for each lookup')
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options['model'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(f'{"lookup":24} {"hashtuple":>10} {"compiled":>10}')
+        for name, kwargs in LOOKUPS.items():
+            result = benchmark_lookup(model, kwargs, number=options['number'])
+            self.stdout.write(f'{name:24} {result["hashtuple_us"]:8.2f}us {result["compiled_us"]:8.2f}us')
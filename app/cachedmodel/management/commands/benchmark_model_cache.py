@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import json
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from cachedmodel.benchmarks.suite import BENCHMARKS, compare_results, run_suite
+
+
+class Command(BaseCommand):
+    help = ('Time row cache reads, writes and lazy objects against local memory and Redis caches, '
+            'at several table sizes. Rows are added to the model\'s table and removed afterwards, '
+            'so use a development database')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', default='media.Icon', metavar='app_label.ModelName',
+                            help='Row cached model to benchmark, default media.Icon')
+        parser.add_argument('--sizes', default='100,1000,10000',
+                            help='Comma separated numbers of rows to benchmark with, default 100,1000,10000')
+        parser.add_argument('--number', type=int, default=1000,
+                            help='Rows read or written by each benchmark, default 1000')
+        parser.add_argument('--redis', metavar='URL',
+                            help='Also benchmark a Redis compatible server, e.g. redis://127.0.0.1:6379/15')
+        parser.add_argument('--benchmark', action='append', choices=BENCHMARKS,
+                            help='Benchmarks to run, default all; may be repeated')
+        parser.add_argument('--label',
+                            help='Name for the results, e.g. the release')
+        parser.add_argument('--output', metavar='FILE',
+                            help='Write the results to a JSON file')
+        parser.add_argument('--compare', metavar='FILE',
+                            help='JSON results of an earlier run to compare with')
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options['model'])
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+        previous = None
+        if options['compare']:
+            try:
+                with open(options['compare']) as f:
+                    previous = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Can't read {options['compare']}: {e}")
+
+        try:
+            report = run_suite(model, sizes=sizes, number=options['number'], redis_url=options['redis'],
+                               benchmarks=options['benchmark'] or BENCHMARKS, label=options['label'],
+                               progress=self.stderr.write if options['verbosity'] > 1 else None)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+
+        results = compare_results(previous, report) if previous else report['results']
+        self.stdout.write(f'{"benchmark":12} {"phase":10} {"backend":8} {"size":>6} {"ops":>6} '
+                          f'{"p50":>10} {"p99":>10} {"trips":>6} {"queries":>7}'
+                          + (f' {"before":>10} {"ratio":>6}' if previous else ''))
+        for result in results:
+            name = result.get('lookup') or result.get('backend') or ''
+            p50 = result['p50_us'] if result['p50_us'] is not None else result['mean_us']
+            p99 = f'{result["p99_us"]:8.1f}us' if result['p99_us'] is not None else f'{"":10}'
+            line = (f'{result["benchmark"]:12} {result["phase"]:10} {name[:8]:8} {result.get("size") or "":>6} '
+                    f'{result["ops"]:6d} {p50:8.1f}us {p99} {result["round_trips"]:6.2f} {result["queries"]:7.2f}')
+            if previous:
+                before = f'{result["previous_us"]:8.1f}us' if result['previous_us'] is not None else f'{"":10}'
+                ratio = f'{result["ratio"]:6.2f}' if result['ratio'] is not None else ''
+                line += f' {before} {ratio}'
+            self.stdout.write(line)
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from cachedmodel.benchmarks.serialization import DEFAULT_MODELS, benchmark_model
+
+
+class Command(BaseCommand):
+    help = 'Compare the size and decode time of pickled and compact cached rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', metavar='app_label.ModelName',
+                            help=f'Models to benchmark, default {", ".join(DEFAULT_MODELS)}')
+        parser.add_argument('--number', type=int, default=10000,
+                            help='Number of decodes to time for each model')
+
+    def handle(self, *args, **options):
+        try:
+            models = [apps.get_model(label) for label in options['models'] or DEFAULT_MODELS]
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(f'{"model":32} {"pickle":>8} {"compact":>8} {"pickle":>10} {"compact":>10}')
+        for model in models:
+            result = benchmark_model(model, number=options['number'])
+            self.stdout.write(f'{result["model"]:32} '
+                              f'{result["pickle_bytes"]:7d}B {result["compact_bytes"]:7d}B '
+                              f'{result["pickle_us"]:8.2f}us {result["compact_us"]:8.2f}us')
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from cachedmodel.models import CachedModel
+from cachedmodel.utils.modelutils import bump_model_generation, get_model_name
+
+
+class Command(BaseCommand):
+    help = 'Invalidate all cached rows and lookups of the given models'
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', metavar='app_label.ModelName',
+                            help='Models to invalidate')
+        parser.add_argument('--all', action='store_true',
+                            help='Invalidate all CachedModel subclasses')
+
+    def handle(self, *args, **options):
+        if options['all']:
+            models = [model for model in apps.get_models() if issubclass(model, CachedModel)]
+        elif options['models']:
+            models = []
+            for label in options['models']:
+                try:
+                    models.append(apps.get_model(label))
+                except (LookupError, ValueError) as e:
+                    raise CommandError(str(e))
+        else:
+            raise CommandError('Provide one or more models, or --all')
+
+        for model in models:
+            generation = bump_model_generation(model)
+            self.stdout.write(f'{get_model_name(model)}: generation {generation}')
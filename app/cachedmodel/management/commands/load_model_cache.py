@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import json
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from cachedmodel.benchmarks.load import run_load
+
+
+class Command(BaseCommand):
+    help = ('Read and write rows from concurrent threads and processes through the row cache, and report '
+            'throughput, latency, queries and stale reads. Rows are added to the model\'s table and removed '
+            'afterwards, so use a development database')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', default='media.Icon', metavar='app_label.ModelName',
+                            help='Row cached model to use, default media.Icon')
+        parser.add_argument('--rows', type=int, default=1000,
+                            help='Rows to read and write, default 1000')
+        parser.add_argument('--threads', type=int, default=4,
+                            help='Threads in each process, default 4')
+        parser.add_argument('--processes', type=int, default=1,
+                            help='Processes to run, default 1; more are forked')
+        parser.add_argument('--duration', type=float, default=10,
+                            help='Seconds to run for, default 10')
+        parser.add_argument('--write-ratio', type=float, default=0.1,
+                            help='Fraction of operations which save a row, default 0.1')
+        parser.add_argument('--lookup-ratio', type=float, default=0.5,
+                            help='Fraction of reads by lookup rather than pk, default 0.5')
+        parser.add_argument('--redis', metavar='URL',
+                            help='Use a Redis compatible server, e.g. redis://127.0.0.1:6379/15, '
+                                 'rather than the row cache from the settings')
+        parser.add_argument('--seed', type=int,
+                            help='Seed for the choice of operations and rows')
+        parser.add_argument('--label',
+                            help='Name for the results, e.g. the change being tried')
+        parser.add_argument('--output', metavar='FILE',
+                            help='Write the results to a JSON file')
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options['model'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+        if not 0 <= options['write_ratio'] <= 1 or not 0 <= options['lookup_ratio'] <= 1:
+            raise CommandError('--write-ratio and --lookup-ratio must be between 0 and 1')
+        if options['rows'] < 1 or options['threads'] < 1 or options['processes'] < 1:
+            raise CommandError('--rows, --threads and --processes must be at least 1')
+
+        try:
+            report = run_load(model, rows=options['rows'], threads=options['threads'],
+                              processes=options['processes'], duration=options['duration'],
+                              write_ratio=options['write_ratio'], lookup_ratio=options['lookup_ratio'],
+                              redis_url=options['redis'], seed=options['seed'], label=options['label'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+
+        meta, results = report['meta'], report['results']
+        self.stdout.write(f'{meta["processes"]} x {meta["threads"]} workers, {meta["rows"]} rows, '
+                          f'{meta["duration"]:.1f}s, cache {meta["cache"]}: {results["ops"]} operations, '
+                          f'{results["ops_per_second"]:.0f}/s, {results["queries"]:.2f} queries each')
+        self.stdout.write(f'{"operation":12} {"ops":>8} {"per sec":>8} {"p50":>10} {"p99":>10} {"queries":>7}')
+        for kind, counts in results['operations'].items():
+            if counts['ops']:
+                self.stdout.write(f'{kind:12} {counts["ops"]:8d} {counts["ops_per_second"]:8.0f} '
+                                  f'{counts["p50_us"]:8.1f}us {counts["p99_us"]:8.1f}us {counts["queries"]:7.2f}')
+        self.stdout.write(f'stale reads: {results["stale_reads"]} ({results["stale_rate"]:.2%})')
+        if results['errors']:
+            self.stdout.write(f'errors: {results["errors"]}, first {results["error"]}')
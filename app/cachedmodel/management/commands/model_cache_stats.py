@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import json
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from cachedmodel.manager import get_cached_get_stats
+from cachedmodel.models import cache_senders
+from cachedmodel.utils.lazymodel import get_model_cache_stats
+from cachedmodel.utils.metrics import cache_metrics
+
+
+class Command(BaseCommand):
+    help = 'Show row cache hit, miss and latency counters for each model, totalled for all processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', metavar='app_label.ModelName',
+                            help='Models to report, default all cached models')
+        parser.add_argument('--json', action='store_true',
+                            help='Output the counters as JSON')
+        parser.add_argument('--reset', action='store_true',
+                            help='Reset the counters after reporting them')
+
+    def handle(self, *args, **options):
+        if options['models']:
+            try:
+                models = [apps.get_model(label) for label in options['models']]
+            except (LookupError, ValueError) as e:
+                raise CommandError(str(e))
+        else:
+            models = sorted(cache_senders, key=lambda model: model._meta.label_lower)
+
+        stats = cache_metrics.shared_snapshot(models)
+        if options['json']:
+            self.stdout.write(json.dumps({'models': stats, 'tiers': get_model_cache_stats(),
+                                          'get_caches': get_cached_get_stats()}, indent=2))
+        else:
+            self.stdout.write(f'{"model":32} {"kind":6} {"hits":>9} {"misses":>9} {"negative":>9} {"bloom":>9} '
+                              f'{"db":>9} {"invalid":>9} {"hit rate":>8} {"avg us":>8}')
+            for label, kinds in sorted(stats.items()):
+                for kind, counts in sorted(kinds.items()):
+                    found = counts['hits'] + counts['negative_hits'] + counts['bloom_hits']
+                    lookups = found + counts['misses']
+                    hit_rate = found / lookups if lookups else 0.0
+                    avg_us = counts['backend_us'] / counts['backend_calls'] if counts['backend_calls'] else 0.0
+                    self.stdout.write(f'{label:32} {kind:6} {counts["hits"]:9d} {counts["misses"]:9d} '
+                                      f'{counts["negative_hits"]:9d} {counts["bloom_hits"]:9d} '
+                                      f'{counts["db_fallbacks"]:9d} '
+                                      f'{counts["invalidations"]:9d} {hit_rate:8.1%} {avg_us:8.1f}')
+            get_caches = get_cached_get_stats()
+            if get_caches:
+                self.stdout.write(f'\n{"get() cache, this process":32} {"entries":>9} {"bytes":>9} '
+                                  f'{"hits":>9} {"misses":>9} {"evicted":>9} {"hit rate":>8}')
+                for label, counts in sorted(get_caches.items()):
+                    self.stdout.write(f'{label:32} {counts["entries"]:9d} {counts["bytes"]:9d} '
+                                      f'{counts["hits"]:9d} {counts["misses"]:9d} {counts["evictions"]:9d} '
+                                      f'{counts["hit_rate"]:8.1%}')
+
+        if options['reset']:
+            cache_metrics.reset(models)
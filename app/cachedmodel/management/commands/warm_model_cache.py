@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import time
+from itertools import islice
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import router
+
+from cachedmodel.models import CachedModel
+from cachedmodel.utils.lazymodel import fill_rows, get_model_cache, model_cache_key, pack_row
+from cachedmodel.utils.modelutils import get_model_name
+
+
+class Command(BaseCommand):
+    help = 'Load the rows of CachedModel tables into the row cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', metavar='app_label.ModelName',
+                            help='Models to load, default all CachedModel subclasses')
+        parser.add_argument('--filter', action='append', default=[], metavar='app_label.ModelName:lookup=value',
+                            help='Only load the rows of a model matching a lookup; may be repeated')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Rows read and cached at a time, default 1000')
+        parser.add_argument('--rate', type=float, default=0,
+                            help='Maximum rows per second for each model, default no limit')
+        parser.add_argument('--force', action='store_true',
+                            help='Replace rows already in cache, rather than only adding missing ones, '
+                                 'unless they were changed meanwhile')
+
+    def get_models(self, labels):
+        try:
+            if labels:
+                return [apps.get_model(label) for label in labels]
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+        return [model for model in apps.get_models() if issubclass(model, CachedModel)]
+
+    def get_filters(self, filters) -> dict:
+        """{model: {lookup: value}} from the --filter options"""
+        model_filters = {}
+        for option in filters:
+            try:
+                label, lookup = option.split(':', 1)
+                name, value = lookup.split('=', 1)
+                model = apps.get_model(label)
+            except (LookupError, ValueError):
+                raise CommandError(f'Invalid filter {option!r}, expected app_label.ModelName:lookup=value')
+            model_filters.setdefault(model, {})[name] = value
+        return model_filters
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        filters = self.get_filters(options['filter'])
+        for model in self.get_models(options['models']):
+            self.warm(model, filters.get(model, {}), options['chunk_size'], options['rate'], options['force'])
+
+    def warm(self, model, lookups, chunk_size, rate, force):
+        label = get_model_name(model)
+        cache, timeout = get_model_cache()
+        # from the primary, as a replica behind it would cache old rows
+        # noinspection PyProtectedMember
+        queryset = model._base_manager.using(router.db_for_write(model)).filter(**lookups).order_by('pk')
+        total = queryset.count()
+        # a server-side cursor where the database supports it
+        rows = queryset.iterator(chunk_size=chunk_size)
+
+        start = reported = time.monotonic()
+        loaded = cached = 0
+        while True:
+            chunk_start = time.monotonic()
+            chunk = {model_cache_key(instance, instance.pk): instance for instance in islice(rows, chunk_size)}
+            if not chunk:
+                break
+            loaded += len(chunk)
+            delta = time.monotonic() - chunk_start
+            # added where missing in one batch, so as not to overwrite rows saves have written since they were read
+            skipped = fill_rows(cache, {key: pack_row(instance, timeout, delta) for key, instance in chunk.items()},
+                                timeout, replace=chunk if force else ())
+            cached += len(chunk) - len(skipped)
+
+            elapsed = time.monotonic() - start
+            if rate > 0 and loaded / rate > elapsed:
+                time.sleep(loaded / rate - elapsed)
+            if self.verbosity > 1 or (self.verbosity and time.monotonic() - reported >= 1):
+                reported = time.monotonic()
+                self.stdout.write(f'{label}: {loaded}/{total} rows ({loaded / max(total, loaded):.0%}), '
+                                  f'{loaded / max(reported - start, 1e-6):.0f} rows/s')
+
+        if self.verbosity:
+            self.stdout.write(f'{label}: cached {cached} of {total} rows in {time.monotonic() - start:.1f}s')
@@ -1,15 +1,43 @@
 # -*- coding: utf-8 -*-
-from django.db import models
+import copy
+import time
+
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ValidationError
+from django.db import models, router
 from django.utils.functional import empty
 
-from .utils.lazymodel import model_cache_key, OBJECT_DOES_NOT_EXIST, get_model_cache
+from .query import RowCacheQuerySet, has_annotations
+from .signals import removed_from_cache
+from .utils.asynccache import cache_aget, cache_aget_many, has_async_client
+from .utils.bloom import get_bloom_filter
+from .utils.identitymap import current_identity_map
+from .utils.invalidation import has_pending_changes, is_pending
+from .utils.keycompiler import lookup_keys
+from .utils.localcache import LocalCache
+from .utils.metrics import cache_metrics
+from .utils.lazymodel import (
+    fill_rows,
+    model_cache_key,
+    pack_row,
+    refresh_early,
+    unpack_row,
+    OBJECT_DOES_NOT_EXIST,
+    get_model_cache,
+)
 from .utils.modelutils import (
+    aget_lookup_cache_row,
+    aget_model_generation,
+    get_identifier,
+    get_lookup_cache_row,
     lookup_cache_key,
     model_cache_deleted_cache_key,
     model_row_cache_enabled,
     save_lookup_cache_key,
     GET_ARGS_PK_KEY,
 )
+from .utils.singleflight import cache_fills
+
 DOES_NOT_EXIST_CACHE_TIMEOUT = 60 * 5
 DELETED_CACHE_TIMEOUT = 60
 LOOKUP_CACHE_TIMEOUT = 60 * 60
@@ -53,28 +81,82 @@ def _only_item(dict_: dict) -> tuple:
 
 class CachedGetManager(RelatedFieldManager):
     """
-    Manager for caching results of the get() method. Uses an ordinary
-    dictionary by default, but can be overridden to use anything that
-    supports dictionary-like access, such as a memcache wrapper.
+    Manager for caching results of the get() method by pk in the process.
+    Each model has its own bounded LRU cache, of at most cache_max_entries
+    objects held for cache_timeout seconds, and objects are dropped from it
+    when saved or deleted, by the same signals which update the row cache.
+    Changes made by other processes are only seen once entries expire.
+
+    Subclasses may instead set cache_backend to anything that supports
+    dictionary-like access, such as a memcache wrapper. Entries there are
+    kept by pk alone, and are not dropped when objects are saved or deleted.
 
     """
 
-    cache_backend = {}
+    cache_max_entries = 1000
+    cache_timeout = 5 * 60
+
+    @property
+    def cache_backend(self) -> LocalCache:
+        model = self.model._meta.concrete_model
+        try:
+            return _get_caches[model]
+        except KeyError:
+            pass
+        from .models import check_cache_signals
+        check_cache_signals(model)
+        removed_from_cache.connect(_discard_cached_get, sender=model, weak=False,
+                                   dispatch_uid=f'cachedmodel.get.{model._meta.label_lower}')
+        return _get_caches.setdefault(model, LocalCache(self.cache_max_entries, self.cache_timeout))
 
     def get(self, *args, **kwargs):
         if not args:
             key, value = _only_item(kwargs)
-            if key in GET_ARGS_PK_KEY:
-                pk = value
+            # objects changed in a transaction not yet committed are still cached as they were
+            if key in GET_ARGS_PK_KEY and not has_pending_changes():
                 try:
-                    result = self.cache_backend[pk]
-                except KeyError:
+                    # so that 1 and '1' are cached as one
+                    # noinspection PyProtectedMember
+                    pk = self.model._meta.pk.to_python(value)
+                except ValidationError:
+                    return super(CachedGetManager, self).get(*args, **kwargs)
+                cache_backend = self.cache_backend
+                result = cache_backend.get(pk)
+                if result is None:
                     result = super(CachedGetManager, self).get(*args, **kwargs)
-                    self.cache_backend[pk] = result
-                return result
+                    if isinstance(cache_backend, LocalCache):
+                        cache_backend.set(pk, result)
+                    else:
+                        # a dictionary-like backend set by a subclass
+                        cache_backend[pk] = result
+                # callers can't alter each other's objects
+                return copy.copy(result)
         return super(CachedGetManager, self).get(*args, **kwargs)
 
 
+# per model process-local caches of CachedGetManager
+_get_caches = {}
+
+
+# noinspection PyUnusedLocal
+def _discard_cached_get(sender, instance, **kwargs):
+    pk = getattr(instance, 'pk', None)
+    cache_backend = _get_caches.get(sender._meta.concrete_model)
+    if cache_backend is None:
+        return
+    if pk is None:
+        # given by identifier
+        cache_backend.clear()
+    else:
+        cache_backend.delete(pk)
+
+
+def get_cached_get_stats() -> dict:
+    """Entries, approximate size in bytes and hit rate of the CachedGetManager cache of each model."""
+    return {model._meta.label_lower: dict(cache_backend.stats(), bytes=cache_backend.footprint())
+            for model, cache_backend in list(_get_caches.items())}
+
+
 class RowCacheManager(RelatedFieldManager):
     """
     Manager for caching single-row queries. To make invalidation easy,
@@ -84,29 +166,60 @@ class RowCacheManager(RelatedFieldManager):
     this pk cache key should be invalidated. Doing two memcached queries is
     still much faster than fetching from the database.
 
+    Querysets are RowCacheQuerySet, which invalidates rows changed by bulk writes.
+
     """
 
+    _queryset_class = RowCacheQuerySet
+
+    def _bloom_excludes(self, kind, **kwargs) -> bool:
+        """Whether the model's Bloom filter shows nothing matches a single field lookup."""
+        bloom = get_bloom_filter(self.model)
+        # rows added in a transaction not yet committed are only added to the filter on commit
+        if bloom is None or bloom.may_exist(**kwargs) or has_pending_changes():
+            return False
+        cache_metrics.count(self.model, kind, 'bloom_hits')
+        return True
+
+    async def _abloom_excludes(self, kind, **kwargs) -> bool:
+        """Async version of _bloom_excludes(), which reads the cache in a thread when the filter is due to sync."""
+        bloom = get_bloom_filter(self.model)
+        if bloom is not None and bloom.sync_due():
+            return await sync_to_async(self._bloom_excludes, thread_sensitive=False)(kind, **kwargs)
+        return self._bloom_excludes(kind, **kwargs)
+
     # noinspection PyProtectedMember
     def get(self, *args, **kwargs):
 
-        if not model_row_cache_enabled():
-            # Bypass the cache.
+        if not model_row_cache_enabled() or args:
+            # Bypass the cache; positional arguments (Q objects) aren't part of the cache keys.
             return super(RowCacheManager, self).get(*args, **kwargs)
 
+        key, value = _only_item(kwargs)
+        identities, identity_lookup, result = self._from_identity_map(key, value, kwargs)
+        if result is not None:
+            return result
+
+        if self._bloom_excludes('pk' if key in GET_ARGS_PK_KEY else 'lookup', **kwargs):
+            raise self.model.DoesNotExist
+
         cache, timeout = get_model_cache()
 
         object_pk = None
         # to avoid UnboundError
         model_cache_deleted_key = None
 
-        key, value = _only_item(kwargs)
+        start = time.perf_counter()
         if key in GET_ARGS_PK_KEY:
             # Generate the cache key directly, since we have the id/pk.
+            kind = 'pk'
             pk_key = model_cache_key(self.model, value)
             lookup_key = None
+            model_cache_deleted_key = model_cache_deleted_cache_key(self.model, value)
         else:
             # This lookup is not simply an id/pk lookup.
             # Get the cache key for this lookup.
+            kind = 'lookup'
 
             # Handle related managers, which automatically use core_filters
             # to filter querysets using the related object's ID.
@@ -120,60 +233,368 @@ class RowCacheManager(RelatedFieldManager):
                 lookup_kwargs = kwargs
 
             lookup_key = lookup_cache_key(self.model, **lookup_kwargs)
+            if lookup_key is None:
+                # The values can't be cached against
+                cache_metrics.count(self.model, kind, 'db_fallbacks')
+                return super(RowCacheManager, self).get(*args, **kwargs)
 
-            # Try to get the cached pk_key.
-            object_pk = cache.get(lookup_key)
-            pk_key = object_pk and model_cache_key(self.model, object_pk)
+            # Try to get the cached pk_key, along with the row.
+            object_pk, row = get_lookup_cache_row(self.model, lookup_key)
+            pk_key = object_pk and object_pk != OBJECT_DOES_NOT_EXIST and model_cache_key(self.model, object_pk)
 
             # Check if this object was changed within the last minute
             model_cache_deleted_key = object_pk and model_cache_deleted_cache_key(self.model, object_pk)
 
-        # Try to get a cached result if the pk_key is known.
+        if pk_key and is_pending(pk_key):
+            # The object was changed in a transaction not yet committed, so read it from the database
+            cache_metrics.count(self.model, kind, 'db_fallbacks')
+            return super(RowCacheManager, self).get(*args, **kwargs)
+
+        # Try to get a cached result if the pk_key is known, in a single round trip.
+        if lookup_key is None:
+            row = cache.get(pk_key, empty)
         result = None
-        if pk_key and pk_key in cache:
-            result = cache.get(pk_key)
+        if pk_key and row is not empty:
+            result, expires, delta = unpack_row(row)
+            if result is empty:
+                # cached with an older schema
+                result = None
+
+            # Reload a fresh row a little ahead of expiry now and then, so hot rows never expire under load
+            if result and result != OBJECT_DOES_NOT_EXIST and refresh_early(expires, delta):
+                result = None
+        # a row there to be replaced, rather than a missing one to add
+        replace = bool(pk_key) and row is not empty and not result
+        cache_metrics.timed(self.model, kind, start)
 
         # in case we recorded the miss
         if result == OBJECT_DOES_NOT_EXIST or object_pk == OBJECT_DOES_NOT_EXIST:
+            cache_metrics.count(self.model, kind, 'negative_hits')
             raise self.model.DoesNotExist
 
+        cache_metrics.count(self.model, kind, 'hits' if result else 'misses')
         if not result:
-            try:
-                # The result was not in cache, so fetch it from the database
-                result = super(RowCacheManager, self).get(*args, **kwargs)
-            except self.model.DoesNotExist as e:
-                # Shall we cache DoesNotExist? Because this is risky depending on who calls it we are going to
-                # whitelist the models that we want to cache for and that we know cause unnecessary db calls
-                if getattr(self.model, 'cache_for_does_not_exist', False):
-                    if model_cache_deleted_key and cache.get(model_cache_deleted_key, False):
-                        cache_timeout = 60
-                    else:
-                        cache_timeout = DOES_NOT_EXIST_CACHE_TIMEOUT
-                    if lookup_key:
-                        cache.set(lookup_key, OBJECT_DOES_NOT_EXIST, timeout=cache_timeout)
-                    else:
-                        cache.set(pk_key, OBJECT_DOES_NOT_EXIST, timeout=cache_timeout)
-                raise e
-
-            object_pk = result.pk
-
-            # And cache the result against the pk_key for next time.
-            pk_key = model_cache_key(result, object_pk)
-            cache.set(pk_key, result, timeout=timeout)
-
-            # If a lookup was used, then cache the pk against it. Next time
-            # the same lookup is requested, it will find the relevant pk and
-            # be able to get the cached object using that.
-            if lookup_key:
-                if model_cache_deleted_key and cache.get(model_cache_deleted_key, False):
-                    # If the objects is changed recently, there is a high possibility that slave db hasn't synced yet.
-                    # So we only cache it for 60s instead of an hour to reduce the error.
-                    # We only need to do this for lookup_key because pk_key cache was refreshed when the object
-                    # is updated. By this way, it read from master db and ensured the value is up to date.
-                    cache.set(lookup_key, object_pk, DELETED_CACHE_TIMEOUT)
+            # Only one caller at a time loads the same row; the rest wait for its result
+            def load():
+                return self._load(cache, timeout, pk_key, lookup_key, model_cache_deleted_key, replace,
+                                  *args, **kwargs)
+
+            def recheck():
+                if lookup_key:
+                    cached = get_lookup_cache_row(self.model, lookup_key)[1]
                 else:
-                    cache.set(lookup_key, object_pk, timeout=LOOKUP_CACHE_TIMEOUT)
+                    cached = cache.get(pk_key, empty)
+                cached = unpack_row(cached)[0] if cached is not empty else empty
+                if cached and cached is not empty and cached != OBJECT_DOES_NOT_EXIST:
+                    return cached
+                return empty
+
+            result, shared = cache_fills.do(lookup_key or pk_key, load, cache=cache, recheck=recheck)
+            if shared:
+                result = copy.copy(result)
+
+        if identities is not None:
+            result = identities.add(get_identifier(result, result.pk), result, lookup=identity_lookup)
+        return result
 
-                save_lookup_cache_key(self.model, object_pk, lookup_key)
+    def _from_identity_map(self, key, value, kwargs) -> tuple:
+        """
+        The identity map of the request, the key of a lookup in it, and the
+        object if it was already fetched; objects changed in a transaction
+        not yet committed are fetched again.
+        """
+        identities = current_identity_map()
+        if identities is None or has_pending_changes():
+            return None, None, None
+        if key in GET_ARGS_PK_KEY:
+            return identities, None, identities.get(get_identifier(self.model, value))
+        core_filters = getattr(self, 'core_filters', None)
+        lookup = lookup_keys(self.model, dict(core_filters, **kwargs) if isinstance(core_filters, dict) else kwargs)
+        if lookup is None:
+            return None, None, None
+        return identities, lookup, identities.get_lookup(lookup)
+
+    def _load(self, cache, timeout, pk_key, lookup_key, model_cache_deleted_key, replace, *args, **kwargs):
+        """
+        Fetch a row missing from cache from the database, and cache it. Rows
+        changed within the replica lag, and misses about to be cached, are read
+        from the default database, so a replica behind it is never cached.
+        The row is only added if missing, as a save may have written a newer one
+        meanwhile, unless replace is set and the object hasn't changed since.
+        """
+        cache_metrics.count(self.model, 'lookup' if lookup_key else 'pk', 'db_fallbacks')
+        start = time.monotonic()
+        primary = router.db_for_write(self.model)
+        recently_changed = bool(model_cache_deleted_key and cache.get(model_cache_deleted_key, False))
+        queryset = self.get_queryset()
+        if recently_changed:
+            queryset = queryset.using(primary)
+        try:
+            try:
+                result = queryset.get(*args, **kwargs)
+            except self.model.DoesNotExist:
+                if queryset.db == primary or not getattr(self.model, 'cache_for_does_not_exist', False):
+                    raise
+                # the row may be missing from the replica only
+                queryset = queryset.using(primary)
+                result = queryset.get(*args, **kwargs)
+        except self.model.DoesNotExist as e:
+            # Shall we cache DoesNotExist? Because this is risky depending on who calls it we are going to
+            # whitelist the models that we want to cache for and that we know cause unnecessary db calls
+            if getattr(self.model, 'cache_for_does_not_exist', False) and not (pk_key and is_pending(pk_key)):
+                if recently_changed:
+                    cache_timeout = 60
+                else:
+                    cache_timeout = DOES_NOT_EXIST_CACHE_TIMEOUT
+                # not over a row written by a save meanwhile
+                cache.add(lookup_key or pk_key, OBJECT_DOES_NOT_EXIST, timeout=cache_timeout)
+            raise e
+
+        object_pk = result.pk
+        pk_key = model_cache_key(result, object_pk)
+        if is_pending(pk_key) or has_annotations(queryset):
+            # Don't cache uncommitted changes, or values from a manager's annotations
+            return result
+
+        if lookup_key and queryset.db != primary and not recently_changed:
+            # the pk wasn't known before, so check now whether the replica may be behind for this row
+            recently_changed = bool(cache.get(model_cache_deleted_cache_key(self.model, object_pk), False))
+            if recently_changed:
+                result = queryset.using(primary).get(*args, **kwargs)
+                if result.pk != object_pk:
+                    # another row matches now, so leave it to the next lookup
+                    return result
+
+        # And cache the result against the pk_key for next time.
+        fill_rows(cache, {pk_key: pack_row(result, timeout, time.monotonic() - start)}, timeout,
+                  replace=(pk_key,) if replace else ())
+
+        # If a lookup was used, then cache the pk against it. Next time
+        # the same lookup is requested, it will find the relevant pk and
+        # be able to get the cached object using that.
+        if lookup_key:
+            if recently_changed:
+                # If the objects is changed recently, there is a high possibility that slave db hasn't synced yet.
+                # So we only cache it for 60s instead of an hour to reduce the error.
+                # We only need to do this for lookup_key because pk_key cache was refreshed when the object
+                # is updated. By this way, it read from master db and ensured the value is up to date.
+                save_lookup_cache_key(self.model, object_pk, lookup_key, DELETED_CACHE_TIMEOUT)
+            else:
+                save_lookup_cache_key(self.model, object_pk, lookup_key, LOOKUP_CACHE_TIMEOUT)
 
         return result
+
+    def get_many(self, pks) -> dict:
+        """
+        Batched version of get() for primary key lookups. All the pk cache keys
+        are fetched with a single get_many(), any misses are then read from the
+        database in one pk__in query and added back where missing in one batch.
+
+        Returns a dict mapping each pk to its object, as in_bulk() does. Objects
+        that do not exist are left out, and are cached as such for models with
+        cache_for_does_not_exist set, following the same rules as get().
+
+        """
+
+        if not model_row_cache_enabled() or isinstance(getattr(self, 'core_filters', None), dict):
+            # Bypass the cache; related managers also filter on the related object.
+            return super(RowCacheManager, self).in_bulk(pks)
+
+        cache, timeout = get_model_cache()
+
+        if get_bloom_filter(self.model) is not None:
+            pks = [pk for pk in pks if not self._bloom_excludes('pk', pk=pk)]
+        keys = {model_cache_key(self.model, pk): pk for pk in pks}
+        if not keys:
+            return {}
+
+        results = {}
+        # Objects changed in a transaction not yet committed are read from the database
+        pending = {key for key in keys if is_pending(key)}
+        # fetched along with the rows, to know which of the missing ones have changed recently
+        deleted_keys = {model_cache_deleted_cache_key(self.model, pk): key for key, pk in keys.items()}
+        start = time.perf_counter()
+        cached = cache.get_many([key for key in keys if key not in pending] + list(deleted_keys))
+        cache_metrics.timed(self.model, 'pk', start)
+        recently_changed = {deleted_keys[key] for key in deleted_keys if cached.pop(key, False)}
+        stale = set()
+        for key, value in list(cached.items()):
+            value = unpack_row(value)[0]
+            if value is empty:
+                # cached with an older schema, so fetch it again
+                del cached[key]
+                stale.add(key)
+            # skip the misses we recorded
+            elif value is not None and value != OBJECT_DOES_NOT_EXIST:
+                results[value.pk] = value
+
+        missing = {key: pk for key, pk in keys.items() if key not in cached}
+        cache_metrics.count(self.model, 'pk', 'hits', len(results))
+        cache_metrics.count(self.model, 'pk', 'negative_hits', len(cached) - len(results))
+        cache_metrics.count(self.model, 'pk', 'misses', len(missing) - len(pending))
+        if missing:
+            cache_metrics.count(self.model, 'pk', 'db_fallbacks', len(missing))
+            # Fetch all the rows not in cache from the database in one query, from the default database
+            # if any changed within the replica lag
+            fetched = {}
+            start = time.monotonic()
+            primary = router.db_for_write(self.model)
+            queryset = self.get_queryset()
+            if recently_changed.intersection(missing):
+                queryset = queryset.using(primary)
+            for result in queryset.filter(pk__in=list(missing.values())):
+                fetched[model_cache_key(result, result.pk)] = result
+            if getattr(self.model, 'cache_for_does_not_exist', False) and queryset.db != primary \
+                    and len(fetched) < len(missing):
+                # those not found may be missing from the replica only
+                for result in queryset.using(primary).filter(
+                        pk__in=[pk for key, pk in missing.items() if key not in fetched]):
+                    fetched[model_cache_key(result, result.pk)] = result
+            for result in fetched.values():
+                results[result.pk] = result
+            fetched = {key: result for key, result in fetched.items()
+                       if key not in pending and not has_annotations(queryset)}
+            if fetched:
+                delta = time.monotonic() - start
+                fill_rows(cache, {key: pack_row(result, timeout, delta) for key, result in fetched.items()}, timeout,
+                          replace=stale)
+
+            if getattr(self.model, 'cache_for_does_not_exist', False):
+                does_not_exist = {key: OBJECT_DOES_NOT_EXIST for key in missing
+                                  if key not in fetched and key not in pending}
+                if does_not_exist:
+                    fill_rows(cache, does_not_exist, DOES_NOT_EXIST_CACHE_TIMEOUT)
+
+        return results
+
+    async def aget(self, *args, **kwargs):
+        """
+        Async version of get(). If the cache has an async client it is read
+        with that, and only a miss goes to the thread pool, to load the row
+        from the database through get(). Otherwise all of get() runs there, in
+        a single hop, rather than blocking the event loop on each cache read.
+        """
+        cache, timeout = get_model_cache()
+        if not model_row_cache_enabled() or args or not has_async_client(cache):
+            return await sync_to_async(self.get)(*args, **kwargs)
+
+        key, value = _only_item(kwargs)
+        identities, identity_lookup, result = self._from_identity_map(key, value, kwargs)
+        if result is not None:
+            return result
+
+        if await self._abloom_excludes('pk' if key in GET_ARGS_PK_KEY else 'lookup', **kwargs):
+            raise self.model.DoesNotExist
+
+        # the keys are made with it, so read it now if it's not held
+        await aget_model_generation(self.model)
+        start = time.perf_counter()
+        row = empty
+        if key in GET_ARGS_PK_KEY:
+            kind = 'pk'
+            object_pk = None
+            pk_key = model_cache_key(self.model, value)
+        else:
+            kind = 'lookup'
+            core_filters = getattr(self, 'core_filters', None)
+            lookup_kwargs = dict(core_filters, **kwargs) if isinstance(core_filters, dict) else kwargs
+            lookup_key = lookup_cache_key(self.model, **lookup_kwargs)
+            if lookup_key is None:
+                return await sync_to_async(self.get)(*args, **kwargs)
+            object_pk, row = await aget_lookup_cache_row(self.model, lookup_key)
+            pk_key = object_pk and object_pk != OBJECT_DOES_NOT_EXIST and model_cache_key(self.model, object_pk)
+
+        if object_pk == OBJECT_DOES_NOT_EXIST:
+            cache_metrics.count(self.model, kind, 'negative_hits')
+            raise self.model.DoesNotExist
+
+        if pk_key and not is_pending(pk_key):
+            if kind == 'pk':
+                row = await cache_aget(cache, pk_key)
+            result, expires, delta = unpack_row(None if row is empty else row)
+            cache_metrics.timed(self.model, kind, start)
+            if result == OBJECT_DOES_NOT_EXIST:
+                cache_metrics.count(self.model, kind, 'negative_hits')
+                raise self.model.DoesNotExist
+            if result and result is not empty and not refresh_early(expires, delta):
+                cache_metrics.count(self.model, kind, 'hits')
+                if identities is not None:
+                    result = identities.add(get_identifier(result, result.pk), result, lookup=identity_lookup)
+                return result
+
+        # misses are counted by get()
+        return await sync_to_async(self.get)(*args, **kwargs)
+
+    async def aget_many(self, pks) -> dict:
+        """
+        Async version of get_many(); rows missing from cache are loaded in the
+        thread pool, as all of them are if the cache has no async client.
+        """
+        cache, timeout = get_model_cache()
+        if (not model_row_cache_enabled() or isinstance(getattr(self, 'core_filters', None), dict)
+                or not has_async_client(cache)):
+            return await sync_to_async(self.get_many)(pks)
+
+        if get_bloom_filter(self.model) is not None:
+            pks = [pk for pk in pks if not await self._abloom_excludes('pk', pk=pk)]
+        await aget_model_generation(self.model)
+        keys = {model_cache_key(self.model, pk): pk for pk in pks}
+        if not keys:
+            return {}
+
+        results = {}
+        start = time.perf_counter()
+        cached = await cache_aget_many(cache, [key for key in keys if not is_pending(key)])
+        cache_metrics.timed(self.model, 'pk', start)
+        missing = []
+        for key, pk in keys.items():
+            value = unpack_row(cached[key])[0] if key in cached else empty
+            if value is empty:
+                missing.append(pk)
+            elif value is not None and value != OBJECT_DOES_NOT_EXIST:
+                results[value.pk] = value
+        # misses are counted by get_many()
+        cache_metrics.count(self.model, 'pk', 'hits', len(results))
+        cache_metrics.count(self.model, 'pk', 'negative_hits', len(keys) - len(missing) - len(results))
+
+        if missing:
+            results.update(await sync_to_async(self.get_many)(missing))
+        return results
+
+    def cached_related(self, *fields):
+        return self.get_queryset().cached_related(*fields)
+
+    def cached(self, timeout=None) -> list:
+        return self.get_queryset().cached(timeout)
+
+    def in_bulk(self, id_list=None, *, field_name='pk'):
+        """
+        Use the row cache for in_bulk() when given a list of primary keys.
+        """
+        if id_list is not None and field_name == 'pk':
+            return self.get_many(id_list)
+        return super(RowCacheManager, self).in_bulk(id_list, field_name=field_name)
+
+
+# RowCacheManager instances for models which don't have one
+_row_cache_managers = {}
+
+
+def row_cache_manager(model) -> RowCacheManager:
+    """
+    Return a RowCacheManager for reading rows of a model from the row cache.
+    For models which aren't CachedModel, one is made and the model's signals
+    connected, as LazyModelObject does.
+    """
+    # noinspection PyProtectedMember
+    manager = model._base_manager
+    if isinstance(manager, RowCacheManager):
+        return manager
+    try:
+        return _row_cache_managers[model]
+    except KeyError:
+        from .models import check_cache_signals
+        check_cache_signals(model)
+        manager = RowCacheManager()
+        manager.model = model
+        return _row_cache_managers.setdefault(model, manager)
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+IdentityMapMiddleware keeps an identity map of row cached objects for each request
+"""
+import asyncio
+
+from .utils.identitymap import identity_map
+
+
+class IdentityMapMiddleware:
+    """
+    Objects fetched more than once in a request, by RowCacheManager.get() or
+    LazyModelObject, are the same instance, returned from memory without
+    reading the cache again. Place it ahead of any middleware that fetches
+    cached objects. Runs as sync or async middleware; tasks started by an
+    async view share the request's map, as it is held in a context variable.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # mark the instance as a coroutine function, as MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        with identity_map():
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        with identity_map():
+            return await self.get_response(request)
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
-import json
+import logging
 
+from django.apps import apps
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
 from django.db.models.base import ModelBase
@@ -13,9 +15,11 @@ from django.db.models.signals import (
 )
 
 from .manager import RowCacheManager
-from .signals import removed_from_cache
-from .utils.lazymodel import get_model_cache, model_cache_key
-from .utils.modelutils import get_identifier_string, lookup_cache_master_key
+from .query import RowCacheQuerySet
+from .utils.bloom import get_bloom_filter
+from .utils.invalidation import row_cache_changes, write_through_enabled
+from .utils.lazymodel import get_model_cache, register_model_schema
+from .utils.modelutils import get_identifier_string
 
 DEFAULT_MANAGER_NAME = 'objects'
 BASE_MANAGER_NAME = '_related'
@@ -57,6 +61,11 @@ class MetaCaching(ModelBase):
                         manager.__class__.__bases__ = (RowCacheManager,) + manager.__class__.__bases__
                 except TypeError:
                     pass
+                # likewise make sure the manager's querysets invalidate on bulk writes
+                queryset_class = manager._queryset_class
+                if isinstance(manager, RowCacheManager) and not issubclass(queryset_class, RowCacheQuerySet):
+                    manager.__class__._queryset_class = type(queryset_class.__name__,
+                                                             (RowCacheQuerySet, queryset_class), {})
             if manager not in opts.local_managers:
                 opts.local_managers.append(manager)
             setattr(opts, attr_base, manager)
@@ -64,6 +73,9 @@ class MetaCaching(ModelBase):
 
         add_manager(default_manager_name or DEFAULT_MANAGER_NAME, 'default_manager')
         add_manager(base_manager_name or BASE_MANAGER_NAME, 'base_manager')
+        if not opts.abstract:
+            register_model_schema(new_class)
+            connect_cache_signals(new_class)
         return new_class
 
 
@@ -95,47 +107,126 @@ def create_reverse_many_to_one_manager(superclass, rel):
     return create_manager(original_create_reverse_many_to_one_manager, superclass, rel)
 
 
+def can_write_through(instance, signal, kwargs) -> bool:
+    """Whether a saved instance can be cached as is, rather than removed from cache."""
+    if signal is not post_save or not write_through_enabled():
+        return False
+    if kwargs.get('raw') or kwargs.get('update_fields') is not None or isinstance(instance, ContentType):
+        return False
+    if instance.get_deferred_fields():
+        return False
+    # fields updated with F() etc. hold expressions rather than values
+    # noinspection PyProtectedMember
+    return not any(hasattr(getattr(instance, field.attname, None), 'resolve_expression')
+                   for field in instance._meta.concrete_fields)
+
+
 # noinspection PyUnusedLocal
-def remove_object_from_cache(sender, instance, **kwargs):
+def remove_object_from_cache(sender, instance, signal=None, using=None, **kwargs):
+    """
+    Update the row cache for an object which was saved, deleted or had its
+    many-to-many relations changed. A saved instance is written through to
+    the cache, otherwise the row is removed; either way lookups for the object
+    are invalidated. Inside a transaction this is deferred until it commits.
+    """
 
-    model = instance.__class__
     instance_pk = instance.pk
+    changes = row_cache_changes(using)
+    if signal is m2m_changed:
+        changes.touch(sender)
 
-    if isinstance(instance, ContentType):
-        # The model cache key stuff has special handling to allow passing
-        # in a content type instead of the model. At this point though, we are
-        # actually working with the content type itself and not the model it
-        # represents. So we need to bypass that special handling code.
+    if signal is post_save and get_bloom_filter(instance) is not None:
+        changes.saved.append(instance)
 
-        instance = get_identifier_string(instance, instance.pk)
+    if can_write_through(instance, signal, kwargs):
+        changes.save(instance, get_model_cache()[1])
+    else:
+        if isinstance(instance, ContentType):
+            # The model cache key stuff has special handling to allow passing
+            # in a content type instead of the model. At this point though, we are
+            # actually working with the content type itself and not the model it
+            # represents. So we need to bypass that special handling code.
 
-    cache, timeout = get_model_cache()
+            instance = get_identifier_string(instance, instance.pk)
+        changes.remove(instance, instance_pk)
 
-    cache_key = model_cache_key(instance, instance_pk)
-    cache.delete(cache_key)
+    # Tell anyone else who may be interested that cache was cleaned of instance
+    changes.notify.append((sender, instance, dict(kwargs, using=using)))
 
-    try:
-        # reset cache with new data from master DB
-        model.objects.get(id=instance_pk)
-    except model.DoesNotExist:
-        pass
+    if not changes.deferred:
+        changes.apply()
 
-    # and remove lookup cache keys
-    master_key = lookup_cache_master_key(instance, instance_pk)
-    if master_key in cache:
-        list_lookup_cache_keys = json.loads(cache.get(master_key))
-        for key in list_lookup_cache_keys:
-            cache.delete(key)
-        cache.delete(master_key)
 
-    # Tell anyone else who may be interested that cache was cleaned of instance
-    removed_from_cache.send(sender=sender, instance=instance, **kwargs)
+# models whose changes are sent to remove_object_from_cache
+cache_senders = set()
 
 
-pre_delete.connect(remove_object_from_cache)
-post_delete.connect(remove_object_from_cache)
-post_save.connect(remove_object_from_cache)
-m2m_changed.connect(remove_object_from_cache)
+def connect_cache_signals(model):
+    """
+    Keep the row cache up to date when objects of a model are saved or deleted.
+    The signals are connected for each model, rather than for all senders, so
+    that writes to models which are never cached don't pay for invalidation.
+    """
+    if model in cache_senders:
+        return
+    cache_senders.add(model)
+    # noinspection PyProtectedMember
+    if model._meta.auto_created:
+        # the through model of a many-to-many relation, which is only changed through the relation
+        m2m_changed.connect(remove_object_from_cache, sender=model, weak=False,
+                            dispatch_uid=f'cachedmodel.{model._meta.label_lower}')
+        return
+    for signal in (pre_delete, post_delete, post_save):
+        signal.connect(remove_object_from_cache, sender=model, weak=False,
+                       dispatch_uid=f'cachedmodel.{model._meta.label_lower}')
+
+
+def connect_m2m_cache_signals():
+    """
+    Connect m2m_changed for the through models of many-to-many relations
+    to or from a cached model. Through models may be given by name, so this
+    is done once all models are loaded, from CachedModelAppConfig.ready().
+    """
+    for model in apps.get_models():
+        # noinspection PyProtectedMember
+        for field in model._meta.local_many_to_many:
+            if model in cache_senders or field.related_model in cache_senders:
+                through = field.remote_field.through
+                m2m_changed.connect(remove_object_from_cache, sender=through, weak=False,
+                                    dispatch_uid=f'cachedmodel.{through._meta.label_lower}')
+
+
+def connect_extra_cache_signals():
+    """
+    Connect, at startup, the models besides row cached models whose rows may
+    be cached by any process: those listed in MODEL_ROW_CACHE_SENDERS, such as
+    models cached by LazyModelObject, those with a CachedGetManager, and those
+    row cached models refer to, which cached_related() resolves from cache.
+    """
+    from .manager import CachedGetManager
+    for label in getattr(settings, 'MODEL_ROW_CACHE_SENDERS', ()):
+        connect_cache_signals(apps.get_model(label))
+    for model in apps.get_models():
+        # noinspection PyProtectedMember
+        opts = model._meta
+        if any(isinstance(manager, CachedGetManager) for manager in opts.managers):
+            connect_cache_signals(opts.concrete_model)
+        if issubclass(model, CachedModel):
+            for field in opts.concrete_fields:
+                if field.is_relation and (field.many_to_one or field.one_to_one):
+                    connect_cache_signals(field.related_model._meta.concrete_model)
+
+
+def check_cache_signals(model):
+    """
+    Connect a model cached without having been connected at startup, so this
+    process sees its changes. Others writing to it don't, so warn once.
+    """
+    if model not in cache_senders:
+        logging.warning(f'{model._meta.label} was cached without its changes being followed from startup; '
+                        f'list it in MODEL_ROW_CACHE_SENDERS')
+        connect_cache_signals(model)
+
 
 related_descriptors.create_forward_many_to_many_manager = create_forward_many_to_many_manager
 related_descriptors.create_reverse_many_to_one_manager = create_reverse_many_to_one_manager
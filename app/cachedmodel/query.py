@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import time
+
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist, FieldError
+from django.db import connections, models, router, transaction
+
+from .utils.bloom import get_bloom_filter
+from .utils.invalidation import has_pending_changes, remove_pks_from_cache
+from .utils.lazymodel import copy_for_cache, fill_rows, get_model_cache, model_cache_key, pack_row
+from .utils.metrics import cache_metrics
+from .utils.modelutils import (
+    get_model_by_table,
+    get_model_generation,
+    get_model_label,
+    get_model_writes,
+    model_row_cache_enabled,
+)
+
+QUERY_CACHE_TIMEOUT = 60 * 60
+
+__all__ = (
+    'RowCacheQuerySet',
+    'has_annotations',
+)
+
+
+def has_annotations(queryset) -> bool:
+    """Whether the results carry values besides their fields, so mustn't be cached as rows."""
+    return bool(queryset.query.annotations or queryset.query.extra)
+
+
+class RowCacheQuerySet(models.QuerySet):
+    """
+    QuerySet for row cached models.
+
+    The bulk write methods do not send the model signals that normally keep
+    the row cache up to date, so these collect the primary keys of the rows
+    they change and remove them from cache in one batch instead, once the
+    transaction commits.
+
+    cached_related() resolves foreign keys of the results from the row cache
+    in batches, and cached() caches the pks of the results.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(RowCacheQuerySet, self).__init__(*args, **kwargs)
+        self._cached_related = ()
+
+    def _clone(self):
+        clone = super(RowCacheQuerySet, self)._clone()
+        clone._cached_related = self._cached_related
+        return clone
+
+    def cached_related(self, *fields):
+        """
+        Resolve the given foreign keys of all the results together once they are
+        fetched: the related objects are read from the row cache with a single
+        get_many(), and those missing from it with one pk__in query, then set on
+        the results as select_related() would. Unlike select_related(), related
+        objects are shared by all the results which refer to them.
+
+        Pass None to clear the list. Only forward foreign keys and one-to-one
+        fields are supported, and not when using iterator().
+        """
+        clone = self._chain()
+        if fields == (None,):
+            clone._cached_related = ()
+            return clone
+        # noinspection PyProtectedMember
+        opts = self.model._meta
+        for name in fields:
+            try:
+                field = opts.get_field(name)
+            except FieldDoesNotExist:
+                raise FieldError(f"Invalid field name '{name}' given in cached_related()")
+            if not (field.concrete and (field.many_to_one or field.one_to_one)):
+                raise FieldError(f"'{name}' given in cached_related() is not a foreign key")
+        clone._cached_related = tuple(dict.fromkeys(self._cached_related + fields))
+        return clone
+
+    def _fetch_all(self):
+        fetched = self._result_cache is not None
+        super(RowCacheQuerySet, self)._fetch_all()
+        if self._cached_related and not fetched and issubclass(self._iterable_class, models.query.ModelIterable):
+            self._resolve_cached_related(self._result_cache)
+
+    def _resolve_cached_related(self, objs):
+        from .manager import row_cache_manager
+        # noinspection PyProtectedMember
+        opts = self.model._meta
+        for name in self._cached_related:
+            field = opts.get_field(name)
+            pending = [obj for obj in objs
+                       if getattr(obj, field.attname) is not None and not field.is_cached(obj)]
+            if not pending:
+                continue
+            # foreign keys may refer to fields other than the pk, which the row cache isn't keyed on
+            if field.target_field.primary_key:
+                related = row_cache_manager(field.related_model).get_many(
+                    {getattr(obj, field.attname) for obj in pending})
+            else:
+                related = field.related_model._base_manager.in_bulk(
+                    {getattr(obj, field.attname) for obj in pending}, field_name=field.target_field.name)
+            for obj in pending:
+                value = related.get(getattr(obj, field.attname))
+                if value is not None:
+                    field.set_cached_value(obj, value)
+
+    def cached(self, timeout=None) -> list:
+        """
+        Evaluate the queryset, caching the pks of the results, and return them
+        as a list. Next time the pks are read from cache, and the rows from the
+        row cache with get_many(), so only rows missing from it are queried.
+
+        The pks are cached under a key made from the SQL of the query, and the
+        write generation of the model and each model joined by the query, which
+        moves on when any of their rows are changed; models in subqueries are
+        not followed. Querysets of values(), deferred fields, annotations or raw
+        SQL are evaluated as usual, as are those in a transaction with uncommitted
+        changes. Rows are returned without select_related() objects, which are
+        instead read when used, as are prefetch_related() and cached_related().
+        Queries not in cache are run on the default database unless using() another.
+        """
+        if self._result_cache is not None:
+            return self._result_cache
+        if (not model_row_cache_enabled() or not issubclass(self._iterable_class, models.query.ModelIterable)
+                or self.query.deferred_loading != (frozenset(), True) or has_annotations(self)
+                or has_pending_changes()):
+            return list(self)
+
+        from .manager import row_cache_manager
+        from .models import check_cache_signals
+        # queries not in cache are run on the default database rather than a replica,
+        # which may not have caught up with the writes the key is made from
+        db = self._db or router.db_for_write(self.model)
+        try:
+            sql, params = self.query.get_compiler(using=db).as_sql()
+        except EmptyResultSet:
+            return []
+        labels = set()
+        for alias in self.query.alias_map.values():
+            model = get_model_by_table(alias.table_name)
+            if model is None:
+                # raw SQL, or a table no model is known for
+                return list(self)
+            # changes to it must be followed
+            check_cache_signals(model)
+            labels.add(get_model_label(model))
+        writes = get_model_writes(labels)
+        digest = hashlib.blake2b(repr((db, sql, params, sorted(writes.items()))).encode(),
+                                 digest_size=20).hexdigest()
+        key = f'ModelCacheQuery:{get_model_generation(self.model)}:{get_model_label(self.model)}.{digest}'
+
+        cache, row_timeout = get_model_cache()
+        start = time.perf_counter()
+        pks = cache.get(key)
+        cache_metrics.timed(self.model, 'query', start)
+        cache_metrics.count(self.model, 'query', 'misses' if pks is None else 'hits')
+        if pks is None:
+            cache_metrics.count(self.model, 'query', 'db_fallbacks')
+            start = time.monotonic()
+            self._db = db
+            self._fetch_all()
+            delta = time.monotonic() - start
+            cache.set(key, [obj.pk for obj in self._result_cache], timeout=timeout or QUERY_CACHE_TIMEOUT)
+            # and the rows, for the next time
+            rows = {model_cache_key(obj, obj.pk): obj for obj in self._result_cache}
+            if rows:
+                fill_rows(cache, {row_key: pack_row(copy_for_cache(obj), row_timeout, delta)
+                                  for row_key, obj in rows.items()}, row_timeout)
+            return self._result_cache
+
+        rows = row_cache_manager(self.model).get_many(pks)
+        # rows deleted since are left out
+        self._result_cache = [rows[pk] for pk in pks if pk in rows]
+        if self._prefetch_related_lookups:
+            models.prefetch_related_objects(self._result_cache, *self._prefetch_related_lookups)
+        if self._cached_related:
+            self._resolve_cached_related(self._result_cache)
+        return self._result_cache
+
+    def _affected_pks(self) -> list:
+        queryset = self.order_by()
+        query = self.query
+        # rows of distinct or grouped results can't be locked
+        if query.distinct or query.group_by is not None or any(
+                getattr(annotation, 'contains_aggregate', False) for annotation in query.annotations.values()):
+            return list(queryset.values_list('pk', flat=True))
+        # locked until the write, so other transactions can't change which rows match meanwhile; only this
+        # model's table, as the nullable side of an outer join can't be locked
+        of = ('self',) if connections[self.db].features.has_select_for_update_of else ()
+        return list(queryset.select_for_update(of=of).values_list('pk', flat=True))
+
+    def _changes_bloom_fields(self, names) -> bool:
+        """Whether updating these fields may add values the model's Bloom filter can't follow."""
+        bloom = get_bloom_filter(self.model)
+        if bloom is None:
+            return False
+        # noinspection PyProtectedMember
+        return any(self.model._meta.get_field(name).attname in bloom.fields for name in names)
+
+    def update(self, **kwargs):
+        if not model_row_cache_enabled():
+            return super(RowCacheQuerySet, self).update(**kwargs)
+        # the database written to, rather than a replica; the changes are applied when its transaction commits
+        self._for_write = True
+        with transaction.atomic(using=self.db, savepoint=False):
+            pks = self._affected_pks()
+            rows = super(RowCacheQuerySet, self).update(**kwargs)
+            remove_pks_from_cache(self.model, pks, using=self.db, reset_bloom=self._changes_bloom_fields(kwargs))
+        return rows
+    update.alters_data = True
+
+    def delete(self):
+        if not model_row_cache_enabled():
+            return super(RowCacheQuerySet, self).delete()
+        self._for_write = True
+        with transaction.atomic(using=self.db, savepoint=False):
+            pks = self._affected_pks()
+            result = super(RowCacheQuerySet, self).delete()
+            remove_pks_from_cache(self.model, pks, using=self.db)
+        return result
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = super(RowCacheQuerySet, self).bulk_create(objs, *args, **kwargs)
+        if model_row_cache_enabled():
+            # clears any misses cached for these pks
+            created = [obj for obj in objs if obj.pk is not None]
+            remove_pks_from_cache(self.model, [obj.pk for obj in created], using=self.db, saved=created,
+                                  reset_bloom=len(created) < len(objs) and get_bloom_filter(self.model) is not None)
+        return objs
+
+    def bulk_update(self, objs, fields, batch_size=None):
+        objs = tuple(objs)
+        result = super(RowCacheQuerySet, self).bulk_update(objs, fields, batch_size=batch_size)
+        if model_row_cache_enabled():
+            remove_pks_from_cache(self.model, [obj.pk for obj in objs], using=self.db, saved=objs)
+        return result
+    bulk_update.alters_data = True
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for testing code which uses the row cache.
+
+    with CountingCache() as counter:
+        Icon.objects.get(pk=1)
+    assert counter.round_trips == 1
+
+"""
+import threading
+from collections import Counter
+
+from django.core.cache import caches
+
+from .utils.lazymodel import get_model_cache
+
+__all__ = (
+    'CountingCache',
+)
+
+
+class CountingCache:
+    """
+    Counts the calls made to a cache backend, each of which would be a round
+    trip to a shared cache such as Redis or memcached. While in use, the
+    backend's methods are wrapped on the instance, so every user of the cache
+    is counted; calls one method makes to another, as BaseCache.get_many()
+    does to get(), are counted once. Reads served by the in-process tier of
+    MODEL_ROW_CACHE_LOCAL never reach the backend, and are not counted.
+
+    Defaults to the row cache backend. Connections are per thread, so only
+    calls made in the thread which enters it are counted.
+
+    """
+
+    METHODS = (
+        'add', 'clear', 'decr', 'delete', 'delete_many', 'get', 'get_many', 'get_or_set',
+        'has_key', 'incr', 'set', 'set_many', 'touch',
+    )
+
+    def __init__(self, alias=None):
+        get_model_cache()
+        self.alias = alias or get_model_cache.cache
+        self.calls = Counter()
+        self.keys = Counter()
+        self._local = threading.local()
+        self._cache = None
+
+    @property
+    def round_trips(self) -> int:
+        return sum(self.calls.values())
+
+    def reset(self):
+        self.calls.clear()
+        self.keys.clear()
+
+    def _wrap(self, name, method):
+        def counted(*args, **kwargs):
+            depth = getattr(self._local, 'depth', 0)
+            if not depth:
+                self.calls[name] += 1
+                if args:
+                    # the keys, or for set_many() a dict of them
+                    self.keys[name] += len(args[0]) if name.endswith('_many') else 1
+            self._local.depth = depth + 1
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self._local.depth = depth
+        return counted
+
+    def __enter__(self):
+        self._cache = caches[self.alias]
+        for name in self.METHODS:
+            method = getattr(self._cache, name, None)
+            if method is not None:
+                setattr(self._cache, name, self._wrap(name, method))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for name in self.METHODS:
+            self._cache.__dict__.pop(name, None)
+        self._cache = None
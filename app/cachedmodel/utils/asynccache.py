@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from asgiref.sync import sync_to_async
+from django.core.cache import BaseCache
+
+__all__ = (
+    'cache_aget',
+    'cache_aget_many',
+    'has_async_client',
+)
+
+
+def _native_async(cache, name):
+    """
+    Return the cache's own async method, if it has one. Django's default
+    async cache methods, where present, just run the sync ones in a thread.
+    """
+    # look on the class, so that wrappers passing attributes through aren't bypassed
+    method = getattr(type(cache), name, None)
+    if method is None or method is getattr(BaseCache, name, None):
+        return None
+    return getattr(cache, name)
+
+
+def has_async_client(cache) -> bool:
+    """Whether the cache can be read without blocking the event loop."""
+    return _native_async(cache, 'aget') is not None and _native_async(cache, 'aget_many') is not None
+
+
+async def cache_aget(cache, key, default=None):
+    """
+    Read a key using the cache's async client if there is one, otherwise the
+    sync client in a thread, so that the event loop isn't blocked.
+    """
+    method = _native_async(cache, 'aget')
+    if method is not None:
+        return await method(key, default)
+    return await sync_to_async(cache.get, thread_sensitive=False)(key, default)
+
+
+async def cache_aget_many(cache, keys) -> dict:
+    method = _native_async(cache, 'aget_many')
+    if method is not None:
+        return await method(keys)
+    return await sync_to_async(cache.get_many, thread_sensitive=False)(keys)
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+import functools
+import hashlib
+import logging
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, connections, router
+
+from .modelutils import _new_namespace_version, get_model_label, model_generation_ttl, GET_ARGS_PK_KEY
+
+__all__ = (
+    'BloomFilter',
+    'ModelBloomFilter',
+    'get_bloom_filter',
+    'reset_bloom_filter',
+)
+
+
+FALSE_POSITIVE_RATE = 0.01
+MIN_BITS = 1024
+# seconds to wait before trying again when a filter could not be built
+RETRY_BUILD = 60
+# additions published since a filter was last synced beyond which it is rebuilt instead
+MAX_ADDITIONS = 1000
+# fields whose to_python() gives the same value as is read from the database
+FIELD_TYPES = (
+    'AutoField', 'BigAutoField', 'SmallAutoField',
+    'IntegerField', 'BigIntegerField', 'SmallIntegerField',
+    'PositiveIntegerField', 'PositiveBigIntegerField', 'PositiveSmallIntegerField',
+    'CharField', 'SlugField', 'TextField', 'UUIDField',
+)
+
+
+@functools.cache
+def bloom_rebuild_interval() -> float:
+    return float(getattr(settings, 'MODEL_ROW_CACHE_BLOOM_REBUILD', 60 * 60))
+
+
+class BloomFilter:
+    """
+    A fixed size Bloom filter of strings. Sized for twice the given capacity,
+    to leave room for rows added before it is next rebuilt.
+    """
+
+    def __init__(self, capacity: int):
+        bits = -2 * max(capacity, 1) * math.log(FALSE_POSITIVE_RATE) / math.log(2) ** 2
+        self.size = max(MIN_BITS, int(bits))
+        self.hashes = max(1, min(10, round(self.size / (2 * max(capacity, 1)) * math.log(2))))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class ModelBloomFilter:
+    """
+    A per-process Bloom filter of the pks and unique field values of a model,
+    for models with cache_bloom_filter set. A lookup on one of those fields for
+    a value not in the filter is certain to find nothing, so can be answered
+    without reading the cache or database.
+
+    The filter is built from the database in a background thread, and rebuilt
+    every MODEL_ROW_CACHE_BLOOM_REBUILD seconds to drop deleted rows. Values
+    saved in any process are published through the shared cache on commit: each
+    is numbered with an epoch counter, and the other processes pick up the new
+    ones when they next check the counter, which they do at most once every
+    MODEL_ROW_CACHE_GENERATION_TTL seconds. Until a filter has been built, or
+    if it may have missed any values, lookups are not checked against it.
+
+    """
+
+    def __init__(self, model):
+        self.model = model
+        label = get_model_label(model)
+        self.epoch_key = f'CachedModelBloomEpoch:{label}'
+        self.additions_key = f'CachedModelBloomAdd:{label}:'
+        # noinspection PyProtectedMember
+        self.fields = {field.attname: field for field in model._meta.concrete_fields
+                       if field.unique and field.get_internal_type() in FIELD_TYPES}
+        self._lock = threading.Lock()
+        self._filter = None
+        self._epoch = None
+        self._next_build = self._next_sync = 0.0
+        self._building = False
+
+    @staticmethod
+    def _cache():
+        from .lazymodel import get_model_cache
+        return get_model_cache()[0]
+
+    def _item(self, attname, value) -> str:
+        return f'{attname}={value!r}'
+
+    def items(self, instance) -> list:
+        return [self._item(attname, getattr(instance, attname)) for attname in self.fields]
+
+    def _lookup_item(self, kwargs):
+        """The filter item for a single field lookup, or None if it can't be checked."""
+        if len(kwargs) != 1:
+            return None
+        for key, value in kwargs.items():
+            name = key[:-len('__exact')] if key.endswith('__exact') else key
+            if key in GET_ARGS_PK_KEY:
+                # noinspection PyProtectedMember
+                name = self.model._meta.pk.attname
+            field = self.fields.get(name) or self.fields.get(f'{name}_id')
+            if field is None or value is None:
+                return None
+            try:
+                return self._item(field.attname, field.to_python(value))
+            except (ValidationError, TypeError, ValueError):
+                return None
+
+    def may_exist(self, **kwargs) -> bool:
+        """False if a get() with these arguments is certain not to find anything."""
+        item = self._lookup_item(kwargs)
+        if item is None:
+            return True
+        bloom = self._current()
+        return bloom is None or item in bloom
+
+    def sync_due(self) -> bool:
+        """Whether the next lookup reads the cache, to add the values published by other processes."""
+        return self._filter is not None and time.monotonic() > self._next_sync
+
+    def _current(self):
+        now = time.monotonic()
+        if not self._building and now >= self._next_build:
+            self.rebuild(background=True)
+        if self._filter is not None and now > self._next_sync:
+            self._sync()
+        return self._filter
+
+    def _get_epoch(self, cache):
+        epoch = cache.get(self.epoch_key)
+        if epoch is None:
+            cache.add(self.epoch_key, _new_namespace_version(), timeout=None)
+            epoch = cache.get(self.epoch_key)
+        return epoch
+
+    def _sync(self):
+        """Add the values published by other processes since the last sync."""
+        with self._lock:
+            if self._filter is None:
+                return
+            self._next_sync = time.monotonic() + model_generation_ttl()
+            cache = self._cache()
+            epoch = cache.get(self.epoch_key)
+            if epoch == self._epoch:
+                return
+            if epoch is None or self._epoch is None or not 0 < epoch - self._epoch <= MAX_ADDITIONS:
+                # the counter was lost, or too much has changed
+                self._filter, self._next_build = None, 0.0
+                return
+            keys = [f'{self.additions_key}{n}' for n in range(self._epoch + 1, epoch + 1)]
+            additions = cache.get_many(keys)
+            if len(additions) < len(keys) or any(items is None for items in additions.values()):
+                # some are missing, or a reset was published
+                self._filter, self._next_build = None, 0.0
+                return
+            for items in additions.values():
+                for item in items:
+                    self._filter.add(item)
+            self._epoch = epoch
+
+    def rebuild(self, background=False):
+        """Build a new filter from the database, while the current one carries on being used."""
+        with self._lock:
+            if self._building:
+                return
+            self._building = True
+        if background:
+            threading.Thread(target=self._rebuild, name=f'bloom-{self.epoch_key}', daemon=True).start()
+        else:
+            self._rebuild()
+
+    def _rebuild(self):
+        # from the primary, as rows a replica hasn't caught up with yet would be rejected
+        using = router.db_for_write(self.model)
+        try:
+            epoch = self._get_epoch(self._cache())
+            queryset = self.model._base_manager.using(using).values_list(*self.fields)
+            bloom = BloomFilter(queryset.count() * len(self.fields))
+            for values in queryset.iterator(chunk_size=2000):
+                for attname, value in zip(self.fields, values):
+                    bloom.add(self._item(attname, value))
+            with self._lock:
+                self._filter, self._epoch = bloom, epoch
+                self._next_build = time.monotonic() + bloom_rebuild_interval()
+                self._next_sync = 0.0
+        except DatabaseError:
+            logging.exception(f'Could not build the Bloom filter for {self.model._meta.label}')
+            self._next_build = time.monotonic() + RETRY_BUILD
+        finally:
+            self._building = False
+            if threading.current_thread() is not threading.main_thread():
+                connections[using].close()
+
+    def publish(self, instances):
+        """Add saved objects to the filter here, and in other processes."""
+        items = [item for instance in instances for item in self.items(instance)]
+        if not items:
+            return
+        with self._lock:
+            if self._filter is not None:
+                for item in items:
+                    self._filter.add(item)
+        self._publish(items)
+
+    def reset(self):
+        """Stop using the filter in all processes until it is rebuilt, after changes that weren't published."""
+        with self._lock:
+            self._filter, self._next_build = None, 0.0
+        self._publish(None)
+
+    def _publish(self, items):
+        cache = self._cache()
+        self._get_epoch(cache)
+        try:
+            epoch = cache.incr(self.epoch_key)
+        except ValueError:
+            # evicted, so the other processes will rebuild
+            return
+        cache.set(f'{self.additions_key}{epoch}', items, timeout=bloom_rebuild_interval() * 2)
+        with self._lock:
+            if self._epoch == epoch - 1 and items is not None:
+                # nothing was missed, so no need to fetch this back
+                self._epoch = epoch
+
+
+_bloom_filters = {}
+_bloom_filters_lock = threading.Lock()
+
+
+def get_bloom_filter(model):
+    """The Bloom filter of a model, or None if it doesn't have one."""
+    model = model._meta.concrete_model
+    try:
+        return _bloom_filters[model]
+    except KeyError:
+        pass
+    bloom = None
+    if getattr(model, 'cache_bloom_filter', False):
+        bloom = ModelBloomFilter(model)
+        if not bloom.fields:
+            logging.warning(f'{model._meta.label} has no fields a Bloom filter can be used with')
+            bloom = None
+    with _bloom_filters_lock:
+        return _bloom_filters.setdefault(model, bloom)
+
+
+def reset_bloom_filter(model):
+    """Use after changing rows of a model by means other than the ORM, e.g. raw SQL."""
+    bloom = get_bloom_filter(model)
+    if bloom is not None:
+        bloom.reset()
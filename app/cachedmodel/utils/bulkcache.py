@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django_redis.cache import RedisCache
+from django_redis.client import DefaultClient, ShardClient
+from django_redis.exceptions import ConnectionInterrupted
+from redis.exceptions import ConnectionError, ResponseError, TimeoutError
+
+__all__ = (
+    'cache_add_many',
+)
+
+
+def _redis_client(cache):
+    """Return the django-redis client of a cache whose keys all live on one server, if it is one."""
+    if not isinstance(cache, RedisCache):
+        return None
+    client = cache.client
+    # sharded keys can't share a pipeline
+    if not isinstance(client, DefaultClient) or isinstance(client, ShardClient):
+        return None
+    return client
+
+
+def cache_add_many(cache, data: dict, timeout=DEFAULT_TIMEOUT, version=None) -> list:
+    """
+    Add each value where its key is missing, returning the keys that weren't,
+    in one round trip where the backend allows. Django's cache API only adds
+    one key at a time, so for Redis the SET NX commands are sent in a single
+    pipeline. Other backends add each key in turn, which for in-process caches
+    such as LocMemCache costs no round trips.
+    """
+    if not data:
+        return []
+    add_many = getattr(cache, 'add_many', None)
+    if add_many is not None:
+        return add_many(data, timeout=timeout, version=version)
+    client = _redis_client(cache)
+    if client is None or (timeout is not None and timeout is not DEFAULT_TIMEOUT and timeout <= 0):
+        return [key for key, value in data.items() if not cache.add(key, value, timeout=timeout, version=version)]
+    pipeline = client.get_client(write=True).pipeline()
+    for key, value in data.items():
+        client.set(key, value, timeout=timeout, version=version, client=pipeline, nx=True)
+    try:
+        added = pipeline.execute()
+    except (ConnectionError, ResponseError, TimeoutError) as e:
+        raise ConnectionInterrupted(connection=pipeline) from e
+    return [key for key, result in zip(data, added) if not result]
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Keep the objects fetched through the row cache during a request, so that
+fetching one again returns the same instance without reading the cache.
+
+    with identity_map():
+        icon = Icon.objects.get(pk=1)
+        assert Icon.objects.get(pk=1) is icon
+
+"""
+import contextlib
+import contextvars
+
+__all__ = (
+    'IdentityMap',
+    'current_identity_map',
+    'discard_identities',
+    'identity_map',
+)
+
+
+_identity_map = contextvars.ContextVar('cachedmodel_identity_map', default=None)
+
+
+class IdentityMap:
+    """
+    Objects by identifier, and the identifiers found by get() lookups, for
+    the current request or task. Objects changed in it are dropped once the
+    change is applied to the row cache, but changes made by other processes
+    are not seen until the next request.
+
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.lookups = {}
+        self.hits = 0
+
+    def __len__(self):
+        return len(self.objects)
+
+    def get(self, identifier):
+        instance = self.objects.get(identifier)
+        if instance is not None:
+            self.hits += 1
+        return instance
+
+    def get_lookup(self, lookup):
+        identifier = self.lookups.get(lookup)
+        return None if identifier is None else self.get(identifier)
+
+    def add(self, identifier, instance, lookup=None):
+        """Keep an object, returning the instance already kept if it was fetched another way."""
+        if not identifier or instance is None:
+            return instance
+        instance = self.objects.setdefault(identifier, instance)
+        if lookup is not None:
+            self.lookups[lookup] = identifier
+        return instance
+
+    def discard(self, identifiers):
+        identifiers = set(identifiers)
+        for identifier in identifiers:
+            self.objects.pop(identifier, None)
+        # the lookups may find another object now
+        for lookup, identifier in list(self.lookups.items()):
+            if identifier in identifiers:
+                del self.lookups[lookup]
+
+    def clear(self):
+        self.objects.clear()
+        self.lookups.clear()
+
+
+def current_identity_map():
+    """The identity map of this request or task, or None outside identity_map()."""
+    return _identity_map.get()
+
+
+@contextlib.contextmanager
+def identity_map():
+    """Keep an identity map for the code run inside, e.g. a request, task or management command."""
+    token = _identity_map.set(IdentityMap())
+    try:
+        yield _identity_map.get()
+    finally:
+        _identity_map.reset(token)
+
+
+def discard_identities(identifiers):
+    """Drop changed objects from the identity map of this context."""
+    current = _identity_map.get()
+    if current is not None and identifiers:
+        current.discard(identifiers)
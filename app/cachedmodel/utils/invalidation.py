@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+import functools
+import threading
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from .bloom import get_bloom_filter
+from .identitymap import discard_identities
+from .lazymodel import copy_for_cache, get_model_cache, model_cache_keys, pack_row
+from .metrics import cache_metrics
+from .modelutils import (
+    bump_model_writes,
+    get_concrete_label,
+    get_identifier,
+    get_model_generation,
+    get_model_label,
+    lookup_namespace_key,
+    model_cache_deleted_cache_key,
+    replica_lag,
+)
+from .singleflight import cache_fills
+
+__all__ = (
+    'RowCacheChanges',
+    'has_pending_changes',
+    'is_pending',
+    'remove_pks_from_cache',
+    'row_cache_changes',
+    'write_through_enabled',
+)
+
+
+_local = threading.local()
+
+
+@functools.cache
+def write_through_enabled() -> bool:
+    return bool(getattr(settings, 'MODEL_ROW_CACHE_WRITE_THROUGH', True))
+
+
+class RowCacheChanges:
+    """
+    Row cache updates collected during one transaction, applied when it
+    commits with a single delete_many() and set_many().
+
+    Until then the rows are pending: readers in this thread bypass the cache
+    for them so they see their own writes, and nothing read inside the
+    transaction is written to cache. If the transaction is rolled back the
+    changes are discarded along with the on_commit() callback.
+
+    Once applied, each changed object is marked as recently changed for
+    DATABASE_REPLICA_LAG seconds, and rows loaded into the cache meanwhile are
+    read from the default database rather than from a replica.
+
+    """
+
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.using = using
+        self.rows = {}          # current row key -> packed row, or None to delete it
+        self.deletes = set()    # previous generation row keys and lookup namespaces
+        self.changed = set()    # identifiers of the objects changed
+        self.written = set()    # labels of the models changed, whose cached query results are invalidated
+        self.notify = []        # removed_from_cache signals to send
+        self.saved = []         # saved objects to add to Bloom filters
+        self.bloom_resets = set()   # models whose Bloom filters may have missed changes
+        self.deferred = False   # applied on commit, rather than by the caller
+        self._generations = {}
+
+    def _keys(self, instance, pk) -> list:
+        identifier = get_identifier(instance, pk)
+        label = get_model_label(identifier)
+        if label not in self._generations:
+            self._generations[label] = get_model_generation(label, fresh=True)
+            self.written.add(get_concrete_label(label))
+        keys = model_cache_keys(identifier, generation=self._generations[label])
+        self.changed.add(identifier)
+        self.deletes.update(keys[1:])
+        self.deletes.add(lookup_namespace_key(identifier))
+        return keys
+
+    def remove(self, instance, pk=None):
+        """Remove an object's row, and invalidate its lookups."""
+        self.rows[self._keys(instance, pk)[0]] = None
+
+    def save(self, instance, timeout):
+        """Replace an object's row with the instance, and invalidate its lookups."""
+        if any(connections[self.using].savepoint_ids):
+            # the savepoint may yet be rolled back, leaving the transaction to commit without it
+            return self.remove(instance, instance.pk)
+        instance = copy_for_cache(instance)
+        self.rows[self._keys(instance, instance.pk)[0]] = pack_row(instance, timeout)
+
+    def touch(self, model):
+        """Invalidate the query results cached for a model, e.g. the through model of a changed relation."""
+        self.written.add(get_concrete_label(get_model_label(model)))
+
+    def is_registered(self) -> bool:
+        """Whether this is still due to be applied on commit."""
+        return any(entry[1] == self.apply for entry in connections[self.using].run_on_commit)
+
+    def apply(self):
+        changes = getattr(_local, 'changes', {})
+        if changes.get(self.using) is self:
+            del changes[self.using]
+
+        for key in self.rows:
+            # row keys end with the object's identifier
+            cache_metrics.count(key.rsplit(':', 1)[-1], 'pk', 'invalidations')
+
+        cache, timeout = get_model_cache()
+        sets = {key: row for key, row in self.rows.items() if row is not None}
+        deletes = self.deletes.union(key for key, row in self.rows.items() if row is None)
+        # marked first, so that fills which read the rows before they changed don't replace them
+        if self.changed and replica_lag() > 0:
+            cache.set_many({model_cache_deleted_cache_key(identifier): True for identifier in self.changed},
+                           timeout=replica_lag())
+        if deletes:
+            cache.delete_many(list(deletes))
+        if sets:
+            cache.set_many(sets, timeout=timeout)
+        cache_fills.forget()
+        if self.written:
+            bump_model_writes(self.written)
+        discard_identities(self.changed)
+
+        blooms = {}
+        for instance in self.saved:
+            blooms.setdefault(get_bloom_filter(instance), []).append(instance)
+        for bloom, instances in blooms.items():
+            if bloom is not None:
+                bloom.publish(instances)
+        for model in self.bloom_resets:
+            bloom = get_bloom_filter(model)
+            if bloom is not None:
+                bloom.reset()
+
+        from ..signals import removed_from_cache
+        for sender, instance, kwargs in self.notify:
+            removed_from_cache.send(sender=sender, instance=instance, **kwargs)
+
+
+def row_cache_changes(using=None) -> RowCacheChanges:
+    """
+    Return the changes being collected for the current transaction on a
+    database. Outside a transaction they are not deferred, and the caller
+    should apply() them at once.
+    """
+    using = using or DEFAULT_DB_ALIAS
+    connection = connections[using]
+    if not connection.in_atomic_block:
+        return RowCacheChanges(using)
+
+    if not hasattr(_local, 'changes'):
+        _local.changes = {}
+    changes = _local.changes.get(using)
+    if changes is None or not changes.is_registered():
+        # none yet, or those collected were rolled back
+        changes = _local.changes[using] = RowCacheChanges(using)
+        changes.deferred = True
+        connection.on_commit(changes.apply)
+    return changes
+
+
+def is_pending(key) -> bool:
+    """Whether a row key has uncommitted changes in this thread."""
+    changes = getattr(_local, 'changes', None)
+    if not changes:
+        return False
+    for pending in list(changes.values()):
+        if key in pending.rows:
+            if pending.is_registered():
+                return True
+            # rolled back
+            del changes[pending.using]
+    return False
+
+
+def has_pending_changes() -> bool:
+    """Whether this thread has changed any rows in a transaction not yet committed."""
+    changes = getattr(_local, 'changes', None)
+    return bool(changes) and any(pending.rows and pending.is_registered() for pending in list(changes.values()))
+
+
+def remove_pks_from_cache(model, pks, using=None, saved=(), reset_bloom=False):
+    """
+    Remove the cached rows of several objects of a model, and invalidate their
+    lookups, with a single delete_many() once the transaction commits.
+    Objects created are added to the model's Bloom filter, if it has one, or
+    the filter is reset if the change can't be followed.
+    """
+    pks = list(pks)
+    if not pks:
+        return
+    changes = row_cache_changes(using)
+    for pk in pks:
+        changes.remove(model, pk)
+    changes.saved.extend(saved)
+    if reset_bloom:
+        changes.bloom_resets.add(model)
+    if not changes.deferred:
+        changes.apply()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import datetime
+import decimal
+import hashlib
+import uuid
+
+from django.db import models
+
+__all__ = (
+    'LookupKeyCompiler',
+    'lookup_keys',
+)
+
+
+# values which encode the same way whatever their type, as the field converts them anyway
+_STR_TYPES = (str, int, float, decimal.Decimal, uuid.UUID)
+_REPR_TYPES = (datetime.date, datetime.time, datetime.timedelta)
+
+
+class LookupKeyCompiler:
+    """
+    Builds the identifier part of lookup cache keys, app_label.model.<digest>,
+    from get() keyword arguments.
+
+    The fixed part of a key (the model and the sorted argument names) is worked
+    out once for each shape of lookup and kept, so each call only encodes the
+    argument values and hashes them. Values are encoded by type: model
+    instances by their pk, and other plain values as strings. A lookup with any
+    other value, such as a queryset or an expression, can't be given a key,
+    and None is returned so the caller knows not to cache it.
+
+    """
+
+    def __init__(self):
+        self._shapes = {}
+
+    def _shape(self, model, names):
+        try:
+            return self._shapes[model, names]
+        except KeyError:
+            # noinspection PyProtectedMember
+            opts = model._meta
+            shape = self._shapes[model, names] = (f'{opts.app_label}.{opts.model_name}.', '\x1f'.join(names) + '\x1e')
+            return shape
+
+    @classmethod
+    def _encode(cls, value):
+        if isinstance(value, _STR_TYPES):
+            # bools are ints
+            return str(value)
+        if isinstance(value, models.Model):
+            return None if value.pk is None else str(value.pk)
+        if value is None:
+            return '\x00'
+        if isinstance(value, _REPR_TYPES):
+            return repr(value)
+        if isinstance(value, (list, tuple)):
+            items = [cls._encode(item) for item in value]
+            return None if None in items else '\x1d'.join(items) + '\x1d'
+        return None
+
+    def __call__(self, model, kwargs):
+        names = tuple(sorted(kwargs))
+        prefix, names_part = self._shape(model, names)
+        values = []
+        for name in names:
+            value = self._encode(kwargs[name])
+            if value is None:
+                return None
+            values.append(value)
+        return prefix + hashlib.blake2b((names_part + '\x1f'.join(values)).encode(), digest_size=20).hexdigest()
+
+
+lookup_keys = LookupKeyCompiler()
@@ -1,27 +1,62 @@
 # -*- coding: utf-8 -*-
+import copy
+import functools
 import logging
+import math
+import random
+import time
 from typing import Union
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.contrib.contenttypes.models import ContentType
 from django.core.cache import BaseCache, caches
-from django.core.exceptions import ObjectDoesNotExist
-from django.db import models, DatabaseError
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.db import models, router, DatabaseError
 from django.utils.functional import SimpleLazyObject, empty
 
-from .modelutils import get_identifier
+from .asynccache import cache_aget, has_async_client
+from .bulkcache import cache_add_many
+from .identitymap import current_identity_map
+from .localcache import LocalCache, TieredCache
+from .metrics import cache_metrics
+from .modelutils import (
+    aget_model_generation,
+    get_identifier,
+    get_model_by_label,
+    get_model_generation,
+    get_model_label,
+    get_model_name,
+    model_cache_deleted_cache_key,
+    model_generation_ttl,
+    GET_ARGS_PK_KEY,
+)
+from .serialization import compact_rows_enabled, decode_row, encode_row, is_encoded_row, schema_fingerprint
+from .singleflight import cache_fills
 
 __all__ = (
     'LazyModelObject',
     'LazyModelObjectDict',
     'LazyModelObjectError',
+    'copy_for_cache',
+    'fill_rows',
     'get_model_cache',
+    'get_model_cache_stats',
+    'get_model_schemas',
     'model_cache_key',
+    'model_cache_keys',
+    'model_schema',
+    'model_schemas_key',
+    'pack_row',
+    'refresh_early',
+    'register_model_schema',
+    'resolve_lazy_objects',
+    'unpack_row',
     'OBJECT_DOES_NOT_EXIST',
 )
 
 
 OBJECT_DOES_NOT_EXIST = 'object-does-not-exists'
+MODEL_CACHE_KEY_PREFIX = 'CachedModel:'
 
 
 class LazyModelObjectError(ValueError):
@@ -36,15 +71,183 @@ class LazyModelObjectError(ValueError):
 
 
 def get_model_cache(name: Union[None, str] = None) -> (BaseCache, int):
+    """
+    Return the row cache backend and timeout.
+
+    If MODEL_ROW_CACHE_LOCAL is set (a dict with optional MAX_ENTRIES and
+    TIMEOUT), the backend is fronted by a per-process LRU cache.
+    """
     if not hasattr(get_model_cache, 'cache'):
         get_model_cache.cache = getattr(settings, 'MODEL_ROW_CACHE', 'default')
         get_model_cache.cache_timeout = int(getattr(settings, 'MODEL_ROW_CACHE_TIMEOUT', 60 * 60 * 24 * 7))
-    return caches[name or get_model_cache.cache], get_model_cache.cache_timeout
+        local = getattr(settings, 'MODEL_ROW_CACHE_LOCAL', None)
+        get_model_cache.local = LocalCache(
+            max_entries=int(local.get('MAX_ENTRIES', 1000)),
+            timeout=float(local.get('TIMEOUT', 60)),
+        ) if local else None
+    cache = caches[name or get_model_cache.cache]
+    if get_model_cache.local is not None:
+        cache = TieredCache(cache, get_model_cache.local, MODEL_CACHE_KEY_PREFIX)
+    return cache, get_model_cache.cache_timeout
+
+
+def get_model_cache_stats() -> dict:
+    """Hit rates and eviction counts for the local and shared row cache tiers."""
+    cache, _ = get_model_cache()
+    if isinstance(cache, TieredCache):
+        return cache.stats()
+    return {}
+
+
+# own schema fingerprint of each model: label -> fingerprint
+_model_schemas = {}
+# fingerprints of each model in use by all processes: label -> (expires, fingerprints)
+_deployed_schemas = {}
+# the most fingerprints of a model to keep track of, for a deploy in progress and a rollback
+MAX_SCHEMAS = 3
+
+
+def register_model_schema(model) -> str:
+    """Work out a model's schema fingerprint, which is part of its row cache keys. Called by MetaCaching."""
+    schema = _model_schemas[get_model_name(model)] = f'{schema_fingerprint(model):08x}'
+    return schema
+
+
+def model_schema(label) -> str:
+    """The schema fingerprint of a model, from its label."""
+    try:
+        return _model_schemas[label]
+    except KeyError:
+        pass
+    # models cached by LazyModelObject
+    model = get_model_by_label(label)
+    return register_model_schema(model) if model is not None else '0'
+
+
+def model_schemas_key(label) -> str:
+    return f'CachedModelSchemas:{label}'
+
+
+def get_model_schemas(label) -> tuple:
+    """
+    The schema fingerprints of a model used by all processes, whose rows are
+    all invalidated on change, as while a deploy is rolled out processes with
+    the old and new fields share the cache. This process's own fingerprint is
+    added, and the list is held locally for MODEL_ROW_CACHE_GENERATION_TTL seconds.
+    """
+    try:
+        expires, schemas = _deployed_schemas[label]
+        if expires > time.monotonic():
+            return schemas
+    except KeyError:
+        pass
+    cache, timeout = get_model_cache()
+    schema = model_schema(label)
+    schemas = cache.get(model_schemas_key(label)) or ()
+    if schema not in schemas:
+        schemas = (tuple(other for other in schemas if other != schema) + (schema,))[-MAX_SCHEMAS:]
+        cache.set(model_schemas_key(label), schemas, timeout=None)
+    _deployed_schemas[label] = (time.monotonic() + model_generation_ttl(), schemas)
+    return schemas
 
 
 def model_cache_key(instance, pk=None) -> str:
     identifier = get_identifier(instance, pk=pk)
-    return f'CachedModel:{identifier}'
+    label = get_model_label(identifier)
+    return f'{MODEL_CACHE_KEY_PREFIX}{get_model_generation(label)}:{model_schema(label)}:{identifier}'
+
+
+def model_cache_keys(instance, pk=None, generation=None) -> list:
+    """
+    The cache keys of a row in the current and previous generation of its model,
+    and with the fields of other deployed versions, for invalidation; other
+    processes may still be using them. The first is the key used by this one.
+    """
+    identifier = get_identifier(instance, pk=pk)
+    label = get_model_label(identifier)
+    if generation is None:
+        generation = get_model_generation(label, fresh=True)
+    own = model_schema(label)
+    schemas = [own] + [schema for schema in get_model_schemas(label) if schema != own]
+    return [f'{MODEL_CACHE_KEY_PREFIX}{gen}:{schema}:{identifier}'
+            for gen in (generation, generation - 1) for schema in schemas]
+
+
+def copy_for_cache(instance):
+    """A copy of an instance without its related objects, which are cached separately."""
+    instance = copy.copy(instance)
+    instance._state = copy.copy(instance._state)
+    instance._state.fields_cache = {}
+    instance.__dict__.pop('_prefetched_objects_cache', None)
+    return instance
+
+
+def pack_row(instance, timeout, delta=0.0) -> tuple:
+    """
+    Prepare an instance for storing in the row cache. Its expiry time and the
+    time taken to load it are kept with it for early refresh. With
+    MODEL_ROW_CACHE_COMPACT set the instance is stored as its field values.
+    """
+    if compact_rows_enabled():
+        instance = encode_row(instance)
+    return instance, (time.time() + timeout) if timeout else None, delta
+
+
+def unpack_row(value) -> tuple:
+    """
+    Return (instance, expires, delta) for a value read from the row cache.
+    The instance is empty for compact rows which can no longer be decoded.
+    """
+    if isinstance(value, tuple) and len(value) == 3:
+        if is_encoded_row(value[0]):
+            return (decode_row(value[0]),) + value[1:]
+        return value
+    # markers for missing objects, and anything cached by older versions
+    return value, None, 0.0
+
+
+@functools.cache
+def early_refresh_beta() -> float:
+    return float(getattr(settings, 'MODEL_ROW_CACHE_EARLY_REFRESH_BETA', 1.0))
+
+
+def fill_rows(cache, rows, timeout, replace=()) -> list:
+    """
+    Cache rows read from the database, {row key: packed row}. A save writes
+    its row through once committed, which is newer than any row read before
+    it, so rows are only added where missing rather than overwriting one. Keys
+    in replace, of rows refreshed early or cached in an older format, are
+    overwritten unless their objects were changed since, as their recently
+    changed markers show. Returns the keys of the rows not cached.
+    """
+    skipped = []
+    replace = [key for key in replace if key in rows]
+    if replace:
+        # row keys end with the object's identifier
+        markers = {model_cache_deleted_cache_key(key.rsplit(':', 1)[-1]): key for key in replace}
+        skipped = [markers[marker] for marker in cache.get_many(list(markers))]
+        rows = dict(rows)
+        replaced = {key: rows.pop(key) for key in replace if key not in skipped}
+        for key in skipped:
+            del rows[key]
+        if replaced:
+            cache.set_many(replaced, timeout=timeout)
+    if not rows:
+        return skipped
+    return skipped + cache_add_many(cache, rows, timeout=timeout)
+
+
+def refresh_early(expires, delta) -> bool:
+    """
+    Probabilistic early expiration: whether this caller should reload a row
+    before it expires. The closer the expiry time and the longer the row took
+    to load, the more likely a reload becomes, so a hot row is refreshed by one
+    caller ahead of time rather than by all of them once it has expired.
+    """
+    beta = early_refresh_beta()
+    if not expires or not delta or beta <= 0:
+        return False
+    return time.time() - delta * beta * math.log(1.0 - random.random()) >= expires
 
 
 def unpickle_lazy_object(obj, args, kwargs):
@@ -99,12 +302,23 @@ class LazyModelObject(SimpleLazyObject):
 
         return unpickle_lazy_object, (object_or_string, args, kwargs)
 
+    @property
+    def _cache(self):
+        return get_model_cache()
+
     def _get_cached_instance(self):
         """
         A cache wrapper around _get_instance, using the same cache keys
         as the row-level cache.
         """
 
+        batch = self.__dict__.pop('_batch', None)
+        if batch is not None:
+            # added to a LazyModelObjectDict without being evaluated, so resolve all of those together
+            batch.resolve()
+            if self._wrapped is not empty:
+                return self._wrapped
+
         try:
             identifier = self._get_identifier()
         except (ValueError, ObjectDoesNotExist) as error:
@@ -112,21 +326,106 @@ class LazyModelObject(SimpleLazyObject):
                 return None
             raise LazyModelObjectError(exc=error) from error
 
+        from .invalidation import has_pending_changes, is_pending
+        identities = current_identity_map()
+        if identities is not None and not has_pending_changes():
+            instance = identities.get(identifier)
+            if instance is not None:
+                return instance
+        else:
+            identities = None
+
         # Get the cache key, basically just namespacing the identifier
         cache_key = model_cache_key(identifier)
 
         cache, timeout = self._cache
-        cace: BaseCache
-        if cache_key in cache:
-            instance = cache.get(cache_key)
-        else:
+        instance = empty
+        replace = False
+        if is_pending(cache_key):
+            # changed in a transaction not yet committed
+            cache_metrics.count(identifier, 'pk', 'db_fallbacks')
             instance = self._get_instance(identifier)
-            cache.set(cache_key, instance, timeout=timeout)
+        else:
+            start = time.perf_counter()
+            value = cache.get(cache_key, empty)
+            if value is not empty:
+                instance, expires, delta = unpack_row(value)
+                if refresh_early(expires, delta):
+                    instance = empty
+                replace = instance is empty
+            cache_metrics.timed(identifier, 'pk', start)
+            cache_metrics.count(identifier, 'pk', _lazy_event(instance))
+
+        if instance is empty:
+            def load():
+                cache_metrics.count(identifier, 'pk', 'db_fallbacks')
+                start = time.monotonic()
+                # from the default database if changed within the replica lag, as RowCacheManager.get() does
+                recently_changed = bool(cache.get(model_cache_deleted_cache_key(identifier), False))
+                loaded = self._get_instance(identifier, primary=recently_changed)
+                if loaded is not None:
+                    # any model can be cached here, so make sure its changes are seen
+                    from ..models import check_cache_signals
+                    check_cache_signals(type(loaded))
+                fill_rows(cache, {cache_key: pack_row(loaded, timeout, time.monotonic() - start)}, timeout,
+                          replace=(cache_key,) if replace else ())
+                return loaded
+
+            def recheck():
+                value = cache.get(cache_key, empty)
+                return unpack_row(value)[0] if value is not empty else empty
+
+            instance, shared = cache_fills.do(cache_key, load, cache=cache, recheck=recheck)
+            if shared:
+                instance = copy.copy(instance)
 
         if instance is None and not self._fail_silently:
             raise LazyModelObjectError(f'{identifier} not found.')
+        if identities is not None:
+            instance = identities.add(identifier, instance)
         return instance
 
+    async def aresolve(self):
+        """
+        Awaitable version of evaluating this object: returns the wrapped
+        instance, or None if it was not found. Cached objects are read with
+        the cache's async client if it has one; loading from the database,
+        any lookup needed to find the object's pk, and reading a cache without
+        an async client, runs in the thread pool.
+        """
+        from .invalidation import has_pending_changes, is_pending
+        if self._wrapped is empty:
+            instance = empty
+            if has_async_client(self._cache[0]) and ('_identifier' in self.__dict__
+                                                     or not _needs_lookup(*self._init_args[1:])):
+                # the cache key can be worked out without a query
+                identities = None if has_pending_changes() else current_identity_map()
+                if identities is not None:
+                    instance = identities.get(self._get_identifier()) or empty
+                await aget_model_generation(self._get_identifier())
+                cache_key = model_cache_key(self._get_identifier())
+                if instance is empty and not is_pending(cache_key):
+                    cache, timeout = self._cache
+                    start = time.perf_counter()
+                    value = await cache_aget(cache, cache_key, empty)
+                    if value is not empty:
+                        instance, expires, delta = unpack_row(value)
+                        if refresh_early(expires, delta):
+                            instance = empty
+                    cache_metrics.timed(self._get_identifier(), 'pk', start)
+                    if instance is not empty:
+                        # misses are counted by _setup()
+                        cache_metrics.count(self._get_identifier(), 'pk', _lazy_event(instance))
+                        if identities is not None:
+                            instance = identities.add(self._get_identifier(), instance)
+            if instance is empty:
+                await sync_to_async(self._setup)()
+            else:
+                if instance is None and not self._fail_silently:
+                    raise LazyModelObjectError(f'{self._get_identifier()} not found.')
+                self._wrapped = instance
+        return self._wrapped
+
     def _get_identifier(self):
         """Get the identifier string for the represented object."""
 
@@ -143,8 +442,8 @@ class LazyModelObject(SimpleLazyObject):
         return self.__dict__['_identifier']
 
     @staticmethod
-    def _get_instance(identifier):
-        """Get the object from the database."""
+    def _get_instance(identifier, primary=False):
+        """Get the object from the database, the one writes go to if primary is set."""
         # noinspection PyBroadException
         try:
             app_label, model, object_pk = identifier.split('.', maxsplit=2)
@@ -152,10 +451,15 @@ class LazyModelObject(SimpleLazyObject):
             if object_pk != 'None':
                 if object_pk == OBJECT_DOES_NOT_EXIST:
                     raise ObjectDoesNotExist()
-                content_type = ContentType.objects.get_by_natural_key(app_label, model)
-                return content_type.get_object_for_this_type(pk=object_pk)
-        except ContentType.DoesNotExist:
-            logging.warning(f'Could not find content type for {identifier!r}')
+                model_class = get_model_by_label(f'{app_label}.{model}')
+                if model_class is None:
+                    logging.warning(f'Could not find model for {identifier!r}')
+                    return None
+                # noinspection PyProtectedMember
+                manager = model_class._base_manager
+                if primary:
+                    return manager.using(router.db_for_write(model_class)).get(pk=object_pk)
+                return manager.get(pk=object_pk)
         except ObjectDoesNotExist:
             logging.warning(f'Could not find related object for {identifier!r}')
         except DatabaseError:   # don't mask these
@@ -176,8 +480,10 @@ class LazyModelObject(SimpleLazyObject):
     def get_model_class(cls, *args, **kwargs):
         identifier = cls.get_identifier(*args, **kwargs)
         app_label, model, object_pk = identifier.split('.', 2)
-        content_type = ContentType.objects.get_by_natural_key(app_label, model)
-        return content_type.model_class()
+        model_class = get_model_by_label(f'{app_label}.{model}')
+        if model_class is None:
+            raise LookupError(f'No installed model {app_label}.{model}')
+        return model_class
 
     @property
     def object_pk(self):
@@ -207,19 +513,179 @@ class LazyModelObject(SimpleLazyObject):
         return f'<LazyModelObject: {self._get_identifier()}>'
 
 
+def _lazy_event(instance) -> str:
+    if instance is empty:
+        return 'misses'
+    return 'negative_hits' if instance is None else 'hits'
+
+
+def _needs_lookup(args, kwargs) -> bool:
+    """Whether finding an object's identifier needs a lookup, which may query the database."""
+    return bool(kwargs) and not args and not any(key in GET_ARGS_PK_KEY for key in kwargs)
+
+
+def resolve_lazy_objects(items):
+    """
+    Evaluate several LazyModelObject instances together: their rows are read
+    with a single cache get_many(), and those missing from cache with one
+    pk__in query for each model, then added to the cache together.
+
+    Objects changed in a transaction not yet committed, and those which aren't
+    found when fail_silently is False, are left to be evaluated one by one.
+    """
+    from .invalidation import has_pending_changes, is_pending
+    cache, timeout = get_model_cache()
+    identities = None if has_pending_changes() else current_identity_map()
+
+    keys = {}
+    for item in items:
+        item.__dict__.pop('_batch', None)
+        if item._wrapped is not empty:
+            continue
+        try:
+            identifier = item._get_identifier()
+        except (ValueError, ObjectDoesNotExist):
+            identifier = None
+        if not identifier:
+            # raised again when evaluated, unless failing silently
+            if item._fail_silently:
+                item._wrapped = None
+            continue
+        instance = identities.get(identifier) if identities is not None else None
+        if instance is not None:
+            item._wrapped = instance
+            continue
+        cache_key = model_cache_key(identifier)
+        if not is_pending(cache_key):
+            keys.setdefault(cache_key, (identifier, []))[1].append(item)
+    if not keys:
+        return
+
+    def found(identifier_, items_, instance):
+        if identities is not None:
+            instance = identities.add(identifier_, instance)
+        for n, item_ in enumerate(items_):
+            if instance is not None or item_._fail_silently:
+                # with an identity map, all of them are the one instance
+                item_._wrapped = copy.copy(instance) if n and identities is None else instance
+
+    start = time.perf_counter()
+    cached = cache.get_many(list(keys))
+    missing = {}
+    refreshed = set()
+    for cache_key, (identifier, key_items) in keys.items():
+        instance = empty
+        if cache_key in cached:
+            instance, expires, delta = unpack_row(cached[cache_key])
+            if refresh_early(expires, delta):
+                instance = empty
+                refreshed.add(cache_key)
+        cache_metrics.count(identifier, 'pk', _lazy_event(instance))
+        if instance is empty:
+            missing.setdefault(get_model_label(identifier), {})[cache_key] = identifier
+        else:
+            found(identifier, key_items, instance)
+    for label in {get_model_label(identifier) for identifier, key_items in keys.values()}:
+        cache_metrics.timed(label, 'pk', start)
+
+    recently_changed = set()
+    if missing:
+        # rows changed within the replica lag are read from the default database, as get_many() does
+        markers = {model_cache_deleted_cache_key(identifier): cache_key
+                   for model_keys in missing.values() for cache_key, identifier in model_keys.items()}
+        recently_changed = {markers[marker] for marker, value in cache.get_many(list(markers)).items() if value}
+
+    rows = {}
+    for label, model_keys in missing.items():
+        cache_metrics.count(label, 'pk', 'db_fallbacks', len(model_keys))
+        start = time.monotonic()
+        loaded = {}
+        model = get_model_by_label(label)
+        if model is None:
+            logging.warning(f'Could not find model for {label!r}')
+        else:
+            pks = []
+            for identifier in model_keys.values():
+                try:
+                    # noinspection PyProtectedMember
+                    pks.append(model._meta.pk.to_python(identifier.split('.', 2)[-1]))
+                except ValidationError:
+                    # including 'None', and cached lookup misses
+                    pass
+            if pks:
+                # noinspection PyProtectedMember
+                queryset = model._base_manager.filter(pk__in=pks).order_by()
+                if recently_changed.intersection(model_keys):
+                    queryset = queryset.using(router.db_for_write(model))
+                for instance in queryset:
+                    loaded[model_cache_key(instance, instance.pk)] = instance
+                # any model can be cached here, so make sure its changes are seen
+                from ..models import check_cache_signals
+                check_cache_signals(model)
+        delta = time.monotonic() - start
+        for cache_key in model_keys:
+            instance = loaded.get(cache_key)
+            found(keys[cache_key][0], keys[cache_key][1], instance)
+            rows[cache_key] = pack_row(instance, timeout, delta)
+    if rows:
+        fill_rows(cache, rows, timeout, replace=refreshed)
+
+
 class LazyModelObjectDict(dict):
     """
     A dictionary of LazyModelObject instances. Use this to avoid duplicate
     database/cache lookups and having duplicate model instances in memory.
 
+    Objects added with add() are not evaluated until one of them is used, or
+    resolve() is called, when all of them are resolved together with
+    resolve_lazy_objects().
+
     """
 
+    def __init__(self, *args, **kwargs):
+        super(LazyModelObjectDict, self).__init__(*args, **kwargs)
+        self._pending = {}
+
+    def add(self, *args, **kwargs):
+        """
+        Get or add a LazyModelObject instance to this dictionary without
+        evaluating it. Accepts the same arguments as the LazyModelObject class.
+
+        Usage:
+            items = LazyModelObjectDict()
+            users = [items.add(User, pk) for pk in pks]
+            # one cache read, and at most one query, for all of them
+            names = [user.username for user in users if user]
+
+        """
+        key = LazyModelObject.get_identifier(*args, **kwargs)
+        try:
+            return self[key]
+        except KeyError:
+            return self._add(key, *args, **kwargs)
+
+    def _add(self, key, *args, **kwargs):
+        item = LazyModelObject(*args, **kwargs)
+        item.__dict__['_batch'] = self
+        self[key] = self._pending[key] = item
+        return item
+
+    def resolve(self):
+        """Evaluate all the objects added and not yet evaluated. Those not found are replaced by None."""
+        pending, self._pending = self._pending, {}
+        resolve_lazy_objects(list(pending.values()))
+        for key, item in pending.items():
+            if self.get(key) is item and item._wrapped is None:
+                self[key] = None
+
     def get_or_add(self, *args, **kwargs):
         """
         Get or add a LazyModelObject instance to this dictionary. Accepts the same
-        arguments as the LazyModelObject class. Returns a LazyModelObject instance.
+        arguments as the LazyModelObject class. Returns a LazyModelObject instance,
+        or None if the object does not exist.
 
-        Note: this will evaluate LazyModelObject instances when adding new ones.
+        Note: this will evaluate LazyModelObject instances when adding new ones,
+        along with any others added with add() and not yet evaluated.
 
         Usage:
             items = LazyModelObjectDict()
@@ -228,11 +694,30 @@ class LazyModelObjectDict(dict):
         """
 
         key = LazyModelObject.get_identifier(*args, **kwargs)
+        if key not in self:
+            self._add(key, *args, **kwargs)
+        if self._pending:
+            self.resolve()
+        item = self[key]
+        if item is not None and not item:
+            # left to be evaluated on its own
+            item = self[key] = None
+        return item
+
+    async def aget_or_add(self, *args, **kwargs):
+        """
+        Awaitable version of get_or_add(). Objects are resolved with
+        LazyModelObject.aresolve().
+        """
+        if _needs_lookup(args[1:], kwargs):
+            key = await sync_to_async(LazyModelObject.get_identifier)(*args, **kwargs)
+        else:
+            key = LazyModelObject.get_identifier(*args, **kwargs)
         try:
             return self[key]
         except KeyError:
             item = LazyModelObject(*args, **kwargs)
-            if not item:
+            if not await item.aresolve():
                 item = None
             self[key] = item
             return item
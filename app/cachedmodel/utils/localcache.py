@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+import copy
+import pickle
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.core.cache import BaseCache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.db import models
+
+from .bulkcache import cache_add_many
+
+__all__ = (
+    'LocalCache',
+    'TieredCache',
+)
+
+
+MISSING = object()
+
+
+class LocalCache:
+    """
+    A bounded, thread safe, in-process LRU cache with a time to live
+    for each entry. This is used as the first tier (L1) in front of the
+    shared row cache, so only a subset of the cache API is provided.
+
+    """
+
+    def __init__(self, max_entries: int = 1000, timeout: float = 60):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = self.stale = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires < time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, timeout=None):
+        expires = time.monotonic() + (self.timeout if timeout is None else timeout)
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def discard(self, key):
+        """Drop an entry found to be out of date, counting the lookup as a miss."""
+        with self._lock:
+            self._data.pop(key, None)
+            self.hits -= 1
+            self.misses += 1
+            self.stale += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def footprint(self) -> int:
+        """Approximate memory used by the values held, in bytes, as their pickled size."""
+        with self._lock:
+            values = [value for expires, value in self._data.values()]
+        size = 0
+        for value in values:
+            try:
+                size += len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+            except (pickle.PicklingError, TypeError, AttributeError):
+                size += sys.getsizeof(value)
+        return size
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._data),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'stale': self.stale,
+        }
+
+
+class TieredCache:
+    """
+    Wraps the shared (L2) row cache backend with an in-process LocalCache (L1).
+
+    Only keys starting with `prefix` (the row keys) are held in L1, everything
+    else is passed straight through to the shared cache. Each L1 entry records
+    a version stamp which is kept in the shared cache next to the row. Every
+    write or delete of the row replaces or removes the stamp, so a change made
+    by any worker is noticed on the next lookup here, at the cost of reading
+    only the small stamp rather than the whole pickled row.
+
+    Rows served from L1 are shallow copies, so callers cannot alter each
+    other's instances.
+
+    """
+
+    # L2 counters are shared by all the wrappers using the same LocalCache
+    _l2_stats_lock = threading.Lock()
+
+    def __init__(self, cache: BaseCache, local: LocalCache, prefix: str):
+        self._cache = cache
+        self._local = local
+        self._prefix = prefix
+        if not hasattr(local, 'l2_hits'):
+            local.l2_hits = local.l2_misses = 0
+
+    def __getattr__(self, name):
+        return getattr(self._cache, name)
+
+    def __contains__(self, key):
+        return self.get(key, MISSING) is not MISSING
+
+    def has_key(self, key, version=None):
+        return self.get(key, MISSING, version=version) is not MISSING
+
+    def _tiered(self, key) -> bool:
+        return isinstance(key, str) and key.startswith(self._prefix)
+
+    @staticmethod
+    def stamp_key(key) -> str:
+        return f'CachedModelStamp:{key}'
+
+    @staticmethod
+    def _new_stamp() -> str:
+        return uuid.uuid4().hex
+
+    @staticmethod
+    def _copy(value):
+        if isinstance(value, tuple) and value and isinstance(value[0], models.Model):
+            # packed rows
+            return (copy.copy(value[0]),) + value[1:]
+        return copy.copy(value) if isinstance(value, models.Model) else value
+
+    def _count(self, hits=0, misses=0):
+        local = self._local
+        with self._l2_stats_lock:
+            local.l2_hits += hits
+            local.l2_misses += misses
+
+    def _check_local(self, keys, version=None, others=()) -> dict:
+        """
+        Return values held in L1 whose stamps still match the shared cache,
+        along with any others read from the shared cache in the same round trip.
+        """
+        entries = {}
+        for key in keys:
+            entry = self._local.get(key)
+            if entry is not None:
+                entries[key] = entry
+        if not entries and not others:
+            return {}
+        stamps = self._cache.get_many([self.stamp_key(key) for key in entries] + list(others), version=version)
+        valid = {key: stamps[key] for key in others if key in stamps}
+        for key, (stamp, value) in entries.items():
+            if stamps.get(self.stamp_key(key)) == stamp:
+                valid[key] = self._copy(value)
+            else:
+                self._local.discard(key)
+        return valid
+
+    def _fetch_shared(self, keys, version=None) -> dict:
+        """Fetch rows with their stamps from the shared cache, and keep them in L1."""
+        fetch = []
+        for key in keys:
+            fetch.extend((key, self.stamp_key(key)))
+        values = self._cache.get_many(fetch, version=version)
+        found = {}
+        for key in keys:
+            try:
+                value = values[key]
+            except KeyError:
+                continue
+            found[key] = value
+            stamp = values.get(self.stamp_key(key))
+            # rows written without a stamp can't be validated, so are not kept locally
+            if stamp is not None:
+                self._local.set(key, (stamp, value))
+        self._count(hits=len(found), misses=len(keys) - len(found))
+        return {key: self._copy(value) for key, value in found.items()}
+
+    def get(self, key, default=None, version=None):
+        if not self._tiered(key):
+            return self._cache.get(key, default, version=version)
+        found = self._check_local([key], version=version)
+        if key not in found:
+            found = self._fetch_shared([key], version=version)
+        return found.get(key, default)
+
+    def get_many(self, keys, version=None) -> dict:
+        keys = list(keys)
+        tiered = [key for key in keys if self._tiered(key)]
+        others = [key for key in keys if not self._tiered(key)]
+        # the stamps and other keys are read together
+        found = self._check_local(tiered, version=version, others=others)
+        remaining = [key for key in tiered if key not in found]
+        if remaining:
+            found.update(self._fetch_shared(remaining, version=version))
+        return found
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.set_many({key: value}, timeout=timeout, version=version)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        data = dict(data)
+        for key in [key for key in data if self._tiered(key)]:
+            stamp = data[self.stamp_key(key)] = self._new_stamp()
+            self._local.set(key, (stamp, self._copy(data[key])))
+        return self._cache.set_many(data, timeout=timeout, version=version)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None) -> bool:
+        return not self.add_many({key: value}, timeout=timeout, version=version)
+
+    def add_many(self, data, timeout=DEFAULT_TIMEOUT, version=None) -> list:
+        """Add each value where its key is missing, returning the keys that weren't."""
+        stamps = {self.stamp_key(key): self._new_stamp() for key in data if self._tiered(key)}
+        # the stamps are added before their rows, in the same round trip
+        skipped = cache_add_many(self._cache, {**stamps, **data}, timeout=timeout, version=version)
+        unstamped = set(skipped).intersection(stamps)
+        skipped = [key for key in skipped if key not in stamps]
+        restamp = {}
+        for key in set(data).difference(skipped):
+            stamp_key = self.stamp_key(key)
+            if stamp_key not in stamps:
+                continue
+            if stamp_key in unstamped:
+                # a stamp left by an expired row mustn't validate L1 copies of it
+                restamp[stamp_key] = stamps[stamp_key]
+            else:
+                self._local.set(key, (stamps[stamp_key], self._copy(data[key])))
+        if restamp:
+            self._cache.set_many(restamp, timeout=timeout, version=version)
+        return skipped
+
+    def delete(self, key, version=None):
+        self.delete_many([key], version=version)
+
+    def delete_many(self, keys, version=None):
+        keys = list(keys)
+        for key in [key for key in keys if self._tiered(key)]:
+            self._local.delete(key)
+            keys.append(self.stamp_key(key))
+        self._cache.delete_many(keys, version=version)
+
+    def clear(self):
+        self._local.clear()
+        self._cache.clear()
+
+    def stats(self) -> dict:
+        local = self._local
+        l2_lookups = local.l2_hits + local.l2_misses
+        return {
+            'l1': local.stats(),
+            'l2': {
+                'hits': local.l2_hits,
+                'misses': local.l2_misses,
+                'hit_rate': local.l2_hits / l2_lookups if l2_lookups else 0.0,
+            },
+        }
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+import functools
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+
+from .modelutils import get_model_label
+
+__all__ = (
+    'CacheMetrics',
+    'EVENTS',
+    'KINDS',
+    'cache_metrics',
+    'metrics_enabled',
+    'metrics_key',
+)
+
+
+KINDS = ('pk', 'lookup', 'query')
+EVENTS = (
+    'hits',             # found in cache
+    'misses',           # not found in cache
+    'negative_hits',    # cached as not existing
+    'bloom_hits',       # not in the model's Bloom filter, so certain not to exist
+    'db_fallbacks',     # rows read from the database instead
+    'invalidations',    # rows removed or replaced on change
+    'backend_calls',    # cache reads timed
+    'backend_us',       # time spent on them, in microseconds
+)
+
+
+@functools.cache
+def metrics_enabled() -> bool:
+    return bool(getattr(settings, 'MODEL_ROW_CACHE_METRICS', True))
+
+
+@functools.cache
+def metrics_flush_interval() -> float:
+    return float(getattr(settings, 'MODEL_ROW_CACHE_METRICS_FLUSH', 10))
+
+
+def metrics_key(label, kind, event) -> str:
+    return f'CachedModelMetrics:{label}:{kind}:{event}'
+
+
+def _nest(counts) -> dict:
+    nested = {}
+    for (label, kind, event), value in counts.items():
+        nested.setdefault(label, {}).setdefault(kind, dict.fromkeys(EVENTS, 0))[event] = value
+    return nested
+
+
+class CacheMetrics:
+    """
+    Row cache counters for each model and kind of lookup.
+
+    Each thread counts into its own dict, so recording an event costs a dict
+    increment with no locking. Every MODEL_ROW_CACHE_METRICS_FLUSH seconds the
+    totals counted since the last flush are added to counters in the shared
+    cache, where they can be read for all processes together.
+
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._counters = []
+        self._flushed = defaultdict(int)
+        self._next_flush = time.monotonic() + metrics_flush_interval()
+
+    def _thread_counters(self) -> defaultdict:
+        try:
+            return self._local.counters
+        except AttributeError:
+            counters = self._local.counters = defaultdict(int)
+            with self._lock:
+                self._counters.append(counters)
+            return counters
+
+    def count(self, model, kind, event, n=1):
+        if not metrics_enabled():
+            return
+        self._thread_counters()[(get_model_label(model), kind, event)] += n
+        if time.monotonic() >= self._next_flush:
+            self.flush()
+
+    def timed(self, model, kind, start):
+        """Record a cache read which began at time.perf_counter() start."""
+        if not metrics_enabled():
+            return
+        counters = self._thread_counters()
+        label = get_model_label(model)
+        counters[(label, kind, 'backend_calls')] += 1
+        counters[(label, kind, 'backend_us')] += int((time.perf_counter() - start) * 1e6)
+
+    def totals(self) -> dict:
+        totals = defaultdict(int)
+        for counters in list(self._counters):
+            for key, value in list(counters.items()):
+                totals[key] += value
+        return totals
+
+    def snapshot(self) -> dict:
+        """Counters for this process: {label: {kind: {event: count}}}."""
+        return _nest(self.totals())
+
+    def flush(self):
+        """Add the counts since the last flush to the shared counters."""
+        if not self._lock.acquire(blocking=False):
+            # another thread is flushing
+            return
+        try:
+            self._next_flush = time.monotonic() + metrics_flush_interval()
+            if metrics_flush_interval() <= 0:
+                return
+            from .lazymodel import get_model_cache
+            cache, timeout = get_model_cache()
+            for key, value in self.totals().items():
+                delta = value - self._flushed[key]
+                if delta:
+                    shared_key = metrics_key(*key)
+                    cache.add(shared_key, 0, timeout=None)
+                    try:
+                        cache.incr(shared_key, delta)
+                    except ValueError:
+                        # evicted meanwhile
+                        continue
+                    self._flushed[key] = value
+        finally:
+            self._lock.release()
+
+    @staticmethod
+    def shared_snapshot(models) -> dict:
+        """Counters of all processes for the given models, as flushed to the shared cache."""
+        from .lazymodel import get_model_cache
+        cache, timeout = get_model_cache()
+        keys = {metrics_key(get_model_label(model), kind, event): (get_model_label(model), kind, event)
+                for model in models for kind in KINDS for event in EVENTS}
+        return _nest({keys[key]: value for key, value in cache.get_many(list(keys)).items()})
+
+    def reset(self, models=()):
+        """Clear the counters of this process, and the shared ones for the given models."""
+        with self._lock:
+            for counters in self._counters:
+                counters.clear()
+            self._flushed.clear()
+        if models:
+            from .lazymodel import get_model_cache
+            cache, timeout = get_model_cache()
+            cache.delete_many([metrics_key(get_model_label(model), kind, event)
+                               for model in models for kind in KINDS for event in EVENTS])
+
+
+cache_metrics = CacheMetrics()
@@ -1,23 +1,39 @@
 # -*- coding: utf-8 -*-
 import functools
-import json
 import logging
 import re
+import time
 
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import models
 from django.contrib.contenttypes.models import ContentType
 
-from .hashtuple import HashableTuple
+from .keycompiler import lookup_keys
 
 __all__ = (
+    'aget_lookup_cache_row',
+    'aget_model_generation',
+    'build_model_registry',
+    'bump_model_generation',
+    'bump_model_writes',
+    'get_model_generation',
     'get_identifier_string',
+    'get_lookup_cache_pk',
+    'get_lookup_cache_row',
+    'get_concrete_label',
+    'get_model_by_label',
+    'get_model_by_table',
+    'get_model_writes',
     'get_object_pk',
     'model_row_cache_enabled',
+    'preload_content_types',
     'model_cache_deleted_cache_key',
     'lookup_cache_key',
-    'lookup_cache_master_key',
+    'replica_lag',
+    'lookup_namespace_key',
+    'model_generation_key',
+    'model_writes_key',
     'save_lookup_cache_key',
     'GET_ARGS_PK_KEY',
 )
@@ -34,32 +50,215 @@ def model_row_cache_enabled() -> bool:
     return any(enabled.startswith(x) for x in TRUTH_VALUES) if isinstance(enabled, str) else enabled
 
 
+@functools.cache
+def model_generation_ttl() -> float:
+    return float(getattr(settings, 'MODEL_ROW_CACHE_GENERATION_TTL', 1))
+
+
+@functools.cache
+def replica_lag() -> float:
+    """How long, in seconds, rows are marked as recently changed, for the database replicas to catch up."""
+    return float(getattr(settings, 'DATABASE_REPLICA_LAG', 60))
+
+
 def model_cache_deleted_cache_key(obj, pk=None) -> str:
     identifier = get_identifier(obj, pk=pk)
     return f"ModelDeletedCache:{identifier})"
 
 
-def lookup_cache_master_key(instance, pk=None) -> str:
+def lookup_namespace_key(instance, pk=None) -> str:
     identifier = get_identifier(instance, pk)
-    return f"ModelCacheLookupMaster:{identifier}"
+    return f"ModelCacheLookupNamespace:{identifier}"
+
+
+def _new_namespace_version() -> int:
+    # based on the clock so that a namespace recreated after eviction does not reuse old versions
+    return time.time_ns() // 1000
 
 
 def save_lookup_cache_key(instance, object_pk, lookup_key, lookup_timeout=None):
+    """
+    Cache object_pk against lookup_key, tagged with the object's current lookup
+    namespace version. All lookups saved for an object are invalidated at once
+    when it changes, by deleting its namespace key along with its row, so
+    there is no list of keys to maintain.
+    """
+    from .lazymodel import get_model_cache
+    cache, timeout = get_model_cache()
+    namespace_key = lookup_namespace_key(instance, object_pk)
+    version = cache.get(namespace_key)
+    if version is None:
+        version = _new_namespace_version()
+        if not cache.add(namespace_key, version, timeout=timeout):
+            # someone else got there first
+            version = cache.get(namespace_key)
+    if version is not None:
+        cache.set(lookup_key, (object_pk, version), timeout=lookup_timeout or timeout)
+
+
+def get_lookup_cache_pk(instance, lookup_key):
+    """
+    Return the object pk cached against lookup_key, or None if there is none or
+    it was invalidated. A cached miss is returned as is.
+    """
+    from .lazymodel import get_model_cache
+    cache, timeout = get_model_cache()
+    value = cache.get(lookup_key)
+    if isinstance(value, tuple):
+        object_pk, version = value
+        if cache.get(lookup_namespace_key(instance, object_pk)) != version:
+            return None
+        return object_pk
+    return value
+
+
+def get_lookup_cache_row(instance, lookup_key) -> tuple:
+    """
+    Return (object_pk, row) for a lookup: the object pk as get_lookup_cache_pk()
+    does, and the value cached for its row, or empty if there is none. The row
+    is read along with the lookup's namespace version, so a hit costs two cache
+    round trips.
+    """
+    from django.utils.functional import empty
+    from .lazymodel import get_model_cache, model_cache_key
+    cache, timeout = get_model_cache()
+    value = cache.get(lookup_key)
+    if not isinstance(value, tuple):
+        return value, empty
+    object_pk, version = value
+    namespace_key = lookup_namespace_key(instance, object_pk)
+    pk_key = model_cache_key(instance, object_pk)
+    found = cache.get_many([namespace_key, pk_key])
+    if found.get(namespace_key) != version:
+        return None, empty
+    return object_pk, found.get(pk_key, empty)
+
+
+async def aget_lookup_cache_row(instance, lookup_key) -> tuple:
+    """Async version of get_lookup_cache_row()."""
+    from django.utils.functional import empty
+    from .asynccache import cache_aget, cache_aget_many
+    from .lazymodel import get_model_cache, model_cache_key
+    cache, timeout = get_model_cache()
+    value = await cache_aget(cache, lookup_key)
+    if not isinstance(value, tuple):
+        return value, empty
+    object_pk, version = value
+    namespace_key = lookup_namespace_key(instance, object_pk)
+    pk_key = model_cache_key(instance, object_pk)
+    found = await cache_aget_many(cache, [namespace_key, pk_key])
+    if found.get(namespace_key) != version:
+        return None, empty
+    return object_pk, found.get(pk_key, empty)
+
+
+def model_generation_key(instance) -> str:
+    return f"CachedModelGeneration:{get_model_label(instance)}"
+
+
+# process local copy of each model's generation: label -> (expires, generation)
+_model_generations = {}
+
+
+def get_model_generation(instance, fresh=False) -> int:
+    """
+    Return the current cache generation of a model, which is part of all row
+    and lookup cache keys for the model. The value is held locally for up to
+    MODEL_ROW_CACHE_GENERATION_TTL seconds unless fresh is set.
+    """
+    label = get_model_label(instance)
+    if not fresh:
+        try:
+            expires, generation = _model_generations[label]
+            if expires > time.monotonic():
+                return generation
+        except KeyError:
+            pass
+
+    from .lazymodel import get_model_cache
+    cache, timeout = get_model_cache()
+    generation_key = model_generation_key(label)
+    generation = cache.get(generation_key)
+    if generation is None:
+        generation = _new_namespace_version()
+        if not cache.add(generation_key, generation, timeout=None):
+            generation = cache.get(generation_key, generation)
+    _model_generations[label] = (time.monotonic() + model_generation_ttl(), generation)
+    return generation
+
+
+async def aget_model_generation(instance) -> int:
+    """
+    Async version of get_model_generation(). When the value isn't held
+    locally, the cache is read in a thread.
+    """
+    label = get_model_label(instance)
+    try:
+        expires, generation = _model_generations[label]
+        if expires > time.monotonic():
+            return generation
+    except KeyError:
+        pass
+    from asgiref.sync import sync_to_async
+    return await sync_to_async(get_model_generation, thread_sensitive=False)(label)
+
+
+def bump_model_generation(instance) -> int:
+    """
+    Invalidate all cached rows and lookups of a model at once by moving it to
+    a new cache generation. Other processes see the change within
+    MODEL_ROW_CACHE_GENERATION_TTL seconds.
+    """
+    from .lazymodel import get_model_cache
+    label = get_model_label(instance)
+    cache, timeout = get_model_cache()
+    try:
+        generation = cache.incr(model_generation_key(label))
+    except ValueError:
+        # no generation yet, so nothing is cached under one
+        return get_model_generation(label, fresh=True)
+    _model_generations[label] = (time.monotonic() + model_generation_ttl(), generation)
+    return generation
+
+
+def model_writes_key(instance) -> str:
+    return f"CachedModelWrites:{get_model_label(instance)}"
+
+
+def get_model_writes(labels) -> dict:
+    """
+    Return the write generation of each model, {label: generation}, which
+    changes whenever any of its rows are changed. Unlike the cache generation
+    it is read afresh from the cache each time, as it only keys query results.
+    """
     from .lazymodel import get_model_cache
-    # save lookup cache key to purge them all when needed
-    identifier = get_identifier(instance, object_pk)
-    # noinspection PyTypeChecker
-    master_key = lookup_cache_master_key(identifier)
     cache, timeout = get_model_cache()
-    list_lookup_cache_keys = []
-    if master_key in cache:
-        cache_keys = cache.get(master_key)
-        if cache_keys:
-            list_lookup_cache_keys = json.loads(cache_keys)
+    keys = {model_writes_key(label): label for label in labels}
+    writes = cache.get_many(list(keys))
+    for key in keys.keys() - writes.keys():
+        # a new value rather than 0, so query results cached before it was evicted are not used
+        cache.add(key, _new_namespace_version(), timeout=None)
+        writes[key] = cache.get(key)
+    return {keys[key]: generation for key, generation in writes.items()}
+
+
+def bump_model_writes(labels):
+    """Move models to a new write generation, invalidating the query results cached for them."""
+    from .lazymodel import get_model_cache
+    cache, timeout = get_model_cache()
+    for label in labels:
+        try:
+            cache.incr(model_writes_key(label))
+        except ValueError:
+            # no query results cached for it
+            pass
+
 
-    if lookup_key not in list_lookup_cache_keys:
-        list_lookup_cache_keys.append(lookup_key)
-        cache.set(master_key, json.dumps(list_lookup_cache_keys), timeout=lookup_timeout or timeout)
+def get_model_label(instance) -> str:
+    """return app_label.model_name for a model, instance, content type or identifier string"""
+    if isinstance(instance, str):
+        return '.'.join(instance.split('.', 2)[:2])
+    return get_model_name(get_model_by_ct(instance))
 
 
 def get_model_name(instance) -> str:
@@ -69,6 +268,68 @@ def get_model_name(instance) -> str:
     return f"{opts.app_label}.{opts.model_name}"
 
 
+# app_label.model_name -> model class, and database table -> model class, for all installed models
+_model_registry = {}
+_table_registry = {}
+
+
+def build_model_registry():
+    """Map the label of each model to its class, once all models are loaded, from CachedModelAppConfig.ready()."""
+    from django.apps import apps
+    for model in apps.get_models(include_auto_created=True):
+        _model_registry[get_model_name(model)] = model
+        # noinspection PyProtectedMember
+        _table_registry.setdefault(model._meta.db_table, model._meta.concrete_model)
+
+
+def get_concrete_label(label) -> str:
+    """The label of the concrete model for a proxy model's label, which shares its table."""
+    model = get_model_by_label(label)
+    # noinspection PyProtectedMember
+    return label if model is None or not model._meta.proxy else get_model_name(model._meta.concrete_model)
+
+
+def get_model_by_table(table):
+    """Return the model class for a database table, or None if it isn't a model's."""
+    if not _table_registry:
+        build_model_registry()
+    return _table_registry.get(table)
+
+
+def get_model_by_label(label):
+    """Return the model class for app_label.model_name, or None if there is no such model."""
+    try:
+        return _model_registry[label]
+    except KeyError:
+        pass
+    from django.apps import apps
+    try:
+        # before the registry is built, or a model created since
+        model = apps.get_model(label)
+    except (LookupError, ValueError):
+        return None
+    _model_registry[label] = model
+    return model
+
+
+# noinspection PyUnusedLocal
+def preload_content_types(sender=None, **kwargs):
+    """
+    Load all content types into ContentType.objects' cache with one query,
+    rather than one for each model when first used. Connected to
+    request_started by CachedModelAppConfig.ready(), and run once.
+    """
+    from django.core.signals import request_started
+    from django.db import DatabaseError
+    request_started.disconnect(preload_content_types, dispatch_uid='cachedmodel.preload_content_types')
+    try:
+        for content_type in ContentType.objects.all():
+            # noinspection PyProtectedMember
+            ContentType.objects._add_to_cache(content_type._state.db, content_type)
+    except DatabaseError:
+        logging.exception('Could not preload content types')
+
+
 def get_model_by_ct(instance):
     if isinstance(instance, ContentType):
         return instance.model_class()
@@ -111,30 +372,44 @@ def get_identifier(instance, pk=None, _fail_silently=True, **kwargs) -> str:
 
 
 def lookup_cache_key(model, *args, **kwargs):
-    identifier = get_identifier(model, HashableTuple(args, kwargs).hash)
-    return f"ModelCacheLookup:{identifier}"
+    """
+    The cache key for a get() lookup, or None if it can't be cached: positional
+    arguments (Q objects) and values such as querysets or expressions aren't.
+    """
+    if args:
+        return None
+    model = get_model_by_ct(model)
+    identifier = lookup_keys(model if isinstance(model, type) else type(model), kwargs)
+    if identifier is None:
+        return None
+    return f"ModelCacheLookup:{get_model_generation(identifier)}:{identifier}"
 
 
 def get_object_pk(model: models.Model, _fail_silently=True, **kwargs):
-    from .lazymodel import get_model_cache
-
+    from .metrics import cache_metrics
+    start = time.perf_counter()
     cache_key = lookup_cache_key(model, **kwargs)
-    cache, timeout = get_model_cache()
-    if cache_key in cache:
-        object_pk = cache[cache_key]
-    else:
+    object_pk = cache_key and get_lookup_cache_pk(model, cache_key)
+    cache_metrics.timed(model, 'lookup', start)
+    if object_pk is None:
         from ..models import CachedModel
+        cached_model = isinstance(model, type) and issubclass(model, CachedModel)
+        if not cached_model:
+            cache_metrics.count(model, 'lookup', 'misses')
+            cache_metrics.count(model, 'lookup', 'db_fallbacks')
         try:
             object_pk = model.objects.get(**kwargs).pk
-            cache.set(cache_key, object_pk, timeout=timeout)
 
-            # if model is CachedModel, this lookup cache key should be saved in model.objects.get(**kwargs).pk
-            if not isinstance(model, CachedModel):
+            # if model is CachedModel, this lookup cache key was saved (and counted) by model.objects.get(**kwargs)
+            if not cached_model and cache_key:
                 save_lookup_cache_key(model, object_pk, cache_key)
 
         except (model.DoesNotExist, ObjectDoesNotExist):
             if not _fail_silently:
                 raise
             object_pk = None
+    else:
+        from .lazymodel import OBJECT_DOES_NOT_EXIST
+        cache_metrics.count(model, 'lookup', 'negative_hits' if object_pk == OBJECT_DOES_NOT_EXIST else 'hits')
 
     return object_pk
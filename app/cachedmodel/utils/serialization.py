@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import functools
+import zlib
+
+from django.apps import apps
+from django.conf import settings
+from django.db import models
+from django.utils.functional import empty
+
+__all__ = (
+    'compact_rows_enabled',
+    'decode_row',
+    'encode_row',
+    'is_encoded_row',
+    'schema_fingerprint',
+)
+
+
+# first item of an encoded row, so it cannot be mistaken for anything else in the row cache
+COMPACT_ROW_TAG = 'CachedModelRow:1'
+
+
+@functools.cache
+def compact_rows_enabled() -> bool:
+    return bool(getattr(settings, 'MODEL_ROW_CACHE_COMPACT', False))
+
+
+@functools.lru_cache(maxsize=None)
+def schema_fingerprint(model) -> int:
+    """A checksum of a model's concrete fields, which changes with its schema."""
+    # noinspection PyProtectedMember
+    fields = ','.join(f'{field.attname}:{field.get_internal_type()}' for field in model._meta.concrete_fields)
+    return zlib.crc32(f'{model._meta.label_lower}({fields})'.encode())
+
+
+def encode_row(instance):
+    """
+    Encode an instance for the row cache as a tuple of its field values,
+    tagged with its model and schema fingerprint. This is much smaller than
+    the pickled instance and quicker to load, as its state and any related
+    objects cached on it are left out.
+
+    Instances with deferred fields are returned as they are.
+    """
+    if not isinstance(instance, models.Model) or instance.get_deferred_fields():
+        return instance
+    model = type(instance)
+    # noinspection PyProtectedMember
+    values = tuple(getattr(instance, field.attname) for field in model._meta.concrete_fields)
+    return COMPACT_ROW_TAG, model._meta.label_lower, schema_fingerprint(model), instance._state.db, values
+
+
+def is_encoded_row(value) -> bool:
+    return isinstance(value, tuple) and len(value) == 5 and value[0] == COMPACT_ROW_TAG
+
+
+def decode_row(value):
+    """
+    Rebuild an instance encoded by encode_row() with Model.from_db(). Returns
+    empty if the model is gone or its fields have changed since it was cached,
+    in which case the row should be treated as missing.
+    """
+    _, label, fingerprint, db, values = value
+    try:
+        model = apps.get_model(label)
+    except LookupError:
+        return empty
+    if schema_fingerprint(model) != fingerprint:
+        return empty
+    # noinspection PyProtectedMember
+    field_names = [field.attname for field in model._meta.concrete_fields]
+    return model.from_db(db, field_names, values)
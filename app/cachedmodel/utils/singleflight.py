@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+from django.core.cache import BaseCache
+from django.utils.functional import empty
+
+__all__ = (
+    'SingleFlight',
+    'cache_fills',
+)
+
+
+FILL_LOCK_TIMEOUT = 5
+FILL_WAIT = 0.5
+FILL_POLL_INTERVAL = 0.025
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent loads of the same cache key so that only one caller
+    goes to the database when a key is missing.
+
+    Threads in this process wait on the first caller's result. Other processes
+    are held off with a short-lived fill lock in the shared cache; while it is
+    held, recheck() is polled for up to FILL_WAIT seconds before giving up and
+    loading anyway, so a stuck or dead filler only costs a short delay.
+
+    Loads under way when changes are written to the cache may have read the
+    rows before they changed, so forget() is called then, and later callers
+    start a load of their own instead of waiting for one of those.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key: str, load, cache: BaseCache = None, recheck=None) -> tuple:
+        """
+        Call load() for key unless another thread is already doing so.
+        Returns (result, shared); shared is True if the result was loaded by
+        another thread, which the caller may want to copy before handing out.
+        """
+        me = threading.get_ident()
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                future = Future()
+                self._calls[key] = (future, me)
+        if call is not None:
+            future, owner = call
+            if owner == me:
+                # re-entered while loading the same key
+                return load(), False
+            try:
+                return future.result(timeout=FILL_LOCK_TIMEOUT), True
+            except TimeoutError:
+                return load(), False
+
+        try:
+            result = self._load(key, load, cache, recheck)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                # unless forgotten and loading again for a later caller
+                if self._calls.get(key, (None, None))[0] is future:
+                    del self._calls[key]
+
+    def forget(self):
+        """Stop handing the results of the loads under way to later callers."""
+        with self._lock:
+            self._calls.clear()
+
+    @staticmethod
+    def _load(key, load, cache, recheck):
+        if cache is None:
+            return load()
+        lock_key = f'CachedModelFill:{key}'
+        if cache.add(lock_key, 1, timeout=FILL_LOCK_TIMEOUT):
+            try:
+                return load()
+            finally:
+                cache.delete(lock_key)
+
+        # another process is filling this key, so give it a chance to finish
+        if recheck is not None:
+            deadline = time.monotonic() + FILL_WAIT
+            while time.monotonic() < deadline:
+                time.sleep(FILL_POLL_INTERVAL)
+                result = recheck()
+                if result is not empty:
+                    return result
+        return load()
+
+
+cache_fills = SingleFlight()
@@ -58,6 +58,8 @@ INSTALLED_APPS = DJANGO_APPS + CUSTOM_APPS + THIRDPARTY_APPS
 
 DJANGO_MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'core.middleware.ReadPinningMiddleware',
+    'cachedmodel.middleware.IdentityMapMiddleware',
     'core.middleware.CoreMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.cache.UpdateCacheMiddleware',
@@ -133,6 +135,9 @@ CACHES = {
     'default': env.cache_url('DJANGO_CACHE_URL'),
     'sessions': env.cache_url('DJANGO_SESSIONS_CACHE_URL', default=env.get('DJANGO_CACHE_URL'))
 }
+# models cached by LazyModelObject, whose changes every process must invalidate
+MODEL_ROW_CACHE_SENDERS = ['auth.User']
+
 SESSION_ENGINE = 'django.contrib.sessions.backends.cache'
 SESSION_CACHE_ALIAS = 'sessions'
 
@@ -8,3 +8,9 @@ class CoreConfig(AppConfig):
 
     # noinspection PyUnresolvedReferences
     from . import settings
+
+    def ready(self):
+        from django.db.models.signals import m2m_changed, post_delete, post_save
+        from .db_router import pin_reads_after_write
+        for signal in (post_save, post_delete, m2m_changed):
+            signal.connect(pin_reads_after_write, dispatch_uid=f'core.pin_reads.{id(signal)}')
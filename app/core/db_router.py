@@ -1,27 +1,80 @@
 # -*- coding: utf-8 -*-
+import contextvars
+import functools
 import random
+import time
 
 from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+from cachedmodel.utils.modelutils import replica_lag
+
+__all__ = (
+    'DBRouter',
+    'pin_reads',
+    'pin_reads_after_write',
+    'reads_pinned',
+    'reads_pinned_until',
+    'readonly_databases',
+)
+
+
+# time.time() until which reads in this context go to default, after a write
+_pinned_until = contextvars.ContextVar('pinned_until', default=0.0)
+
+
+def pin_reads(seconds=None):
+    """Send reads in this context (request or thread) to default for the replica lag window."""
+    until = time.time() + (replica_lag() if seconds is None else seconds)
+    if until > _pinned_until.get():
+        _pinned_until.set(until)
+
+
+def reads_pinned_until() -> float:
+    return _pinned_until.get()
+
+
+def reads_pinned() -> bool:
+    return _pinned_until.get() > time.time()
+
+
+@functools.cache
+def readonly_databases() -> tuple:
+    """The aliases of the databases flagged READONLY (or READ_ONLY), the replicas."""
+    return tuple(db_label for db_label, db_settings in settings.DATABASES.items()
+                 if any(ro_flag in db_settings.get('OPTIONS', {}) for ro_flag in ('READONLY', 'READ_ONLY')))
+
+
+# noinspection PyUnusedLocal
+def pin_reads_after_write(sender, using=None, **kwargs):
+    """
+    Connected to the model write signals by CoreConfig.ready(), rather than
+    pinning in db_for_write(), which Django also calls just to route queries.
+    """
+    if (using or DEFAULT_DB_ALIAS) == DEFAULT_DB_ALIAS and readonly_databases():
+        pin_reads()
 
 
 # noinspection PyMethodMayBeStatic
 class DBRouter:
 
     # noinspection PyAttributeOutsideInit
-    def readonly_db(self):
+    def readonly_db_list(self) -> list:
         if not hasattr(self, '_readonly_db_list'):
             """cache this"""
-            choices = list()
-            for db_label, db_settings in settings.DATABASES.items():
-                options = db_settings.get('OPTIONS', {})
-                if any(ro_flag in options for ro_flag in ('READONLY', 'READ_ONLY')):
-                    choices.append(db_label)
-            self._readonly_db_list = choices
-        if self._readonly_db_list:
-            return random.choice(self._readonly_db_list)
+            self._readonly_db_list = list(readonly_databases())
+        return self._readonly_db_list
+
+    def readonly_db(self):
+        choices = self.readonly_db_list()
+        if choices:
+            return random.choice(choices)
         return 'default'
 
     def db_for_read(self, model, **hints):
+        if reads_pinned():
+            # this request or session wrote recently, so read its own writes
+            return 'default'
         return self.readonly_db()
 
     def db_for_write(self, model, **hints):
@@ -2,10 +2,17 @@
 """
 This extends django.contrib.site.middleware.CurrentSiteMiddleware to
 also saves the site_id in an async local
+
+ReadPinningMiddleware keeps reads on the default database after a write
 """
+import math
+import time
+
 from django.contrib.sites.middleware import CurrentSiteMiddleware
 
 from components.site_info import site_info
+# noinspection PyProtectedMember
+from .db_router import _pinned_until, reads_pinned_until
 
 
 class CoreMiddleware(CurrentSiteMiddleware):
@@ -13,3 +20,33 @@ class CoreMiddleware(CurrentSiteMiddleware):
     def process_request(self, request):
         super().process_request(request)
         setattr(site_info, 'site_id', request.site.id)
+
+
+class ReadPinningMiddleware:
+    """
+    Keeps reads on the default database for the replica lag window after a
+    write, for the rest of the request and for the same browser's following
+    requests, through a cookie holding the time until which they are pinned.
+    Place it ahead of any middleware that reads the database.
+    """
+
+    cookie_name = 'db_pinned'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            pinned_until = float(request.COOKIES.get(self.cookie_name, 0))
+        except ValueError:
+            pinned_until = 0.0
+        token = _pinned_until.set(pinned_until)
+        try:
+            response = self.get_response(request)
+            until = reads_pinned_until()
+            if until > pinned_until:
+                response.set_cookie(self.cookie_name, f'{until:.3f}', max_age=math.ceil(until - time.time()),
+                                    httponly=True, samesite='Lax')
+            return response
+        finally:
+            _pinned_until.reset(token)
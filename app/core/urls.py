@@ -18,4 +18,5 @@ urlpatterns = [
 
     # API
     path('api/ping/', views.ping, name='ping'),
+    path('api/metrics/', views.metrics, name='metrics'),
 ]
\ No newline at end of file
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import login, logout
 from django.contrib.auth.forms import AuthenticationForm
@@ -7,6 +8,10 @@ from django.http import JsonResponse, HttpResponsePermanentRedirect, HttpRequest
 from django.views import View
 from django.views.generic import FormView
 
+from cachedmodel.manager import get_cached_get_stats
+from cachedmodel.models import cache_senders
+from cachedmodel.utils.lazymodel import get_model_cache_stats
+from cachedmodel.utils.metrics import cache_metrics
 from components.view_mixins import MarkdownPage, PrevPageMixin, TemplateSitetreeView
 from .forms import MessageForm
 
@@ -17,6 +22,7 @@ __all__ = (
     'LoginView',
     'LogoutView',
     'favicon',
+    'metrics',
     'ping'
 )
 
@@ -30,6 +36,19 @@ def ping(request):
     return JsonResponse({'message': 'pong'})
 
 
+def metrics(request):
+    """Row cache counters, for staff or monitoring from INTERNAL_IPS"""
+    if not (request.user.is_staff or request.META.get('REMOTE_ADDR') in getattr(settings, 'INTERNAL_IPS', ())):
+        return JsonResponse({'message': 'forbidden'}, status=403)
+
+    return JsonResponse({
+        'process': cache_metrics.snapshot(),
+        'shared': cache_metrics.shared_snapshot(cache_senders),
+        'tiers': get_model_cache_stats(),
+        'get_caches': get_cached_get_stats(),
+    })
+
+
 class HomeView(MarkdownPage):
     pass
 
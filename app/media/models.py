@@ -11,6 +11,9 @@ class Icon(CachedModel):
     svg = models.TextField(_('SVG'))
     tags = TaggableManager(_('Tags'))
 
+    # looked up by name from urls, including for icons which don't exist
+    cache_bloom_filter = True
+
     def __str__(self):
         return self.name
 
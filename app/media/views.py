@@ -10,9 +10,9 @@ def icon(request, name):
     for key in ('name', 'pk'):
         try:
             get_by = {key: name}
-            icon = Icon.objects.filter(**get_by).first()
+            icon = Icon.objects.get(**get_by)
             break
-        except Icon.DoesNotExist:
+        except (Icon.DoesNotExist, ValueError):
             continue
     else:
         return JsonResponse(
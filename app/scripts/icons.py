@@ -90,11 +90,13 @@ def main(args: argparse.Namespace):
         from media.models import Icon
         from django.contrib.contenttypes.models import ContentType
         from taggit.models import TaggedItem
+        from cachedmodel.utils.modelutils import bump_model_generation
 
         ct = ContentType.objects.get(app_label='core', model='icon')
         TaggedItem.objects.filter(content_type=ct).delete()
 
         Icon.objects.all().delete()
+        bump_model_generation(Icon)
 
     elif args.action == 'import':
         from media.models import Icon
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+import json
+from io import StringIO
+
+import pytest
+from django.core.management import call_command
+
+from media.models import Icon
+
+
+@pytest.mark.django_db(transaction=True)
+def test_benchmark_command(tmp_path):
+    output = tmp_path / 'results.json'
+    out = StringIO()
+    call_command('benchmark_model_cache', '--sizes', '5,10', '--number', '5', '--output', str(output), stdout=out)
+
+    report = json.loads(output.read_text())
+    assert report['meta']['sizes'] == [5, 10]
+    results = {(result['benchmark'], result['phase'], result.get('size')): result for result in report['results']}
+    assert results['get_pk', 'warm', 10]['round_trips'] < results['get_pk', 'cold', 10]['round_trips']
+    assert results['get_pk', 'warm', 10]['queries'] == 0
+    assert results['get_pk', 'cold', 10]['queries'] == 1
+    assert ('lookup_key', 'compiled', None) in results
+    # the rows added are removed
+    assert not Icon.objects.filter(name__startswith='benchmark-').exists()
+
+    call_command('benchmark_model_cache', '--sizes', '5', '--number', '5', '--benchmark', 'get_pk',
+                 '--compare', str(output), stdout=out)
+    assert 'ratio' in out.getvalue()
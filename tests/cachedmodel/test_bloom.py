@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import pytest
+from django.db import router
+
+from cachedmodel.utils import bloom as bloom_module
+from cachedmodel.utils.bloom import BloomFilter, ModelBloomFilter
+from cachedmodel.utils.lazymodel import get_model_cache
+from media.models import Icon
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(1000)
+    items = [f'name={n!r}' for n in range(1000)]
+    for item in items:
+        bloom.add(item)
+    assert all(item in bloom for item in items)
+    false_positives = sum(f'name={n!r}' in bloom for n in range(1000, 11000))
+    assert false_positives < 200
+
+
+@pytest.fixture
+def bloom(monkeypatch):
+    get_model_cache()[0].clear()
+    Icon.objects.create(name='exists', svg='')
+    # not one that another test may have started building in the background
+    bloom = ModelBloomFilter(Icon)
+    monkeypatch.setitem(bloom_module._bloom_filters, Icon, bloom)
+    bloom.rebuild()
+    return bloom
+
+
+@pytest.mark.django_db(transaction=True)
+def test_bloom_excludes(bloom, django_assert_num_queries):
+    missing_pk = Icon.objects.get(name='exists').pk + 1000
+    with django_assert_num_queries(0):
+        with pytest.raises(Icon.DoesNotExist):
+            Icon.objects.get(name='missing')
+        with pytest.raises(Icon.DoesNotExist):
+            Icon.objects.get(pk=missing_pk)
+
+    created = Icon.objects.create(name='created', svg='')
+    assert Icon.objects.get(name='created') == created
+    assert Icon.objects.get_many([created.pk]) == {created.pk: created}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_bloom_published(bloom):
+    # another process has its own filter
+    other = ModelBloomFilter(Icon)
+    other.rebuild()
+    assert not other.may_exist(name='created')
+
+    Icon.objects.create(name='created', svg='')
+    other._next_sync = 0.0
+    assert other.may_exist(name='created')
+
+    Icon.objects.filter(name='created').update(name='renamed')
+    other._next_sync = 0.0
+    # reset in both processes
+    assert other.may_exist(name='renamed')
+    assert Icon.objects.get(name='renamed').name == 'renamed'
+
+
+@pytest.mark.django_db(transaction=True)
+def test_bloom_built_from_primary(bloom, monkeypatch):
+    # reads go to a replica, which may not have the latest rows
+    monkeypatch.setattr(router, 'db_for_read', lambda model, **hints: 'replica')
+    other = ModelBloomFilter(Icon)
+    other.rebuild()
+    assert other.may_exist(name='exists')
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from django.core.cache import caches
+from django_redis.cache import RedisCache
+
+from cachedmodel.utils.bulkcache import cache_add_many
+
+
+class FakeRedis:
+    """Just enough of a Redis client to run SET NX commands in a pipeline."""
+
+    def __init__(self):
+        self.data = {}
+        self.commands = []
+        self.executed = 0
+
+    def pipeline(self):
+        return self
+
+    def set(self, name, value, nx=False, px=None, xx=False):
+        self.commands.append((name, value, nx))
+        return self
+
+    def execute(self):
+        self.executed += 1
+        results = []
+        for name, value, nx in self.commands:
+            added = not (nx and name in self.data)
+            if added:
+                self.data[name] = value
+            results.append(True if added else None)
+        self.commands = []
+        return results
+
+
+def test_cache_add_many_redis(monkeypatch):
+    cache = RedisCache('redis://127.0.0.1:6379/15', {})
+    redis = FakeRedis()
+    monkeypatch.setattr(cache.client, 'get_client', lambda *args, **kwargs: redis)
+
+    assert cache_add_many(cache, {'a': 1, 'b': 2}, timeout=60) == []
+    assert cache_add_many(cache, {'b': 3, 'c': 4}, timeout=60) == ['b']
+    # one pipeline for each batch
+    assert redis.executed == 2
+    assert cache.client.decode(redis.data[cache.make_key('b')]) == 2
+
+
+def test_cache_add_many():
+    cache = caches['default']
+    cache.clear()
+    cache.set('b', 2)
+    assert cache_add_many(cache, {'a': 1, 'b': 3}) == ['b']
+    assert cache.get_many(['a', 'b']) == {'a': 1, 'b': 2}
+    assert cache_add_many(cache, {}) == []
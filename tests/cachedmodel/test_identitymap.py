@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import pytest
+from asgiref.sync import async_to_sync
+from django.http import HttpResponse
+from django.test import RequestFactory
+
+from cachedmodel.middleware import IdentityMapMiddleware
+from cachedmodel.testing import CountingCache
+from cachedmodel.utils.identitymap import current_identity_map, identity_map
+from cachedmodel.utils.lazymodel import LazyModelObject, LazyModelObjectDict, get_model_cache
+from cachedmodel.utils.modelutils import get_identifier
+from media.models import Icon
+
+
+@pytest.fixture
+def icon():
+    icon = Icon.objects.create(name='icon', svg='')
+    get_model_cache()[0].clear()
+    return icon
+
+
+@pytest.mark.django_db(transaction=True)
+def test_identity_map(icon, django_assert_num_queries):
+    with identity_map() as identities:
+        fetched = Icon.objects.get(pk=icon.pk)
+        with django_assert_num_queries(0), CountingCache() as counter:
+            assert Icon.objects.get(pk=str(icon.pk)) is fetched
+            lazy = LazyModelObject(get_identifier(icon))
+            assert lazy.name == 'icon' and lazy._wrapped is fetched
+            objects = LazyModelObjectDict()
+            objects.add(get_identifier(icon))
+            objects.resolve()
+            assert objects[get_identifier(icon)]._wrapped is fetched
+            assert async_to_sync(Icon.objects.aget)(pk=icon.pk) is fetched
+        assert counter.round_trips == 0
+
+        # a lookup reads the cache once, then is found in the map
+        assert Icon.objects.get(name='icon') is fetched
+        with CountingCache() as counter:
+            assert Icon.objects.get(name='icon') is fetched
+        assert counter.round_trips == 0
+
+        # saved objects are fetched again
+        fetched.svg = '<svg/>'
+        fetched.save()
+        assert len(identities) == 0
+        assert Icon.objects.get(name='icon') is not fetched
+        assert Icon.objects.get(pk=icon.pk).svg == '<svg/>'
+
+    assert current_identity_map() is None
+    assert Icon.objects.get(pk=icon.pk) is not Icon.objects.get(pk=icon.pk)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_identity_map_middleware(icon):
+    def view(request):
+        assert Icon.objects.get(pk=icon.pk) is Icon.objects.get(name='icon')
+        return HttpResponse()
+
+    async def async_view(request):
+        assert await Icon.objects.aget(pk=icon.pk) is await Icon.objects.aget(pk=icon.pk)
+        return HttpResponse()
+
+    request = RequestFactory().get('/')
+    assert IdentityMapMiddleware(view)(request).status_code == 200
+    assert async_to_sync(IdentityMapMiddleware(async_view))(request).status_code == 200
+    assert current_identity_map() is None
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+import pytest
+from django.db.models import Q
+
+from cachedmodel.utils.keycompiler import lookup_keys
+from cachedmodel.utils.modelutils import lookup_cache_key
+from media.models import Icon
+
+
+def test_lookup_keys():
+    key = lookup_keys(Icon, {'name': 'a', 'id__gt': 1})
+    assert key.startswith('media.icon.')
+    assert key == lookup_keys(Icon, {'id__gt': 1, 'name': 'a'})
+    assert key == lookup_keys(Icon, {'id__gt': '1', 'name': 'a'})
+    assert key != lookup_keys(Icon, {'name': 'a', 'id__lt': 1})
+    assert key != lookup_keys(Icon, {'name': 'b', 'id__gt': 1})
+    assert lookup_keys(Icon, {'name': 'a'}) != lookup_keys(Icon, {'name': None})
+
+
+def test_lookup_keys_uncachable():
+    assert lookup_keys(Icon, {'name__in': Icon.objects.all()}) is None
+    assert lookup_cache_key(Icon, Q(name='a')) is None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_q_lookups_bypass_cache():
+    Icon.objects.create(name='a', svg='')
+    Icon.objects.create(name='b', svg='')
+    assert Icon.objects.get(Q(name='a')).name == 'a'
+    assert Icon.objects.get(Q(name='b')).name == 'b'
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+import json
+from io import StringIO
+
+import pytest
+from django.core.management import CommandError, call_command
+
+from media.models import Icon
+
+
+@pytest.mark.django_db(transaction=True)
+def test_load_command(tmp_path):
+    output = tmp_path / 'results.json'
+    out = StringIO()
+    call_command('load_model_cache', '--rows', '20', '--threads', '2', '--duration', '0.5', '--write-ratio', '0.5',
+                 '--seed', '1', '--output', str(output), stdout=out)
+
+    report = json.loads(output.read_text())
+    assert report['meta']['threads'] == 2
+    results = report['results']
+    assert results['ops'] > 0
+    assert results['operations']['write']['ops'] > 0
+    # saves in one thread are seen by reads in the other
+    assert results['stale_reads'] == 0
+    assert 'stale reads: 0' in out.getvalue()
+    assert not Icon.objects.filter(name__startswith='load-').exists()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_load_command_processes_need_shared_cache():
+    # forked processes don't share a local memory cache
+    with pytest.raises(CommandError, match='local memory'):
+        call_command('load_model_cache', '--processes', '2', '--duration', '0.1', stdout=StringIO())
+    assert not Icon.objects.filter(name__startswith='load-').exists()
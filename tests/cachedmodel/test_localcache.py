@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from django.core.cache import caches
+
+from cachedmodel.utils.localcache import LocalCache, TieredCache
+
+PREFIX = 'CachedModel:'
+
+
+def make_worker(max_entries=10):
+    return TieredCache(caches['default'], LocalCache(max_entries=max_entries, timeout=60), PREFIX)
+
+
+def test_local_cache_lru():
+    local = LocalCache(max_entries=2)
+    local.set('a', 1)
+    local.set('b', 2)
+    assert local.get('a') == 1
+    local.set('c', 3)
+    assert local.get('b') is None
+    assert local.get('a') == 1
+    stats = local.stats()
+    assert stats['evictions'] == 1
+    assert stats['hits'] == 2
+    assert stats['misses'] == 1
+
+
+def test_local_cache_ttl():
+    local = LocalCache(timeout=-1)
+    local.set('a', 1)
+    assert local.get('a') is None
+    assert local.stats()['expirations'] == 1
+
+
+def test_tiered_invalidation_between_workers():
+    caches['default'].clear()
+    worker1, worker2 = make_worker(), make_worker()
+    key = f'{PREFIX}test.model.1'
+
+    worker1.set(key, 'one')
+    assert worker2.get(key) == 'one'
+    assert worker2.get(key) == 'one'
+    assert worker2.stats()['l1']['hits'] == 1
+
+    # an update from one worker is seen on the next lookup of the other
+    worker1.set(key, 'two')
+    assert worker2.get(key) == 'two'
+    assert worker2.stats()['l1']['stale'] == 1
+
+    worker1.delete(key)
+    assert worker2.get(key) is None
+    assert key not in worker2
+
+
+def test_tiered_passthrough():
+    caches['default'].clear()
+    worker = make_worker()
+    worker.set('OtherKey', 1)
+    assert worker.get('OtherKey') == 1
+    assert len(worker._local) == 0
+
+
+def test_tiered_add_many():
+    caches['default'].clear()
+    worker1, worker2 = make_worker(), make_worker()
+    key1, key2 = f'{PREFIX}test.model.1', f'{PREFIX}test.model.2'
+    worker1.set(key1, 'one')
+
+    # only missing rows are added, and kept locally
+    assert worker2.add_many({key1: 'stale', key2: 'two', 'OtherKey': 1}) == [key1]
+    assert worker1.get(key1) == 'one'
+    assert worker2.get(key2) == 'two'
+    assert worker2.stats()['l1']['hits'] == 1
+    assert worker2.get('OtherKey') == 1
+    assert not worker2.add(key2, 'again')
+
+    # a stamp outliving its row is replaced, so it can't validate older copies
+    caches['default'].delete(key2)
+    assert worker1.add(key2, 'new')
+    assert worker2.get(key2) == 'new'
+    assert worker2.stats()['l1']['stale'] == 1
@@ -0,0 +1,573 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import threading
+from io import StringIO
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import FieldError
+from django.core.management import call_command
+from django.db import connection, router, transaction
+from django.db.models import Count
+from django.db.models.signals import post_save
+
+from cachedmodel import manager
+from cachedmodel.manager import CachedGetManager, get_cached_get_stats
+from cachedmodel.models import remove_object_from_cache
+from cachedmodel.query import RowCacheQuerySet
+from cachedmodel.utils import bloom
+from cachedmodel.utils import lazymodel
+from cachedmodel.utils.invalidation import is_pending
+from cachedmodel.utils.lazymodel import (
+    LazyModelObject,
+    LazyModelObjectDict,
+    get_model_cache,
+    get_model_schemas,
+    model_cache_key,
+    model_schema,
+    model_schemas_key,
+    pack_row,
+    unpack_row,
+)
+from cachedmodel.utils.modelutils import (
+    bump_model_generation,
+    get_model_by_label,
+    get_model_generation,
+    model_cache_deleted_cache_key,
+    preload_content_types,
+)
+from core.models import Message
+from media.models import Icon
+
+
+@pytest.fixture
+def icons():
+    created = [Icon.objects.create(name=f'icon-{n}', svg='') for n in range(5)]
+    cache, _ = get_model_cache()
+    cache.clear()
+    return created
+
+
+@pytest.mark.django_db(transaction=True)
+def test_get_many(icons, django_assert_num_queries):
+    pks = [icon.pk for icon in icons]
+    with django_assert_num_queries(1):
+        result = Icon.objects.get_many(pks)
+    assert sorted(result) == pks
+    assert all(result[icon.pk].name == icon.name for icon in icons)
+
+    # all rows are now cached
+    with django_assert_num_queries(0):
+        assert Icon.objects.get_many(pks).keys() == result.keys()
+        assert Icon.objects.get(pk=pks[0]).name == icons[0].name
+
+
+@pytest.mark.django_db(transaction=True)
+def test_in_bulk_missing(icons, django_assert_num_queries, monkeypatch):
+    # without the Bloom filter, which would leave out the missing pk
+    monkeypatch.setitem(bloom._bloom_filters, Icon, None)
+    pks = [icon.pk for icon in icons]
+    missing = max(pks) + 100
+    with django_assert_num_queries(1):
+        result = Icon.objects.in_bulk(pks + [missing])
+    assert missing not in result
+    assert len(result) == len(pks)
+
+    # misses are only cached for models with cache_for_does_not_exist
+    with django_assert_num_queries(1):
+        Icon.objects.in_bulk([missing])
+
+
+@pytest.mark.django_db(transaction=True)
+def test_lookup_invalidated_on_save(icons, django_assert_num_queries):
+    icon = Icon.objects.get(name='icon-0')
+    with django_assert_num_queries(0):
+        assert Icon.objects.get(name='icon-0').pk == icon.pk
+
+    icon.name = 'renamed'
+    icon.save()
+    with pytest.raises(Icon.DoesNotExist):
+        Icon.objects.get(name='icon-0')
+    assert Icon.objects.get(name='renamed').pk == icon.pk
+
+
+@pytest.mark.django_db(transaction=True)
+def test_model_generation(icons, django_assert_num_queries):
+    pks = [icon.pk for icon in icons]
+    Icon.objects.get_many(pks)
+    Icon.objects.get(name='icon-0')
+
+    bump_model_generation(Icon)
+    with django_assert_num_queries(1):
+        assert len(Icon.objects.get_many(pks)) == len(pks)
+    with django_assert_num_queries(1):
+        Icon.objects.get(name='icon-0')
+
+
+@pytest.mark.django_db(transaction=True)
+def test_invalidate_model_cache_command(icons, django_assert_num_queries):
+    Icon.objects.get(pk=icons[0].pk)
+    call_command('invalidate_model_cache', 'media.Icon', stdout=StringIO())
+    with django_assert_num_queries(1):
+        Icon.objects.get(pk=icons[0].pk)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_queryset_update(icons):
+    pks = [icon.pk for icon in icons]
+    Icon.objects.get_many(pks)
+
+    assert Icon.objects.filter(pk__in=pks[:2]).update(svg='updated') == 2
+    assert [Icon.objects.get(pk=pk).svg for pk in pks[:3]] == ['updated', 'updated', '']
+
+
+@pytest.mark.django_db(transaction=True)
+def test_queryset_writes_use_write_database(icons, monkeypatch):
+    # a replica which isn't there, so reading the affected pks from it would fail
+    monkeypatch.setattr(router, 'db_for_read', lambda model, **hints: 'replica')
+    with transaction.atomic():
+        assert Icon.objects.filter(pk=icons[0].pk).update(svg='updated') == 1
+        # applied when the transaction commits
+        assert is_pending(model_cache_key(Icon, icons[0].pk))
+    Icon.objects.filter(pk=icons[1].pk).delete()
+    monkeypatch.undo()
+    assert Icon.objects.get(pk=icons[0].pk).svg == 'updated'
+    assert not Icon.objects.filter(pk=icons[1].pk).exists()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_queryset_writes_lock_affected_rows(icons, monkeypatch):
+    locks = []
+    select_for_update = RowCacheQuerySet.select_for_update
+    monkeypatch.setattr(RowCacheQuerySet, 'select_for_update',
+                        lambda self, **kwargs: locks.append(kwargs) or select_for_update(self, **kwargs))
+    monkeypatch.setattr(connection.features, 'has_select_for_update_of', True)
+    pks = [icon.pk for icon in icons]
+    Icon.objects.get_many(pks)
+    icons[0].tags.add('blue')
+
+    # only this model's rows, not the nullable side of the outer join
+    assert Icon.objects.filter(tags=None, pk__in=pks[3:]).delete()[0] == 2
+    assert locks == [{'of': ('self',)}]
+    # distinct or grouped rows can't be locked
+    assert Icon.objects.filter(tags__name='blue').distinct().update(svg='updated') == 1
+    assert Icon.objects.annotate(n=Count('tags')).filter(n=0, pk=pks[1]).delete()[0] == 1
+    assert len(locks) == 1
+    assert Icon.objects.get(pk=pks[0]).svg == 'updated'
+    assert sorted(Icon.objects.get_many(pks)) == [pks[0], pks[2]]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_queryset_bulk_update(icons):
+    for icon in icons:
+        Icon.objects.get(pk=icon.pk)
+        icon.svg = 'bulk'
+    Icon.objects.bulk_update(icons, ['svg'])
+    assert all(icon.svg == 'bulk' for icon in Icon.objects.get_many([icon.pk for icon in icons]).values())
+
+
+@pytest.mark.django_db(transaction=True)
+def test_write_through(django_assert_num_queries):
+    icon = Icon.objects.create(name='written', svg='')
+    with django_assert_num_queries(0):
+        assert Icon.objects.get(pk=icon.pk).name == 'written'
+
+    with transaction.atomic():
+        icon.svg = 'changed'
+        icon.save()
+        # the row is not updated in cache until the transaction commits
+        with django_assert_num_queries(1):
+            assert Icon.objects.get(pk=icon.pk).svg == 'changed'
+
+    with django_assert_num_queries(0):
+        assert Icon.objects.get(pk=icon.pk).svg == 'changed'
+
+
+@pytest.mark.django_db(transaction=True)
+def test_recently_changed_marker(icons, django_assert_num_queries, settings):
+    cache, _ = get_model_cache()
+    icon = icons[0]
+    with transaction.atomic():
+        icon.name = 'renamed'
+        icon.save()
+        # only marked once committed
+        assert cache.get(model_cache_deleted_cache_key(icon)) is None
+    assert cache.get(model_cache_deleted_cache_key(icon)) is True
+    assert cache.get(model_cache_deleted_cache_key(icons[1])) is None
+
+    # the markers are read along with the rows, and not taken for rows
+    remove_object_from_cache(Icon, icon)
+    with django_assert_num_queries(1):
+        result = Icon.objects.get_many([icon.pk, icons[1].pk])
+    assert sorted(result) == [icon.pk, icons[1].pk]
+    assert result[icon.pk].name == 'renamed'
+    with django_assert_num_queries(1):
+        assert Icon.objects.get(name='renamed').pk == icon.pk
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize('module, fetch', [
+    (manager, lambda icon: Icon.objects.get(pk=icon.pk)),
+    (manager, lambda icon: Icon.objects.get_many([icon.pk])),
+    (lazymodel, lambda icon: lazymodel.resolve_lazy_objects([LazyModelObject(Icon, icon.pk)])),
+])
+def test_fill_keeps_newer_row(icons, monkeypatch, module, fetch):
+    cache, _ = get_model_cache()
+    icon = icons[0]
+    # the one the save writes to, rather than one held from before the cache was cleared
+    get_model_generation(Icon, fresh=True)
+    fill_rows = module.fill_rows
+
+    def save_then_fill(*args, **kwargs):
+        # a save committed after the row was read from the database
+        icon.name = 'renamed'
+        icon.save()
+        fill_rows(*args, **kwargs)
+
+    monkeypatch.setattr(module, 'fill_rows', save_then_fill)
+    fetch(icon)
+    assert unpack_row(cache.get(model_cache_key(icon)))[0].name == 'renamed'
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize('fetch', [
+    lambda icon: LazyModelObject(Icon, icon.pk).name,
+    lambda icon: lazymodel.resolve_lazy_objects([LazyModelObject(Icon, icon.pk)]),
+    lambda icon: Icon.objects.filter(pk=icon.pk).cached(),
+])
+def test_fills_read_recently_changed_from_primary(icons, monkeypatch, fetch):
+    cache, _ = get_model_cache()
+    icon = icons[0]
+    icon.name = 'renamed'
+    icon.save()
+    cache.delete(model_cache_key(icon))
+    # a replica which hasn't caught up with the save
+    monkeypatch.setattr(router, 'db_for_read', lambda model, **hints: 'replica')
+    fetch(icon)
+    assert unpack_row(cache.get(model_cache_key(icon)))[0].name == 'renamed'
+
+
+@pytest.mark.django_db(transaction=True)
+def test_cached_get_manager(django_assert_num_queries, django_user_model):
+    users = CachedGetManager()
+    users.model = django_user_model
+    icons = CachedGetManager()
+    icons.model = Icon
+    user = django_user_model.objects.create(username='user')
+    icon = Icon.objects.create(pk=user.pk, name='icon', svg='')
+
+    with django_assert_num_queries(2):
+        assert users.get(pk=user.pk).username == 'user'
+        assert icons.get(pk=user.pk).name == 'icon'
+    # models are cached apart, and pks as given or as strings are the same
+    with django_assert_num_queries(0):
+        assert users.get(id=str(user.pk)).username == 'user'
+        assert icons.get(pk=user.pk).name == 'icon'
+
+    icon.name = 'renamed'
+    icon.save()
+    with django_assert_num_queries(1):
+        assert icons.get(pk=icon.pk).name == 'renamed'
+    icon.delete()
+    with pytest.raises(Icon.DoesNotExist):
+        icons.get(pk=user.pk)
+
+    stats = get_cached_get_stats()
+    assert stats['auth.user']['entries'] == 1
+    assert stats['auth.user']['bytes'] > 0
+    assert stats['auth.user']['hits'] == 1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_cached_get_manager_dict_backend(django_assert_num_queries):
+    class DictCachedGetManager(CachedGetManager):
+        cache_backend = {}
+
+    icons = DictCachedGetManager()
+    icons.model = Icon
+    icon = Icon.objects.create(name='icon', svg='')
+    with django_assert_num_queries(1):
+        assert icons.get(pk=icon.pk).name == 'icon'
+        assert icons.get(pk=str(icon.pk)).name == 'icon'
+    assert list(DictCachedGetManager.cache_backend) == [icon.pk]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_schema_in_row_keys(icons, monkeypatch):
+    cache, _ = get_model_cache()
+    icon = icons[0]
+    get_model_generation(Icon, fresh=True)
+    key = model_cache_key(icon)
+    assert f':{model_schema("media.icon")}:media.icon.{icon.pk}' in key
+
+    # another version of the model, deployed alongside this one
+    monkeypatch.setattr(lazymodel, '_deployed_schemas', {})
+    cache.set(model_schemas_key('media.icon'), ('0badf00d',))
+    old_key = key.replace(model_schema('media.icon'), '0badf00d')
+    cache.set(old_key, pack_row(icon, None))
+    assert get_model_schemas('media.icon') == ('0badf00d', model_schema('media.icon'))
+
+    # a change invalidates its rows too
+    icon.save()
+    assert old_key not in cache
+    assert unpack_row(cache.get(key))[0] == icon
+
+
+@pytest.mark.django_db(transaction=True)
+def test_rollback_leaves_cache(django_assert_num_queries):
+    icon = Icon.objects.create(name='kept', svg='')
+    with pytest.raises(RuntimeError):
+        with transaction.atomic():
+            icon.svg = 'discarded'
+            icon.save()
+            raise RuntimeError()
+
+    with django_assert_num_queries(0):
+        assert Icon.objects.get(pk=icon.pk).svg == ''
+
+
+def test_signals_only_for_cached_models(django_user_model):
+    assert remove_object_from_cache in post_save._live_receivers(Icon)
+    assert remove_object_from_cache not in post_save._live_receivers(Site)
+    # connected at startup, as cached_related() caches the users messages refer to
+    assert remove_object_from_cache in post_save._live_receivers(django_user_model)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_aget(icons, django_assert_num_queries):
+    icon = icons[0]
+    with django_assert_num_queries(1):
+        assert async_to_sync(Icon.objects.aget)(pk=icon.pk) == icon
+    with django_assert_num_queries(0):
+        assert async_to_sync(Icon.objects.aget)(pk=icon.pk).name == icon.name
+
+    with django_assert_num_queries(1):
+        assert async_to_sync(Icon.objects.aget)(name='icon-1') == icons[1]
+    with django_assert_num_queries(0):
+        assert async_to_sync(Icon.objects.aget)(name='icon-1') == icons[1]
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize('async_client', [False, True])
+def test_async_reads_leave_event_loop(icons, monkeypatch, async_client):
+    get, get_many = LocMemCache.get, LocMemCache.get_many
+    blocking = []
+    native = threading.local()
+
+    def in_event_loop():
+        if getattr(native, 'client', False):
+            return False
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+        return True
+
+    def sync_get(self, *args, **kwargs):
+        blocking.append(in_event_loop())
+        return get(self, *args, **kwargs)
+
+    def sync_get_many(self, *args, **kwargs):
+        blocking.append(in_event_loop())
+        return get_many(self, *args, **kwargs)
+
+    monkeypatch.setattr(LocMemCache, 'get', sync_get)
+    monkeypatch.setattr(LocMemCache, 'get_many', sync_get_many)
+    if async_client:
+        async def aget(self, *args, **kwargs):
+            native.client = True
+            try:
+                return get(self, *args, **kwargs)
+            finally:
+                native.client = False
+
+        async def aget_many(self, *args, **kwargs):
+            native.client = True
+            try:
+                return get_many(self, *args, **kwargs)
+            finally:
+                native.client = False
+
+        monkeypatch.setattr(LocMemCache, 'aget', aget, raising=False)
+        monkeypatch.setattr(LocMemCache, 'aget_many', aget_many, raising=False)
+
+    pks = [icon.pk for icon in icons]
+    bump_model_generation(Icon)
+    for _ in range(2):
+        assert async_to_sync(Icon.objects.aget)(pk=pks[0]) == icons[0]
+        assert async_to_sync(Icon.objects.aget)(name='icon-1') == icons[1]
+        assert sorted(async_to_sync(Icon.objects.aget_many)(pks)) == pks
+        assert async_to_sync(LazyModelObject(Icon, pks[2]).aresolve)() == icons[2]
+    assert blocking and not any(blocking)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_aget_many(icons, django_assert_num_queries):
+    pks = [icon.pk for icon in icons]
+    Icon.objects.get(pk=pks[0])
+    with django_assert_num_queries(1):
+        assert sorted(async_to_sync(Icon.objects.aget_many)(pks)) == pks
+    with django_assert_num_queries(0):
+        assert sorted(async_to_sync(Icon.objects.aget_many)(pks)) == pks
+
+
+@pytest.mark.django_db(transaction=True)
+def test_lazy_aresolve(icons, django_assert_num_queries):
+    items = LazyModelObjectDict()
+    item = async_to_sync(items.aget_or_add)(Icon, icons[0].pk)
+    assert item.name == icons[0].name
+    with django_assert_num_queries(0):
+        assert async_to_sync(LazyModelObject(Icon, icons[0].pk).aresolve)() == icons[0]
+    assert async_to_sync(LazyModelObject(Icon, 0).aresolve)() is None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_lazy_object_without_content_types(icons, django_assert_num_queries):
+    ContentType.objects.clear_cache()
+    assert get_model_by_label('media.icon') is Icon
+    assert get_model_by_label('media.nothing') is None
+    with django_assert_num_queries(1):
+        assert LazyModelObject(Icon, icons[0].pk).name == icons[0].name
+        assert LazyModelObject.get_model_class(f'media.icon.{icons[0].pk}') is Icon
+
+    preload_content_types()
+    with django_assert_num_queries(0):
+        assert ContentType.objects.get_for_model(Icon).model_class() is Icon
+
+
+@pytest.mark.django_db(transaction=True)
+def test_lazy_dict_batch(icons, django_assert_num_queries, django_user_model):
+    user = django_user_model.objects.create(username='user')
+    cache, _ = get_model_cache()
+    cache.clear()
+    Icon.objects.get(pk=icons[0].pk)
+
+    items = LazyModelObjectDict()
+    with django_assert_num_queries(0):
+        added = [items.add(Icon, icon.pk) for icon in icons]
+        added += [items.add(Icon, 0), items.add(django_user_model, user.pk)]
+        assert items.add(Icon, icons[1].pk) is added[1]
+    # one query for each model, for those not already cached
+    with django_assert_num_queries(2):
+        assert added[2].name == icons[2].name
+    with django_assert_num_queries(0):
+        assert [item.name for item in added[:5]] == [icon.name for icon in icons]
+        assert not added[5]
+        assert added[6].username == 'user'
+        assert items.get_or_add(Icon, 0) is None
+        assert items.get_or_add(Icon, icons[3].pk) is added[3]
+
+    # and now all cached
+    items = LazyModelObjectDict()
+    with django_assert_num_queries(0):
+        added = [items.add(Icon, icon.pk) for icon in icons]
+        items.resolve()
+        assert [item.name for item in added] == [icon.name for icon in icons]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_cached_queryset(icons, django_assert_num_queries):
+    queryset = Icon.objects.filter(name__in=['icon-3', 'icon-1', 'icon-4']).order_by('-name')
+    with django_assert_num_queries(1):
+        assert [icon.name for icon in queryset.all().cached()] == ['icon-4', 'icon-3', 'icon-1']
+    with django_assert_num_queries(0):
+        assert [icon.name for icon in queryset.all().cached()] == ['icon-4', 'icon-3', 'icon-1']
+    with django_assert_num_queries(1):
+        assert Icon.objects.filter(name='missing').cached() == []
+    with django_assert_num_queries(0):
+        assert Icon.objects.filter(name='missing').cached() == []
+
+    # any change to the model is seen
+    Icon.objects.create(name='icon-5', svg='')
+    with django_assert_num_queries(1):
+        assert len(queryset.all().cached()) == 3
+    Icon.objects.filter(name='icon-4').update(name='icon-40')
+    with django_assert_num_queries(1):
+        assert [icon.name for icon in queryset.all().cached()] == ['icon-3', 'icon-1']
+
+    # and to the models it joins
+    ContentType.objects.get_for_model(Icon)
+    tagged = Icon.objects.filter(tags__name='blue')
+    with django_assert_num_queries(1):
+        assert tagged.all().cached() == []
+    icons[2].tags.add('blue')
+    with django_assert_num_queries(1):
+        assert tagged.all().cached() == [icons[2]]
+    with django_assert_num_queries(0):
+        assert tagged.all().cached() == [icons[2]]
+
+    # not cached inside a transaction with uncommitted changes
+    with transaction.atomic():
+        Icon.objects.filter(pk=icons[2].pk).update(svg='<svg/>')
+        with django_assert_num_queries(1):
+            assert tagged.all().cached()[0].svg == '<svg/>'
+
+
+@pytest.mark.django_db(transaction=True)
+def test_cached_queryset_annotations(icons, django_assert_num_queries):
+    icons[0].tags.add('blue', 'green')
+    annotated = Icon.objects.filter(pk=icons[0].pk).annotate(n=Count('tags'))
+    # evaluated as usual, so the annotations are there every time
+    for _ in range(2):
+        with django_assert_num_queries(1):
+            assert [icon.n for icon in annotated.all().cached()] == [2]
+    # and the annotated instances aren't cached as rows
+    assert get_model_cache()[0].get(model_cache_key(icons[0])) is None
+    assert not hasattr(Icon.objects.get(pk=icons[0].pk), 'n')
+
+    with django_assert_num_queries(1):
+        assert [icon.name for icon in Icon.objects.filter(pk=icons[1].pk).extra(select={'n': '1'}).cached()] \
+            == ['icon-1']
+    assert get_model_cache()[0].get(model_cache_key(icons[1])) is None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_cached_related(django_assert_num_queries, django_user_model):
+    users = [django_user_model.objects.create(username=f'user-{n}') for n in range(3)]
+    for n in range(6):
+        Message.objects.create(topic=f'topic-{n}', text='', to=users[n % 3], created_by=users[0])
+    get_model_cache()[0].clear()
+
+    with django_assert_num_queries(2):
+        messages = list(Message.objects.cached_related('to', 'created_by'))
+        assert [message.to for message in messages] == [users[n % 3] for n in range(6)]
+        assert all(message.created_by == users[0] for message in messages)
+
+    # the users are now cached
+    with django_assert_num_queries(1):
+        messages = list(Message.objects.filter(topic='topic-1').cached_related('to'))
+        assert messages[0].to == users[1]
+
+    with pytest.raises(FieldError):
+        Message.objects.cached_related('text')
+
+
+@pytest.mark.django_db(transaction=True)
+def test_warm_model_cache_command(icons, django_assert_num_queries, monkeypatch):
+    # rows are read from the primary, not a replica which may be behind it
+    monkeypatch.setattr(router, 'db_for_read', lambda model, **hints: 'replica')
+    out = StringIO()
+    call_command('warm_model_cache', 'media.Icon', '--filter', 'media.Icon:name=icon-0', stdout=out)
+    assert 'cached 1 of 1 rows' in out.getvalue()
+
+    # rows already cached are left alone, and each chunk is added in one batch
+    batches = []
+    add_many = lazymodel.cache_add_many
+    monkeypatch.setattr(lazymodel, 'cache_add_many', lambda cache, rows, **kwargs: batches.append(len(rows)) or
+                        add_many(cache, rows, **kwargs))
+    call_command('warm_model_cache', 'media.Icon', '--filter', 'media.Icon:name__startswith=icon-',
+                 '--chunk-size', '2', '--rate', '1000', stdout=out)
+    assert 'cached 4 of 5 rows' in out.getvalue()
+    assert batches == [2, 2, 1]
+    with django_assert_num_queries(0):
+        assert len(Icon.objects.get_many([icon.pk for icon in icons])) == len(icons)
+
+    # and those changed recently are left alone even when forced
+    icons[0].save()
+    out = StringIO()
+    call_command('warm_model_cache', 'media.Icon', '--filter', 'media.Icon:name__startswith=icon-', '--force',
+                 stdout=out)
+    assert 'cached 4 of 5 rows' in out.getvalue()
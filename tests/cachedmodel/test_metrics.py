@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from io import StringIO
+
+import pytest
+from django.core.management import call_command
+
+from cachedmodel.utils.lazymodel import get_model_cache
+from cachedmodel.utils.metrics import cache_metrics
+from media.models import Icon
+
+
+@pytest.fixture
+def metrics():
+    cache_metrics.reset([Icon])
+    yield cache_metrics
+    cache_metrics.reset([Icon])
+
+
+@pytest.mark.django_db(transaction=True)
+def test_counts(metrics):
+    icon = Icon.objects.create(name='counted', svg='')
+    get_model_cache()[0].clear()
+
+    Icon.objects.get(pk=icon.pk)
+    Icon.objects.get(pk=icon.pk)
+    Icon.objects.get(name='counted')
+    icon.save()
+
+    counts = metrics.snapshot()['media.icon']
+    assert counts['pk']['hits'] == 1
+    assert counts['pk']['misses'] == 1
+    assert counts['pk']['db_fallbacks'] == 1
+    assert counts['pk']['invalidations'] == 2
+    assert counts['pk']['backend_calls'] == 2
+    assert counts['lookup']['misses'] == 1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_flush_and_command(metrics):
+    icon = Icon.objects.create(name='counted', svg='')
+    Icon.objects.get(pk=icon.pk)
+    metrics.flush()
+
+    assert metrics.shared_snapshot([Icon])['media.icon']['pk']['hits'] == 1
+    out = StringIO()
+    call_command('model_cache_stats', 'media.Icon', '--reset', stdout=out)
+    assert 'media.icon' in out.getvalue()
+    assert metrics.shared_snapshot([Icon]) == {}
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import pytest
+from asgiref.sync import async_to_sync
+
+from cachedmodel.testing import CountingCache
+from cachedmodel.utils.lazymodel import LazyModelObject, get_model_cache
+from cachedmodel.utils.metrics import cache_metrics
+from media.models import Icon
+
+
+@pytest.fixture
+def icon(monkeypatch):
+    icon = Icon.objects.create(name='icon', svg='')
+    get_model_cache()[0].clear()
+    # no metrics flushes or Bloom filter checks while counting
+    monkeypatch.setattr(cache_metrics, '_next_flush', float('inf'))
+    monkeypatch.setattr(Icon.objects, '_bloom_excludes', lambda kind, **kwargs: False)
+    # cache the row and lookup, and the model's generation in the process
+    Icon.objects.get(name='icon')
+    return icon
+
+
+@pytest.mark.django_db(transaction=True)
+def test_get_pk_round_trips(icon, django_assert_num_queries):
+    with django_assert_num_queries(0), CountingCache() as counter:
+        assert Icon.objects.get(pk=icon.pk) == icon
+    assert counter.round_trips == 1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_get_lookup_round_trips(icon, django_assert_num_queries):
+    with django_assert_num_queries(0), CountingCache() as counter:
+        assert Icon.objects.get(name='icon') == icon
+    # the lookup, then its namespace version with the row
+    assert counter.round_trips == 2
+
+    with CountingCache() as counter:
+        assert async_to_sync(Icon.objects.aget)(name='icon') == icon
+    assert counter.round_trips == 2
+
+
+@pytest.mark.django_db(transaction=True)
+def test_lazy_object_round_trips(icon, django_assert_num_queries):
+    with django_assert_num_queries(0), CountingCache() as counter:
+        assert LazyModelObject(Icon, icon.pk).name == 'icon'
+        assert Icon.objects.get_many([icon.pk]) == {icon.pk: icon}
+    assert counter.round_trips == 2
+
+
+@pytest.mark.django_db(transaction=True)
+def test_counting_cache_nested_calls():
+    cache, _ = get_model_cache()
+    with CountingCache() as counter:
+        # the local memory cache's get_many() calls get() for each key
+        cache.get_many(['a', 'b', 'c'])
+        cache.set_many({'a': 1, 'b': 2})
+    assert counter.calls == {'get_many': 1, 'set_many': 1}
+    assert counter.keys == {'get_many': 3, 'set_many': 2}
+    # removed afterwards
+    cache.get('a')
+    assert counter.round_trips == 2
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import pickle
+
+import pytest
+from django.utils.functional import empty
+
+from cachedmodel.utils.lazymodel import get_model_cache, model_cache_key, unpack_row
+from cachedmodel.utils.serialization import compact_rows_enabled, decode_row, encode_row, is_encoded_row
+from media.models import Icon
+
+
+@pytest.fixture
+def compact_rows(settings):
+    settings.MODEL_ROW_CACHE_COMPACT = True
+    compact_rows_enabled.cache_clear()
+    yield
+    compact_rows_enabled.cache_clear()
+
+
+def test_encode_row():
+    icon = Icon(pk=1, name='compact', svg='<svg/>')
+    encoded = encode_row(icon)
+    assert is_encoded_row(encoded)
+    assert len(pickle.dumps(encoded)) < len(pickle.dumps(icon))
+
+    decoded = decode_row(pickle.loads(pickle.dumps(encoded)))
+    assert (decoded.pk, decoded.name, decoded.svg) == (1, 'compact', '<svg/>')
+    assert not decoded._state.adding
+
+
+def test_decode_row_schema_changed():
+    encoded = encode_row(Icon(pk=1, name='compact', svg=''))
+    assert decode_row(encoded[:2] + (encoded[2] + 1,) + encoded[3:]) is empty
+
+
+@pytest.mark.django_db(transaction=True)
+def test_compact_rows_cached(compact_rows, django_assert_num_queries):
+    icon = Icon.objects.create(name='compact', svg='')
+    cache, _ = get_model_cache()
+    cache.clear()
+
+    Icon.objects.get(pk=icon.pk)
+    with django_assert_num_queries(0):
+        assert Icon.objects.get(pk=icon.pk).name == 'compact'
+        assert Icon.objects.get_many([icon.pk])[icon.pk].name == 'compact'
+
+    cached = cache.get(model_cache_key(icon))
+    assert is_encoded_row(cached[0])
+    assert unpack_row(cached)[0] == icon
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+from django.core.cache import caches
+
+from cachedmodel.utils.lazymodel import pack_row, refresh_early, unpack_row
+from cachedmodel.utils.singleflight import SingleFlight
+
+
+def test_single_flight_coalesces_threads():
+    flight = SingleFlight()
+    calls = []
+    results = []
+
+    def load():
+        calls.append(1)
+        time.sleep(0.1)
+        return 'loaded'
+
+    def worker():
+        results.append(flight.do('key', load))
+
+    threads = [threading.Thread(target=worker) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert sorted(shared for _, shared in results) == [False, True, True, True, True]
+    assert all(result == 'loaded' for result, _ in results)
+
+
+def test_single_flight_reentrant():
+    flight = SingleFlight()
+    assert flight.do('key', lambda: flight.do('key', lambda: 'inner')[0]) == ('inner', False)
+
+
+def test_single_flight_forget():
+    flight = SingleFlight()
+    loading = threading.Event()
+    finish = threading.Event()
+    results = []
+
+    def load():
+        loading.set()
+        finish.wait(1)
+        return 'before'
+
+    first = threading.Thread(target=lambda: results.append(flight.do('key', load)))
+    first.start()
+    loading.wait(1)
+    # a change was written meanwhile, so later callers don't wait for the load under way
+    flight.forget()
+    assert flight.do('key', lambda: 'after') == ('after', False)
+    finish.set()
+    first.join()
+    assert results == [('before', False)]
+    assert flight.do('key', lambda: 'again') == ('again', False)
+
+
+def test_single_flight_waits_for_other_process():
+    cache = caches['default']
+    cache.clear()
+    flight = SingleFlight()
+    # another process holds the fill lock and has since filled the key
+    cache.add('CachedModelFill:key', 1)
+    result = flight.do('key', lambda: 'loaded', cache=cache, recheck=lambda: 'filled')
+    assert result == ('filled', False)
+
+
+def test_refresh_early():
+    instance, expires, delta = unpack_row(pack_row('row', 60, 0.01))
+    assert instance == 'row'
+    assert not refresh_early(expires, delta)
+    # expired or about to, having taken a long time to load
+    assert refresh_early(time.time(), 10)
+    assert not refresh_early(None, 10)
+    assert unpack_row('legacy') == ('legacy', None, 0.0)
@@ -24,3 +24,13 @@ def test_ping(client):
     assert 'message' in resp_json
     assert resp_json['message'] == 'pong'
 
+
+@pytest.mark.django_db
+def test_metrics(client, settings):
+    response = client.get(reverse('metrics'))
+    assert response.status_code == int(status.FORBIDDEN)
+
+    settings.INTERNAL_IPS = ['127.0.0.1']
+    response = client.get(reverse('metrics'))
+    assert response.status_code == int(status.OK)
+    assert {'process', 'shared', 'tiers'} <= response.json().keys()
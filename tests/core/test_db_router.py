@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import contextvars
+import time
+
+import pytest
+from django.http import HttpResponse
+from django.test import RequestFactory
+
+from core import db_router
+from core.db_router import DBRouter, pin_reads, pin_reads_after_write, reads_pinned
+from core.middleware import ReadPinningMiddleware
+from core.models import Message
+
+
+def _replica_router():
+    router = DBRouter()
+    router._readonly_db_list = ['readonly']
+    return router
+
+
+@pytest.mark.django_db
+def test_reads_pinned_after_write(monkeypatch):
+    monkeypatch.setattr(db_router, 'readonly_databases', lambda: ('readonly',))
+
+    def run():
+        router = _replica_router()
+        assert router.db_for_read(Message) == 'readonly'
+        # routing a write doesn't pin, as Django also does it just to pick a database
+        assert router.db_for_write(Message) == 'default'
+        assert not reads_pinned()
+        Message.objects.create(topic='pinned', text='')
+        assert reads_pinned()
+        assert router.db_for_read(Message) == 'default'
+
+    contextvars.copy_context().run(run)
+    # only for the context which wrote
+    assert not reads_pinned()
+
+
+def test_reads_not_pinned_without_replicas():
+    def run():
+        router = DBRouter()
+        router._readonly_db_list = []
+        assert router.db_for_write(Message) == 'default'
+        pin_reads_after_write(Message, using='default')
+        assert not reads_pinned()
+
+    contextvars.copy_context().run(run)
+
+
+def test_read_pinning_middleware():
+    factory = RequestFactory()
+
+    def write(request):
+        pin_reads()
+        return HttpResponse()
+
+    response = ReadPinningMiddleware(write)(factory.get('/'))
+    cookie = response.cookies[ReadPinningMiddleware.cookie_name]
+    assert float(cookie.value) > time.time()
+    assert not reads_pinned()
+
+    # later requests from the same browser read from default too
+    def read(request):
+        assert reads_pinned()
+        return HttpResponse()
+
+    request = factory.get('/')
+    request.COOKIES[ReadPinningMiddleware.cookie_name] = cookie.value
+    response = ReadPinningMiddleware(read)(request)
+    assert ReadPinningMiddleware.cookie_name not in response.cookies
+
+    # ignored if not a time
+    def unpinned(request):
+        assert not reads_pinned()
+        return HttpResponse()
+
+    request = factory.get('/')
+    request.COOKIES[ReadPinningMiddleware.cookie_name] = 'junk'
+    ReadPinningMiddleware(unpinned)(request)